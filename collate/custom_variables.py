@@ -1,10 +1,91 @@
 '''A collection of tasks to perform related to Piwik custom variables.'''
 import logging
 import re
+import collections
+import time
+import multiprocessing
 
 import dbsources
 import dbengine
 
+# Each worker process populates shards with its own copy, see run_parallel.
+_SHARD_POPULATE = None
+
+def _shard_setup(populate):
+    '''Prepare a worker process with its own database connections.'''
+    global _SHARD_POPULATE
+    populate.CONNECTION = populate.CONNECTION.clone()
+    populate.READER = None
+    _SHARD_POPULATE = populate
+
+def _shard_run(keyrange):
+    '''Populate a shard in a worker process.'''
+    return _SHARD_POPULATE.run_shard(keyrange)
+
+class ActionMap(object):
+    '''Actions resolved to a scode and category, loaded once from Piwik.
+
+    Actions are read in chunks when first needed. If they all fit within
+    the limit, any action up to the last one read that is not in the map
+    is known to have no code, so there is no need to ask the database.
+    With a limit the map keeps the most recently used actions and looks
+    up the rest one at a time.
+    '''
+    def __init__(self, populate, limit=None, chunk=100000):
+        self.POPULATE = populate # how to look up and understand actions
+        self.LIMIT = limit # most actions to keep, None for no limit
+        self.CHUNK = chunk # actions to read with each query
+        self.ACTIONS = dict() # idaction: (scode, category) or False
+        if limit:
+            self.ACTIONS = collections.OrderedDict()
+        self.COMPLETE = False # every action up to LAST has been read
+        self.LAST = 0 # highest idaction read
+        self.HITS = 0
+        self.MISSES = 0
+
+    def sql_actions(self, after):
+        table, key, check, down = self.POPULATE.CONFIG.get_action_look_config()
+        return 'SELECT %s , %s , %s FROM %s WHERE %s > %s ORDER BY %s LIMIT %s'%(
+                        key, check, down, table, key, after, key, self.CHUNK)
+
+    def load(self):
+        '''Read the actions that have a code, a chunk at a time.'''
+        read = 0
+        while True:
+            rows = self.POPULATE.CONNECTION.fetchall(self.sql_actions(self.LAST))
+            for row in rows:
+                found = self.POPULATE.action_details(row)
+                if found:
+                    self.ACTIONS[int(row[0])] = found
+                self.LAST = int(row[0])
+            read += len(rows)
+            if len(rows) < self.CHUNK:
+                self.COMPLETE = True
+                break
+            if self.LIMIT and len(self.ACTIONS) >= self.LIMIT:
+                break
+        logging.info('Actions read: %s, with codes: %s'%(read, len(self.ACTIONS)))
+
+    def get(self, action):
+        '''Return scode and category of action, or False if not useful.'''
+        key = int(action)
+        if key in self.ACTIONS:
+            self.HITS += 1
+            found = self.ACTIONS[key]
+            if self.LIMIT: # keep recently used actions
+                del self.ACTIONS[key]
+                self.ACTIONS[key] = found
+            return found
+        if self.COMPLETE and key <= self.LAST:
+            self.HITS += 1
+            return False
+        self.MISSES += 1
+        found = self.POPULATE.lookup_action(key)
+        self.ACTIONS[key] = found
+        if self.LIMIT and len(self.ACTIONS) > self.LIMIT:
+            self.ACTIONS.popitem(last=False)
+        return found
+
 class Populate(object):
     '''Take existing data and populate custom variables.'''
     def __init__(self):
@@ -19,9 +100,21 @@ class Populate(object):
         self.DCODE_VIEW = 'v' # value to insert when it is a view
         self.DCODE_DOWN = 'd' # value to insert when a download
         
+        # Resolve actions from a map read once, rather than a query each.
+        self.PRELOAD_ACTIONS = True
+        self.ACTION_LIMIT = None # most actions to keep, eg. for huge installs
+        self.ACTIONS = None # see ActionMap
+        
+        # Updates are written in batches, each with one commit.
+        self.UPDATE_BATCH_SIZE = 1000 # 1 to update and commit each row
+        self.UPDATES = list() # (key, scode, dcode) waiting to be written
+        
         # Control how the WHERE clause will be generated.
         self.FIND_WHERE_METHOD = self.where_notdone
         self.FIND_BATCH_SIZE = 10000 # takes < 1 minute
+        self.FIND_KEY_RANGE = None # (low, high) keys of a shard to populate
+        self.FIND_LAST_KEY = 0 # where the keyset method has got to
+        self.READER = None # streams rows while updates use CONNECTION
         
     def setup(self):
         '''Setup the connection to the system being populated.'''
@@ -64,10 +157,22 @@ class Populate(object):
         
     def get_action(self, action):
         '''Return details about an action.'''
+        if not self.PRELOAD_ACTIONS:
+            return self.lookup_action(action)
+        if self.ACTIONS is None:
+            self.ACTIONS = ActionMap(self, self.ACTION_LIMIT)
+            self.ACTIONS.load()
+        return self.ACTIONS.get(action)
+    
+    def lookup_action(self, action):
+        '''Return details about an action, querying the database.'''
         result = self.action_lookup(action)
         if not result:
             return False
+        return self.action_details(result)
         
+    def action_details(self, result):
+        '''Return code and category from an action lookup result.'''
         code = self.action_extract_code(result[1])
         if not code:
             return False
@@ -83,7 +188,7 @@ class Populate(object):
     def action_extract_code(self, checkname):
         found = re.search(self.PATTERN_CHECK, checkname)
         if found:
-            code = 'uuid:%s'%str(found.group(2)).lower()
+            code = intern('uuid:%s'%str(found.group(2)).lower())
             return code
         else:
             return False
@@ -97,23 +202,54 @@ class Populate(object):
     
     def setup_where(self, cat='test'):
         '''Setup the where clause to use when finding items to update.'''
-        if cat not in ['test','notdone']:
+        if cat not in ['test','notdone','keyset']:
             raise ValueError
         if cat == 'test':
             self.FIND_WHERE_METHOD = self.where_test
         elif cat == 'notdone':
             self.FIND_WHERE_METHOD = self.where_notdone
+        elif cat == 'keyset':
+            self.FIND_WHERE_METHOD = self.where_keyset
+            self.FIND_LAST_KEY = 0
         
     def where_test(self):
         return ' LIMIT 0, 5'
     
     def where_notdone(self):
-        return " WHERE %s IS NULL LIMIT 0, %s"%(
-            self.CONFIG.FIELD_CUSTOM_VARS_DCODE, self.FIND_BATCH_SIZE)
+        keyrange = ''
+        if self.FIND_KEY_RANGE:
+            keyrange = ' AND %s BETWEEN %s AND %s'%((self.CONFIG.FIELD_STORE_KEY,)
+                                                   + tuple(self.FIND_KEY_RANGE))
+        return " WHERE %s IS NULL%s LIMIT 0, %s"%(
+            self.CONFIG.FIELD_CUSTOM_VARS_DCODE, keyrange, self.FIND_BATCH_SIZE)
+     
+    def where_keyset(self):
+        '''Page through rows not done by key, so each page costs the same.'''
+        key = self.CONFIG.FIELD_STORE_KEY
+        where = " WHERE %s > %s AND %s IS NULL"%(key, self.FIND_LAST_KEY,
+                                                self.CONFIG.FIELD_CUSTOM_VARS_DCODE)
+        if self.FIND_KEY_RANGE:
+            where += ' AND %s <= %s'%(key, self.FIND_KEY_RANGE[1])
+        return '%s ORDER BY %s LIMIT %s'%(where, key, self.FIND_BATCH_SIZE)
      
     def find_items_to_populate(self, how='test'):
+        if self.FIND_WHERE_METHOD == self.where_keyset:
+            return self.stream_items()
         query = self.sql_find_items()
         return self.CONNECTION.fetchall(query)
+    
+    def stream_items(self):
+        '''Yield rows not done a page at a time, until there are none left.'''
+        if not self.READER:
+            self.READER = self.CONNECTION.clone()
+        while True:
+            found = 0
+            for row in self.READER.stream(self.sql_find_items()):
+                found += 1
+                self.FIND_LAST_KEY = row[0]
+                yield row
+            if found < self.FIND_BATCH_SIZE:
+                return
 
     # Update the store if necessary.
     def sql_update(self, key, scode, dcode):
@@ -128,9 +264,43 @@ class Populate(object):
         '''Execute the update of key with scode and dcode.'''
         query = self.sql_update(key, scode, dcode)
         return self.CONNECTION.update(query)
+    
+    def sql_update_keys(self, number):
+        '''Return SQL to set the same codes for a number of keys.'''
+        table,  fieldkey = self.CONFIG.get_update_store_config()
+        update = "UPDATE %s SET "%table
+        scode = "%s = %%s , "%self.CONFIG.FIELD_CUSTOM_VARS_SCODE
+        dcode = "%s = %%s "%self.CONFIG.FIELD_CUSTOM_VARS_DCODE
+        where = "WHERE %s IN (%s)"%(fieldkey, ', '.join(['%s']*number))
+        return '%s%s%s%s'%(update, scode, dcode, where)
+    
+    def queue_update(self, key, scode, dcode):
+        '''Update key with scode and dcode when the batch is full.'''
+        if self.UPDATE_BATCH_SIZE <= 1:
+            return self.update_codes(key, scode, dcode)
+        self.UPDATES.append((key, scode, dcode))
+        if len(self.UPDATES) >= self.UPDATE_BATCH_SIZE:
+            self.flush_updates()
+    
+    def flush_updates(self):
+        '''Write the waiting updates, one statement for each pair of codes.'''
+        if not self.UPDATES:
+            return 0
+        keys = dict() # (scode, dcode): keys to update
+        for key, scode, dcode in self.UPDATES:
+            keys.setdefault((scode, dcode), list()).append(key)
+        statements = list()
+        for (scode, dcode), group in keys.iteritems():
+            params = [scode, dcode] + group
+            statements.append((self.sql_update_keys(len(group)), params))
+        self.CONNECTION.update_batch(statements)
+        written = len(self.UPDATES)
+        self.UPDATES = list()
+        return written
         
     def run_populate(self):
         '''Check the store and update any custom variables needed.'''
+        start = time.time()
         views = 0
         downloads = 0
         others = 0
@@ -174,18 +344,108 @@ class Populate(object):
                     else:
                         scode = new_code
                           
-            self.update_codes(key, scode, dcode)
-            
+            self.queue_update(key, scode, dcode)
+        self.flush_updates()
+        
+        done = views + downloads + others
+        taken = max(time.time()-start, 0.001)
+        logging.info('Rows updated: %s in %.1f seconds, %.0f rows/s'%(
+                        done, taken, done/taken))
         return views, downloads, others
             
+    # Populate in parallel, each worker doing shards of the keys.
+    def sql_key_range(self):
+        table, key = self.CONFIG.get_update_store_config()
+        dcode = self.CONFIG.FIELD_CUSTOM_VARS_DCODE
+        return 'SELECT MIN(%s) , MAX(%s) FROM %s WHERE %s IS NULL'%(
+                        key, key, table, dcode)
+    
+    def shard_ranges(self, shards):
+        '''Return disjoint (low, high) key ranges covering rows not done.'''
+        low, high = self.CONNECTION.fetchone(self.sql_key_range())
+        if low is None:
+            return list()
+        low, high = int(low), int(high)
+        size = max(1, (high-low+1)//shards + 1)
+        return [(start, min(start+size-1, high)) for start in range(low, high+1, size)]
+    
+    def run_shard(self, keyrange):
+        '''Populate all rows not done in keyrange, a page at a time.'''
+        self.FIND_WHERE_METHOD = self.where_keyset
+        self.FIND_KEY_RANGE = keyrange
+        self.FIND_LAST_KEY = keyrange[0] - 1
+        totals = [0, 0, 0]
+        while True:
+            counts = self.run_populate()
+            totals = [total+count for total, count in zip(totals, counts)]
+            if not sum(counts):
+                break
+        self.CONNECTION.close()
+        if self.READER:
+            self.READER.close()
+        return tuple(totals)
+    
+    def run_parallel(self, workers=4, shards=None, retries=2):
+        '''Populate shards of the keys using a pool of worker processes.
+        
+        Returns the views, downloads and others of all shards. A shard
+        that fails is tried again up to retries times, since only rows
+        not yet done are found this is safe to do.
+        '''
+        start = time.time()
+        if self.PRELOAD_ACTIONS and self.ACTIONS is None:
+            self.ACTIONS = ActionMap(self, self.ACTION_LIMIT)
+            self.ACTIONS.load() # once, the workers share this copy
+        pending = self.shard_ranges(shards or workers*4)
+        self.CONNECTION.close() # workers must not share the connections
+        if self.READER:
+            self.READER.close()
+        logging.info('Shards to populate: %s'%len(pending))
+        totals = [0, 0, 0]
+        pool = multiprocessing.Pool(workers, _shard_setup, (self,))
+        try:
+            for attempt in range(retries+1):
+                running = [(keyrange, pool.apply_async(_shard_run, (keyrange,)))
+                           for keyrange in pending]
+                pending = list()
+                for keyrange, result in running:
+                    try:
+                        counts = result.get()
+                    except Exception, e:
+                        logging.warn('Shard %s failed: %s'%(keyrange, e))
+                        pending.append(keyrange)
+                        continue
+                    totals = [total+count for total, count in zip(totals, counts)]
+                if not pending:
+                    break
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        if pending:
+            logging.critical('Shards not populated: %s'%pending)
+        done = sum(totals)
+        taken = max(time.time()-start, 0.001)
+        logging.info('Parallel rows updated: %s in %.1f seconds, %.0f rows/s'%(
+                        done, taken, done/taken))
+        return tuple(totals)
+            
 if __name__ == '__main__':
     '''Do nothing unless enabled.'''
     testing = False
     process = False
+    parallel = False
     if process:
         p = Populate()
         p.FIND_BATCH_SIZE = 10000000 # override the default
+        p.setup_where('keyset') # stream, so memory use stays flat
         p.run_populate()   
+    if parallel:
+        logging.basicConfig(level=logging.INFO)
+        p = Populate()
+        print p.run_parallel(workers=4)
     if testing:
         logging.basicConfig(level=logging.INFO)
         p = Populate()
@@ -211,5 +471,6 @@ if __name__ == '__main__':
         print 'View: %s'%views
         print 'Downloads: %s'%downloads
         print 'Ignores: %s'%ignores
+        print 'Action lookups, map: %s, database: %s'%(p.ACTIONS.HITS, p.ACTIONS.MISSES)
         
     
\ No newline at end of file
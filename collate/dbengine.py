@@ -1,6 +1,7 @@
 '''Enable connection to database engine.'''
 import logging
 import MySQLdb as db
+import MySQLdb.cursors # for server side cursors
 
 import dbsources # So we can use configuration options
 
@@ -47,6 +48,27 @@ class Connection(object):
         cursor.execute(query)
         return cursor.fetchall()
     
+    def stream(self, query, size=1000):
+        '''Yield the rows of query without holding them all in memory.
+        
+        Uses a server side cursor, so nothing else can be run on this
+        connection until all the rows have been read.
+        '''
+        logging.debug('Stream query: %s'%query)
+        if not self.CONNECTION and not self.connect():
+            return
+        cursor = self.CONNECTION.cursor(db.cursors.SSCursor)
+        try:
+            cursor.execute(query)
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+    
     def fetchone(self, query):
         logging.debug('Fetch one query: %s'%query)
         cursor = self.cursor()
@@ -58,12 +80,34 @@ class Connection(object):
         cursor = self.cursor()
         cursor.execute(query)
         self.CONNECTION.commit()
+    
+    def update_batch(self, statements):
+        '''Execute (query, params) statements then commit them all once.'''
+        cursor = self.cursor()
+        try:
+            for query, params in statements:
+                logging.debug('Batch update query: %s'%query)
+                cursor.execute(query, params)
+        except db.Error:
+            self.CONNECTION.rollback()
+            raise
+        self.CONNECTION.commit()
         
     def close(self):
         '''Close the DB connection if required.'''
         if self.CONNECTION:
             logging.debug('Closing connection')
             self.CONNECTION.close()
+            self.CONNECTION = None
+    
+    def clone(self):
+        '''Return an unconnected Connection with the same settings.'''
+        other = Connection()
+        other.HOST = self.HOST
+        other.USER = self.USER
+        other.PASSWORD = self.PASSWORD
+        other.DATABASE = self.DATABASE
+        return other
 
 class PiwikConfig(object):
     '''Configuration of tables and fields in Piwik.'''
@@ -0,0 +1,177 @@
+'''HTTP front-end answering summaries with a single GET from the cache.'''
+import logging
+import os
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+import timecache
+import seriescodec # compact caches are served too
+
+ACADEMIC_START = 8 # academic years start in August
+BATCH_LIMIT = 1000 # most scodes in one batch request
+
+def academic_year(year, month):
+    '''Return the label of the academic year a month is in, eg. 2012-13.'''
+    if month < ACADEMIC_START:
+        year -= 1
+    return '%s-%02d'%(year, (year+1)%100)
+
+class FrontEndHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answer the URLs SingleRequest uses, see engines.py.'''
+    protocol_version = 'HTTP/1.1' # so clients can keep connections alive
+    server_version = 'StatsTimeCache/1'
+    wbufsize = -1 # send the head and body together, avoiding delayed ACKs
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        scode = params.get('scode', [''])[0]
+        cache = self.server.cache()
+        try:
+            content = self.answer(cache, url, params, scode)
+        finally:
+            self.server.release(cache)
+        if content is None:
+            return self.send_error(404)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def answer(self, cache, url, params, scode):
+        '''Return the content for a URL, or None if it is unknown.'''
+        if url.path.startswith('/results/dv/'):
+            content = self.vdown(cache, self.static_scode(url.path))
+        elif url.path in ('/results/vdown.php', '/results/vdown_act.php',
+                          '/results/get.php'):
+            content = self.vdown(cache, scode)
+        elif url.path == '/results/yearmonth.php':
+            content = self.yearmonth(cache, scode, params.get('yeartype', [''])[0])
+        elif url.path == '/results/getgrby.php':
+            content = self.group(cache, scode)
+        elif url.path == '/results/batch.php':
+            content = self.batch(cache, params)
+        else:
+            content = None
+        return content
+
+    def static_scode(self, path):
+        '''Return the scode from a path like /results/dv/15/b8/6a5d-...'''
+        parts = path.split('/')[3:]
+        return 'uuid:%s'%''.join(parts)
+
+    def vdown(self, cache, scode):
+        '''Return total views and downloads, eg. 10;2'''
+        return '%s;%s'%cache.totals(scode)
+
+    def yearmonth(self, cache, scode, yeartype):
+        '''Return a line of views and downloads for each month.'''
+        lines = list()
+        for year, month, views, downloads in cache.monthly(scode):
+            if yeartype == 'ac':
+                label = academic_year(year, month)
+            else:
+                label = year
+            lines.append('%s\t%s\t%s\t%s'%(label, month, views, downloads))
+        return '\n'.join(lines)
+
+    def group(self, cache, scode):
+        '''Return a line of views and downloads for each year.'''
+        years = dict()
+        for year, unused, views, downloads in cache.monthly(scode):
+            total = years.setdefault(year, [0, 0])
+            total[0] += views
+            total[1] += downloads
+        lines = ['%s\t%s\t%s'%(year, v, d) for year, (v, d) in sorted(years.items())]
+        return '\n'.join(lines)
+
+    def batch(self, cache, params):
+        '''Return a line for each scode, eg. scodes=uuid:a,uuid:b'''
+        scodes = list()
+        for value in params.get('scodes', []):
+            scodes += [scode for scode in value.split(',') if scode]
+        lines = list()
+        for scode in scodes[:BATCH_LIMIT]:
+            lines.append('%s\t%s'%(scode, self.vdown(cache, scode)))
+        return '\n'.join(lines)
+
+    def log_message(self, format, *args):
+        logging.debug('%s %s'%(self.address_string(), format%args))
+
+class FrontEnd(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Threaded server using the cache, reopened when it is replaced.'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, fname=timecache.CACHE_FILE):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FrontEndHandler)
+        self.FNAME = fname
+        self.CACHE = None
+        self.STAT = None # identifies the file the cache was opened from
+        self.CHECKED = 0 # time the file was last checked
+        self.CHECK_EVERY = 1.0 # seconds
+        self.USERS = dict() # cache: requests using it
+        self.RETIRED = list() # replaced caches, closed once not in use
+        self.LOCK = threading.Lock()
+
+    def cache(self):
+        '''Return the cache, opening the latest file if it has changed.
+
+        Each cache returned must be given back to release when done.
+        '''
+        with self.LOCK:
+            if time.time()-self.CHECKED >= self.CHECK_EVERY:
+                self.CHECKED = time.time()
+                stat = os.stat(self.FNAME)
+                current = (stat.st_ino, stat.st_mtime)
+                if current != self.STAT:
+                    logging.info('Opening cache: %s'%self.FNAME)
+                    if self.CACHE is not None:
+                        self.RETIRED.append(self.CACHE)
+                    self.CACHE = seriescodec.open_cache(self.FNAME)
+                    self.STAT = current
+                    self.close_retired()
+            self.USERS[self.CACHE] = self.USERS.get(self.CACHE, 0) + 1
+            return self.CACHE
+
+    def release(self, cache):
+        '''Stop using a cache, closing it if replaced and no longer used.'''
+        with self.LOCK:
+            self.USERS[cache] -= 1
+            if not self.USERS[cache]:
+                del self.USERS[cache]
+            self.close_retired()
+
+    def close_retired(self):
+        '''Close replaced caches no request is using, so their maps and
+        the deleted files behind them are freed. Call holding LOCK.'''
+        for cache in list(self.RETIRED):
+            if cache not in self.USERS:
+                logging.info('Closing replaced cache')
+                cache.close()
+                self.RETIRED.remove(cache)
+
+def command_line():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('-p', help='Port to listen on', dest='port',
+                      default=8080, type='int')
+    parser.add_option('-c', help='Cache file to use, raw or compact', dest='fname',
+                      default=timecache.CACHE_FILE)
+    parser.add_option('-v', help='Enables info logging', dest='info',
+                      default=False, action="store_true")
+    (options, unused) = parser.parse_args()
+    if options.info:
+        logging.basicConfig(level=logging.INFO)
+    return options
+
+if __name__ == '__main__':
+    options = command_line()
+    server = FrontEnd(('', options.port), options.fname)
+    server.release(server.cache()) # fail now if there is no cache
+    logging.warn('Serving %s on port %s'%(options.fname, options.port))
+    server.serve_forever()
@@ -0,0 +1,178 @@
+'''Most used objects of each month and year, found in bounded memory.'''
+import heapq
+import logging
+import os
+import time
+
+import timecache
+
+WHATS = ('views', 'downloads')
+BATCH_DIR = os.path.join('..', 'times', 'batches') # see about.txt there
+TOP_HEADER = 'Count\tError\tScode'
+
+class SpaceSaving(object):
+    '''Most frequent keys of a stream, keeping at most capacity counters.
+
+    When a new key arrives and every counter is in use, the key with the
+    smallest count is replaced by the new key, which takes over that
+    count as its possible error (the Space-Saving algorithm). Any key
+    seen more than total/capacity times is kept, and counts are over by
+    at most their error.
+    '''
+    def __init__(self, capacity=1000):
+        self.CAPACITY = capacity
+        self.COUNTS = dict() # key: [count, error]
+        self.HEAP = list() # (count, key), out of date ones are skipped
+        self.TOTAL = 0
+
+    def add(self, key, count=1):
+        '''Count key, count times.'''
+        self.TOTAL += count
+        found = self.COUNTS.get(key)
+        if found is None:
+            if len(self.COUNTS) < self.CAPACITY:
+                found = self.COUNTS[key] = [0, 0]
+            else:
+                smallest, evicted = self.smallest()
+                del self.COUNTS[evicted]
+                found = self.COUNTS[key] = [smallest, smallest]
+        found[0] += count
+        heapq.heappush(self.HEAP, (found[0], key))
+        if len(self.HEAP) > 4*self.CAPACITY:
+            self.compact()
+
+    def smallest(self):
+        '''Remove and return the smallest count and its key from the heap.'''
+        while True:
+            count, key = heapq.heappop(self.HEAP)
+            found = self.COUNTS.get(key)
+            if found is not None and found[0] == count:
+                return count, key
+
+    def compact(self):
+        '''Rebuild the heap with only the current counts.'''
+        self.HEAP = [(found[0], key) for key, found in self.COUNTS.iteritems()]
+        heapq.heapify(self.HEAP)
+
+    def top(self, k=100):
+        '''Return (key, count, error) of the k most frequent keys.'''
+        ranked = sorted(self.COUNTS.iteritems(),
+                        key=lambda (key, found): (-found[0], key))
+        return [(key, count, error) for key, (count, error) in ranked[:k]]
+
+    def threshold(self):
+        '''Return the count above which keys are sure to be kept.'''
+        return self.TOTAL//self.CAPACITY
+
+    def __len__(self):
+        return len(self.COUNTS)
+
+class HeavyHitters(object):
+    '''Space-Saving summaries of views and downloads by month and year.
+
+    Periods are years, eg. 2013, and months, eg. 2013-09. Memory is
+    bounded by the capacity times the number of periods seen.
+    '''
+    def __init__(self, capacity=1000):
+        self.CAPACITY = capacity
+        self.SUMMARIES = dict() # (what, period): SpaceSaving
+        self.ROWS = 0
+
+    def summary(self, what, period):
+        '''Return the summary of what in period, making it if needed.'''
+        key = (what, period)
+        if key not in self.SUMMARIES:
+            self.SUMMARIES[key] = SpaceSaving(self.CAPACITY)
+        return self.SUMMARIES[key]
+
+    def add(self, scode, what, year, month, count=1):
+        '''Count views or downloads of scode in a month and its year.'''
+        if what not in WHATS:
+            raise ValueError('Unknown count: %s'%what)
+        self.ROWS += 1
+        self.summary(what, '%s'%year).add(scode, count)
+        self.summary(what, '%s-%02d'%(int(year), int(month))).add(scode, count)
+
+    def periods(self, what='views'):
+        '''Return the periods with counts of what, oldest first.'''
+        return sorted([period for found, period in self.SUMMARIES if found == what])
+
+    def latest_year(self, what='views'):
+        '''Return the latest year with counts of what, or None.'''
+        years = [period for period in self.periods(what) if '-' not in period]
+        if not years:
+            return None
+        return years[-1]
+
+    def top(self, what='views', period=None, k=100):
+        '''Return (scode, count, error) of the k most used in period,
+        the latest year if not given.'''
+        if period is None:
+            period = self.latest_year(what)
+        if (what, period) not in self.SUMMARIES:
+            return list()
+        return self.SUMMARIES[(what, period)].top(k)
+
+    def result(self, what='views', period=None, k=20):
+        '''Return a table of the k most used in period.'''
+        answer = [TOP_HEADER]
+        for scode, count, error in self.top(what, period, k):
+            answer.append('%s\t%s\t%s'%(count, error, scode))
+        return '\n'.join(answer)
+
+    def write_batch(self, what='views', period=None, k=100, order=6,
+                    directory=BATCH_DIR):
+        '''Write the k most used in period as a sample, returning its name.
+
+        The name follows the samples, eg. 6_topviews2013_100.csv runs
+        after the other samples and has 100 codes.
+        '''
+        if period is None:
+            period = self.latest_year(what)
+        scodes = [scode for scode, unused, unused in self.top(what, period, k)]
+        hint = 'top%s%s'%(what, period or '')
+        fname = os.path.join(directory, '%s_%s_%s.csv'%(order, hint, len(scodes)))
+        with file(fname, 'w') as outfile:
+            outfile.write(''.join(['%s\n'%scode for scode in scodes]))
+        logging.info('Batch of %s codes: %s'%(len(scodes), fname))
+        return fname
+
+class HitterBuilder(timecache.CacheBuilder):
+    '''Find the heavy hitters in the custom variables Populate has set.'''
+    def sql_events(self):
+        '''Return SQL selecting the scode, year, month and dcode of events.'''
+        table = self.CONFIG.TABLE_CUSTOM_VARS_STORE
+        scode = self.CONFIG.FIELD_CUSTOM_VARS_SCODE
+        dcode = self.CONFIG.FIELD_CUSTOM_VARS_DCODE
+        when = self.CONFIG.FIELD_STORE_TIME
+        select = 'SELECT %s , YEAR(%s) , MONTH(%s) , %s FROM %s'%(
+                        scode, when, when, dcode, table)
+        where = " WHERE %s IN ('%s', '%s')"%(dcode, self.DCODE_VIEW, self.DCODE_DOWN)
+        return '%s%s'%(select, where)
+
+    def scan(self, hitters=None, capacity=1000):
+        '''Stream every event into hitters, returning them.'''
+        if hitters is None:
+            hitters = HeavyHitters(capacity)
+        start = time.time()
+        for scode, year, month, dcode in self.CONNECTION.stream(self.sql_events()):
+            what = WHATS[0] if dcode == self.DCODE_VIEW else WHATS[1]
+            hitters.add(scode, what, year, month)
+        taken = max(time.time()-start, 0.001)
+        logging.info('Scanned %s events in %.1f seconds, %.0f rows/s'%(
+                        hitters.ROWS, taken, hitters.ROWS/taken))
+        return hitters
+
+if __name__ == '__main__':
+    '''Do nothing unless enabled.'''
+    scan = False
+    write = False # the top 100 viewed of the latest year as a sample
+    if scan:
+        logging.basicConfig(level=logging.INFO)
+        h = HitterBuilder()
+        hitters = h.scan()
+        for what in WHATS:
+            print 'Most %s in %s'%(what, hitters.latest_year(what))
+            print hitters.result(what)
+        if write:
+            print hitters.write_batch()
@@ -0,0 +1,264 @@
+'''Cumulative daily view and download counts answering any date range.'''
+import datetime
+import logging
+import os
+import time
+
+import numpy
+
+import timecache
+
+# Layout of the sums (a .npy file, memory mapped when read):
+#   for each scode in index order, for each day from the first day less
+#   one: total views and downloads up to and including that day
+# so the counts of days a to b are sums[b-first+1] less sums[a-first].
+# The sorted scodes and first day are kept alongside, see index_name.
+PREFIX_FILE = 'daily_events.npy'
+SUM_TYPE = numpy.uint32
+ACADEMIC_START = 8 # academic years start in August
+WINDOWS = ('last5years', 'last12months', 'ac1year', '24months')
+
+def day_number(year, month, day=1):
+    '''Return a number for the day that can be used to count days.'''
+    return datetime.date(int(year), int(month), int(day)).toordinal()
+
+def day_name(number):
+    '''Return the date for a day number.'''
+    return datetime.date.fromordinal(number)
+
+def parse_day(text):
+    '''Return the day number of a date like 2012-08-01.'''
+    return day_number(*text.split('-'))
+
+def academic_year(year):
+    '''Return the first and last day of the academic year starting in year.'''
+    return day_number(year, ACADEMIC_START), day_number(year+1, ACADEMIC_START)-1
+
+def window(query, today=None):
+    '''Return the first and last day of a query MultipleRequest uses.'''
+    if not today:
+        today = datetime.date.today()
+    end = today.toordinal()
+    last_academic = today.year - 1 # the last academic year to have ended
+    if today.month < ACADEMIC_START:
+        last_academic -= 1
+    if query == 'last5years':
+        return day_number(today.year-4, 1), end
+    if query == 'last12months':
+        month = timecache.month_number(today.year, today.month) - 11
+        return day_number(*timecache.month_name(month)), end
+    if query == 'ac1year':
+        return academic_year(last_academic)
+    if query == '24months':
+        return academic_year(last_academic-1)[0], academic_year(last_academic)[1]
+    raise ValueError('Unknown window: %s'%query)
+
+def index_name(fname):
+    '''Return the file the scodes and first day of the sums in fname are in.'''
+    return '%s.index.npz'%os.path.splitext(fname)[0]
+
+def read_batch(fname):
+    '''Return the scodes in a batch file, see times/batches.'''
+    with file(fname) as infile:
+        return [line.strip() for line in infile if line.strip()]
+
+def write_prefixes(fname, counts):
+    '''Write counts {scode: {day number: [views, downloads]}} to fname.
+
+    The sums are written a scode at a time to a file alongside, then the
+    index and sums are renamed into place.
+    '''
+    days = [day for scode in counts for day in counts[scode]]
+    first = min(days) if days else 0
+    total = (max(days) - first + 1) if days else 0
+    codes = sorted(counts)
+    width = max([len(scode) for scode in codes] or [1])
+    tmpname = '%s.tmp'%fname
+    sums = numpy.lib.format.open_memmap(tmpname, 'w+', SUM_TYPE,
+                                        (len(codes), total+1, 2))
+    row = numpy.zeros((total+1, 2), SUM_TYPE)
+    for position, scode in enumerate(codes):
+        row[:] = 0
+        for day, pair in counts[scode].iteritems():
+            row[day-first+1] = pair
+        sums[position] = numpy.cumsum(row, axis=0)
+    sums.flush()
+    del sums
+    tmpindex = '%s.tmp'%index_name(fname)
+    with file(tmpindex, 'wb') as outfile:
+        numpy.savez(outfile, codes=numpy.array(codes, 'S%s'%width),
+                    first=numpy.array(first))
+    os.rename(tmpindex, index_name(fname))
+    os.rename(tmpname, fname)
+    logging.info('Sums of %s codes over %s days: %s'%(len(codes), total, fname))
+
+class PrefixSums(object):
+    '''Read only view of the sums, any range of days takes two lookups.'''
+    def __init__(self, fname=PREFIX_FILE):
+        self.FNAME = fname
+        self.CODES = None # sorted scodes
+        self.FIRST_DAY = 0
+        self.DAYS = 0
+        self.SUMS = None
+        self.open()
+
+    def open(self):
+        '''Read the index and map the sums into memory.'''
+        index = numpy.load(index_name(self.FNAME))
+        try:
+            self.CODES = index['codes']
+            self.FIRST_DAY = int(index['first'])
+        finally:
+            index.close()
+        self.SUMS = numpy.load(self.FNAME, mmap_mode='r')
+        self.DAYS = self.SUMS.shape[1] - 1
+        if len(self.SUMS) != len(self.CODES):
+            raise ValueError('Index does not match sums: %s'%self.FNAME)
+
+    def close(self):
+        self.SUMS = None # the map is closed when no longer used
+
+    def find(self, scode):
+        '''Return the position of scode in the index or -1.'''
+        position = numpy.searchsorted(self.CODES, scode)
+        if position < len(self.CODES) and self.CODES[position] == scode:
+            return int(position)
+        return -1
+
+    def bounds(self, start=None, end=None):
+        '''Return the places in the sums of days start to end, inclusive.
+
+        Start and end are day numbers (see day_number), or arrays of them.
+        Days outside the sums count nothing.
+        '''
+        if start is None:
+            start = self.FIRST_DAY
+        if end is None:
+            end = self.FIRST_DAY + self.DAYS - 1
+        low = numpy.clip(numpy.asarray(start) - self.FIRST_DAY, 0, self.DAYS)
+        high = numpy.clip(numpy.asarray(end) - self.FIRST_DAY + 1, 0, self.DAYS)
+        return low, numpy.maximum(low, high)
+
+    def totals(self, scode, start=None, end=None):
+        '''Return the total views and downloads of scode over the days.'''
+        position = self.find(scode)
+        if position < 0:
+            return 0, 0
+        low, high = self.bounds(start, end)
+        views, downloads = self.SUMS[position, high] - self.SUMS[position, low]
+        return int(views), int(downloads)
+
+    def positions(self, scodes):
+        '''Return the position of each scode and whether it is known.'''
+        scodes = numpy.asarray(scodes)
+        if not len(self.CODES):
+            return numpy.zeros(len(scodes), int), numpy.zeros(len(scodes), bool)
+        positions = numpy.searchsorted(self.CODES, scodes)
+        positions = numpy.minimum(positions, len(self.CODES)-1)
+        return positions, self.CODES[positions] == scodes
+
+    def totals_many(self, scodes, start=None, end=None):
+        '''Return arrays of the views and downloads of each scode.
+
+        Start and end can also be arrays, giving each scode its own days.
+        '''
+        positions, known = self.positions(scodes)
+        if not len(self.CODES):
+            none = numpy.zeros(len(positions), numpy.int64)
+            return none, none.copy()
+        low, high = self.bounds(start, end)
+        found = (self.SUMS[positions, high].astype(numpy.int64) -
+                 self.SUMS[positions, low])
+        found[~known] = 0
+        return found[:, 0], found[:, 1]
+
+    def batch_totals(self, fname, start=None, end=None):
+        '''Return the scodes of a batch file and arrays of their totals.'''
+        scodes = read_batch(fname)
+        views, downloads = self.totals_many(scodes, start, end)
+        return scodes, views, downloads
+
+    def monthly(self, scode, start=None, end=None):
+        '''Return (year, month, views, downloads) for each month of scode.
+
+        Start and end are month numbers (see timecache.month_number), as
+        TimeCache.monthly takes.
+        '''
+        if self.find(scode) < 0 or not self.DAYS:
+            return list()
+        first = day_name(self.FIRST_DAY)
+        last = day_name(self.FIRST_DAY + self.DAYS - 1)
+        months = range(timecache.month_number(first.year, first.month),
+                       timecache.month_number(last.year, last.month)+1)
+        if start is not None:
+            months = [month for month in months if month >= start]
+        if end is not None:
+            months = [month for month in months if month <= end]
+        if not months:
+            return list()
+        starts = [day_number(*timecache.month_name(month)) for month in months]
+        ends = [day_number(*timecache.month_name(month+1))-1 for month in months]
+        views, downloads = self.totals_many([scode]*len(months), starts, ends)
+        return [timecache.month_name(month) + (int(v), int(d))
+                for month, v, d in zip(months, views, downloads)]
+
+    def __len__(self):
+        return len(self.CODES)
+
+class PrefixBuilder(timecache.CacheBuilder):
+    '''Build the sums from the custom variables Populate has set.'''
+    def sql_daily_counts(self):
+        '''Return SQL counting views and downloads by scode and day.'''
+        table = self.CONFIG.TABLE_CUSTOM_VARS_STORE
+        scode = self.CONFIG.FIELD_CUSTOM_VARS_SCODE
+        dcode = self.CONFIG.FIELD_CUSTOM_VARS_DCODE
+        when = self.CONFIG.FIELD_STORE_TIME
+        select = 'SELECT %s , DATE(%s) , %s , COUNT(*) FROM %s'%(
+                        scode, when, dcode, table)
+        where = " WHERE %s IN ('%s', '%s')"%(dcode, self.DCODE_VIEW, self.DCODE_DOWN)
+        group = ' GROUP BY %s , DATE(%s) , %s'%(scode, when, dcode)
+        return '%s%s%s'%(select, where, group)
+
+    def add_counts(self, counts, rows):
+        '''Add rows of (scode, date, dcode, count) to counts.'''
+        for scode, day, dcode, number in rows:
+            days = counts.setdefault(scode, dict())
+            pair = days.setdefault(day.toordinal(), [0, 0])
+            if dcode == self.DCODE_VIEW:
+                pair[0] += int(number)
+            else:
+                pair[1] += int(number)
+        return counts
+
+    def build(self, fname=PREFIX_FILE):
+        '''Build the sums from all populated data.'''
+        start = time.time()
+        rows = self.CONNECTION.fetchall(self.sql_daily_counts())
+        counts = self.add_counts(dict(), rows)
+        write_prefixes(fname, counts)
+        logging.info('Sums built in %.1f seconds'%(time.time()-start))
+        return len(counts)
+
+if __name__ == '__main__':
+    '''Do nothing unless enabled.'''
+    build = False
+    testing = False
+    if build:
+        logging.basicConfig(level=logging.INFO)
+        p = PrefixBuilder()
+        p.build()
+    if testing:
+        ps = PrefixSums()
+        print 'Codes in sums: %s'%len(ps)
+        scode = 'uuid:15b86a5d-21f4-44a3-95bb-b8543d326658'
+        for query in WINDOWS:
+            first, last = window(query, datetime.date(2013, 9, 1))
+            start = time.time()
+            views, downloads = ps.totals(scode, first, last)
+            print '%s\t%s to %s\t%s\t%s\t%.6f seconds'%(query, day_name(first),
+                            day_name(last), views, downloads, time.time()-start)
+        batch = os.path.join('..', 'times', 'batches', '5_econ5394.csv')
+        start = time.time()
+        scodes, views, downloads = ps.batch_totals(batch, *academic_year(2012))
+        print 'Batch of %s in %.6f seconds, views %s, downloads %s'%(
+                        len(scodes), time.time()-start, views.sum(), downloads.sum())
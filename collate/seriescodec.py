@@ -0,0 +1,316 @@
+'''Compact monthly count series, coded as deltas in variable length bytes.'''
+import logging
+import mmap
+import os
+import random
+import struct
+import time
+
+import timecache
+
+# Layout of a compact cache file (all little-endian):
+#   header, see HEADER, as the time cache has plus the months in a block
+#   index of scodes, sorted, each padded with nulls to the code width
+#   offsets, for each scode and one more: where its series starts
+#   series, for each scode in index order:
+#       skip index, the length in bytes of each block, 0 if all zeros
+#       blocks of BLOCK_MONTHS months, see encode_block
+# Lengths and counts are varints: 7 bits a byte, low bits first, the
+# top bit set on every byte but the last.
+MAGIC = 'STCACHE2'
+# magic, first month, months, codes, width, watermark key and time, block
+HEADER = struct.Struct('<8sIIIIQQI')
+OFFSETS = struct.Struct('<II') # start of a series and of the next one
+OFFSET_SIZE = 4
+BLOCK_MONTHS = 12
+COMPACT_FILE = 'monthly_events.compact'
+BENCHMARK_HEADER = 'Layout\tBytes\tPerCode\tSeriesUs\tYearUs'
+
+def zigzag(value):
+    '''Return value with the sign moved to the lowest bit, so small
+    negative numbers stay small.'''
+    if value < 0:
+        return (-value << 1) - 1
+    return value << 1
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+def encode_varints(values):
+    '''Return the values, none negative, as varints.'''
+    answer = bytearray()
+    for value in values:
+        while value > 0x7f:
+            answer.append(0x80 | (value & 0x7f))
+            value >>= 7
+        answer.append(value)
+    return answer
+
+def decode_varints(data):
+    '''Return the values of varints in data, a bytearray.'''
+    if max(data) < 0x80: # every value fits in a byte, as most do
+        return list(data)
+    values = list()
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+def encode_block(row):
+    '''Return the varints of a block of interleaved views and downloads,
+    each less the one of the month before, or None if all are zero.'''
+    if not any(row):
+        return None
+    deltas = list()
+    views = downloads = 0
+    for place in range(0, len(row), 2):
+        deltas.append(zigzag(row[place] - views))
+        deltas.append(zigzag(row[place+1] - downloads))
+        views, downloads = row[place], row[place+1]
+    return encode_varints(deltas)
+
+def decode_block(data, size):
+    '''Return size interleaved views and downloads from a block.'''
+    if not data:
+        return [0]*size
+    values = decode_varints(data)
+    views = downloads = 0
+    for place in range(0, size, 2):
+        views += unzigzag(values[place])
+        downloads += unzigzag(values[place+1])
+        values[place] = views
+        values[place+1] = downloads
+    return values
+
+def encode_series(row, block=BLOCK_MONTHS):
+    '''Return the skip index and blocks of a row, see TimeCache.row.'''
+    blocks = list()
+    for start in range(0, len(row), block*2):
+        blocks.append(encode_block(row[start:start+block*2]) or bytearray())
+    answer = encode_varints([len(data) for data in blocks])
+    for data in blocks:
+        answer += data
+    return answer
+
+def decode_series(data, months, block=BLOCK_MONTHS, low=0, high=None):
+    '''Return interleaved views and downloads of months low to high (not
+    included) from a series, decoding only the blocks they are in.'''
+    if high is None:
+        high = months
+    count = (months + block - 1)//block
+    lengths = list()
+    place = value = shift = 0
+    while len(lengths) < count: # the skip index
+        byte = data[place]
+        place += 1
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            lengths.append(value)
+            value = shift = 0
+    first = low//block
+    last = (max(high, low+1) - 1)//block
+    start = place + sum(lengths[:first])
+    values = list()
+    for number in range(first, last+1):
+        end = start + lengths[number]
+        size = (min(months, (number+1)*block) - number*block)*2
+        values += decode_block(data[start:end], size)
+        start = end
+    skip = (low - first*block)*2
+    return values[skip:skip+(high-low)*2]
+
+def write_compact(fname, counts, watermark=(0, 0), first=None, total=None,
+                  block=BLOCK_MONTHS):
+    '''Write counts {scode: {month number: [views, downloads]}} to fname
+    as write_cache does, with each series coded by encode_series.'''
+    months = [m for scode in counts for m in counts[scode]]
+    if first is None:
+        first = min(months) if months else 0
+    if total is None:
+        total = (max(months) - first + 1) if months else 0
+    codes = sorted(counts)
+    width = max([len(scode) for scode in codes] or [0])
+    index_size = HEADER.size + len(codes)*width
+    series_start = index_size + (len(codes)+1)*OFFSET_SIZE
+    offsets = [series_start]
+    tmpname = '%s.tmp'%fname
+    with file(tmpname, 'wb') as outfile:
+        outfile.seek(series_start)
+        for scode in codes:
+            row = [0]*(total*2)
+            for month, (views, downloads) in counts[scode].iteritems():
+                row[(month-first)*2] = views
+                row[(month-first)*2+1] = downloads
+            data = encode_series(row, block)
+            outfile.write(data)
+            offsets.append(offsets[-1] + len(data))
+        outfile.seek(0)
+        outfile.write(HEADER.pack(MAGIC, first, total, len(codes), width,
+                                  watermark[0], watermark[1], block))
+        for scode in codes:
+            outfile.write(scode.ljust(width, '\0'))
+        outfile.write(struct.pack('<%sI'%len(offsets), *offsets))
+    os.rename(tmpname, fname)
+    logging.info('Compact cache of %s codes over %s months: %s'%(len(codes),
+                 total, fname))
+
+def compact_cache(source=timecache.CACHE_FILE, fname=COMPACT_FILE):
+    '''Write a compact copy of the time cache in source.'''
+    cache = timecache.TimeCache(source)
+    try:
+        write_compact(fname, cache.read_counts(), (cache.WATERMARK_KEY,
+                      cache.WATERMARK_TIME), cache.FIRST_MONTH, cache.MONTHS)
+    finally:
+        cache.close()
+
+def open_cache(fname):
+    '''Return a TimeCache or CompactCache for fname, by its magic.'''
+    with file(fname, 'rb') as infile:
+        magic = infile.read(len(MAGIC))
+    if magic == MAGIC:
+        return CompactCache(fname)
+    return timecache.TimeCache(fname)
+
+class CompactCache(timecache.TimeCache):
+    '''Read only view of a compact cache file, opened using mmap.'''
+    def __init__(self, fname=COMPACT_FILE):
+        self.BLOCK_MONTHS = BLOCK_MONTHS
+        self.OFFSETS_START = 0
+        timecache.TimeCache.__init__(self, fname)
+
+    def open(self):
+        '''Map the cache file into memory.'''
+        with file(self.FNAME, 'rb') as infile:
+            self.MAP = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self.MAP, 0)
+        if header[0] != MAGIC:
+            raise ValueError('Not a compact cache file: %s'%self.FNAME)
+        unused, first, months, codes, width, key, when, block = header
+        self.FIRST_MONTH = first
+        self.MONTHS = months
+        self.CODES = codes
+        self.WIDTH = width
+        self.WATERMARK_KEY = key
+        self.WATERMARK_TIME = when
+        self.BLOCK_MONTHS = block
+        self.INDEX_START = HEADER.size
+        self.OFFSETS_START = self.INDEX_START + codes*width
+
+    def series(self, position):
+        '''Return the coded series of the scode at position.'''
+        start, end = OFFSETS.unpack_from(self.MAP,
+                                         self.OFFSETS_START + position*OFFSET_SIZE)
+        return bytearray(self.MAP[start:end])
+
+    def row(self, position):
+        '''Return views and downloads for each month of the scode at position.'''
+        return decode_series(self.series(position), self.MONTHS,
+                             self.BLOCK_MONTHS)
+
+    def monthly(self, scode, start=None, end=None):
+        '''Return (year, month, views, downloads) for each month of scode,
+        decoding only the blocks the months are in.'''
+        position = self.find(scode)
+        if position < 0:
+            return list()
+        months = self.months(start, end)
+        if not months:
+            return list()
+        low = months[0] - self.FIRST_MONTH
+        values = decode_series(self.series(position), self.MONTHS,
+                               self.BLOCK_MONTHS, low, low+len(months))
+        answer = list()
+        for place, month in enumerate(months):
+            year, number = timecache.month_name(month)
+            answer.append((year, number, values[place*2], values[place*2+1]))
+        return answer
+
+def synthetic_counts(codes=10000, months=120, seed=1):
+    '''Return counts as the time cache keeps them, mostly small and zero,
+    with objects added over time and a few used far more than most.'''
+    chance = random.Random(seed)
+    first = timecache.month_number(2004, 1)
+    counts = dict()
+    for number in range(codes):
+        scode = 'uuid:%08x-0000-0000-0000-%012x'%(number, number)
+        added = chance.randrange(months)
+        scale = chance.paretovariate(1.5)
+        series = dict()
+        for month in range(added, months):
+            views = int(chance.expovariate(1.0/scale)*2)
+            downloads = int(views*chance.random()*0.3)
+            if views or downloads:
+                series[first+month] = [views, downloads]
+        counts[scode] = series
+    return counts
+
+def time_lookups(cache, scodes, last_year):
+    '''Return microseconds to get a whole series and the last year of it.'''
+    start = time.time()
+    for scode in scodes:
+        cache.counts(scode)
+    series = (time.time()-start)*1000000/len(scodes)
+    start = time.time()
+    for scode in scodes:
+        cache.monthly(scode, last_year)
+    year = (time.time()-start)*1000000/len(scodes)
+    return series, year
+
+def benchmark(counts, directory='.', lookups=2000, seed=1):
+    '''Return a table of the size and lookup times of both layouts.'''
+    raw = os.path.join(directory, 'benchmark.cache')
+    compact = os.path.join(directory, 'benchmark.compact')
+    timecache.write_cache(raw, counts)
+    write_compact(compact, counts)
+    scodes = random.Random(seed).sample(sorted(counts), min(lookups, len(counts)))
+    answer = [BENCHMARK_HEADER]
+    for name, cache in (('raw', timecache.TimeCache(raw)),
+                        ('compact', CompactCache(compact))):
+        size = os.path.getsize(cache.FNAME)
+        last_year = cache.FIRST_MONTH + cache.MONTHS - 12
+        series, year = time_lookups(cache, scodes, last_year)
+        answer.append('%s\t%s\t%.1f\t%.1f\t%.1f'%(name, size,
+                      float(size)/max(1, len(cache)), series, year))
+        cache.close()
+        os.remove(cache.FNAME)
+    return '\n'.join(answer)
+
+def command_line():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('-c', help='Time cache to write a compact copy of',
+                      dest='source', default=None)
+    parser.add_option('-o', help='Compact cache file to write', dest='fname',
+                      default=COMPACT_FILE)
+    parser.add_option('-b', help='Compare sizes and lookup times of the layouts',
+                      dest='benchmark', default=False, action="store_true")
+    parser.add_option('-n', help='Codes in the benchmark, made up unless -c '
+                      'is given', dest='codes', default=10000, type='int')
+    parser.add_option('-m', help='Months of made up counts', dest='months',
+                      default=120, type='int')
+    parser.add_option('-v', help='Enables info logging', dest='info',
+                      default=False, action="store_true")
+    (options, unused) = parser.parse_args()
+    if options.info:
+        logging.basicConfig(level=logging.INFO)
+    return options
+
+if __name__ == '__main__':
+    options = command_line()
+    if options.source and not options.benchmark:
+        compact_cache(options.source, options.fname)
+    if options.benchmark:
+        if options.source:
+            cache = timecache.TimeCache(options.source)
+            counts = cache.read_counts()
+            cache.close()
+        else:
+            counts = synthetic_counts(options.codes, options.months)
+        print benchmark(counts)
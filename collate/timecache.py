@@ -0,0 +1,322 @@
+'''Cache of monthly view and download counts read optimised for time.'''
+import logging
+import mmap
+import os
+import struct
+import time
+
+import dbsources
+import dbengine
+
+# Layout of a cache file (all little-endian):
+#   header, see HEADER, including the high-water mark of the data used
+#   index of scodes, sorted, each padded with nulls to the code width
+#   counts, for each scode in index order, for each month: views, downloads
+MAGIC = 'STCACHE3' # STCACHE1 files had no watermark, STCACHE2 see seriescodec
+# magic, first month, months, codes, width, watermark key and time
+HEADER = struct.Struct('<8sIIIIQQ')
+CACHE_FILE = 'monthly_events.cache'
+
+def month_number(year, month):
+    '''Return a number for the month that can be used to count months.'''
+    return int(year)*12 + int(month) - 1
+
+def month_name(number):
+    '''Return the year and month for a month number.'''
+    return number//12, number%12 + 1
+
+def write_cache(fname, counts, watermark=(0, 0)):
+    '''Write counts {scode: {month number: [views, downloads]}} to fname.
+
+    The watermark is the key and time (seconds since the epoch) of the
+    last row counted. The file is written alongside and renamed into
+    place, so readers never see a half written cache.
+    '''
+    months = [m for scode in counts for m in counts[scode]]
+    first = min(months) if months else 0
+    total = (max(months) - first + 1) if months else 0
+    codes = sorted(counts)
+    width = max([len(scode) for scode in codes] or [0])
+    block = struct.Struct('<%sI'%(total*2))
+    tmpname = '%s.tmp'%fname
+    with file(tmpname, 'wb') as outfile:
+        outfile.write(HEADER.pack(MAGIC, first, total, len(codes), width,
+                                  watermark[0], watermark[1]))
+        for scode in codes:
+            outfile.write(scode.ljust(width, '\0'))
+        for scode in codes:
+            row = [0]*(total*2)
+            for month, (views, downloads) in counts[scode].iteritems():
+                row[(month-first)*2] = views
+                row[(month-first)*2+1] = downloads
+            outfile.write(block.pack(*row))
+    os.rename(tmpname, fname)
+    logging.info('Cache of %s codes over %s months: %s'%(len(codes), total, fname))
+
+class TimeCache(object):
+    '''Read only view of a cache file, opened using mmap.'''
+    def __init__(self, fname=CACHE_FILE):
+        self.FNAME = fname
+        self.MAP = None
+        self.FIRST_MONTH = 0
+        self.MONTHS = 0
+        self.CODES = 0
+        self.WIDTH = 0
+        self.WATERMARK_KEY = 0 # last row of the data counted
+        self.WATERMARK_TIME = 0
+        self.INDEX_START = HEADER.size
+        self.COUNTS_START = 0
+        self.BLOCK = None # unpacks the counts for one scode
+        self.open()
+
+    def open(self):
+        '''Map the cache file into memory.'''
+        with file(self.FNAME, 'rb') as infile:
+            self.MAP = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self.MAP, 0)
+        if header[0] != MAGIC:
+            raise ValueError('Not a cache file: %s'%self.FNAME)
+        unused, first, months, codes, width, key, when = header
+        self.FIRST_MONTH = first
+        self.MONTHS = months
+        self.CODES = codes
+        self.WIDTH = width
+        self.WATERMARK_KEY = key
+        self.WATERMARK_TIME = when
+        self.COUNTS_START = self.INDEX_START + codes*width
+        self.BLOCK = struct.Struct('<%sI'%(months*2))
+
+    def close(self):
+        if self.MAP:
+            self.MAP.close()
+            self.MAP = None
+
+    def code(self, position):
+        '''Return the scode at position in the index.'''
+        start = self.INDEX_START + position*self.WIDTH
+        return self.MAP[start:start+self.WIDTH].rstrip('\0')
+
+    def find(self, scode):
+        '''Return the position of scode in the index or -1.'''
+        low, high = 0, self.CODES
+        while low < high:
+            middle = (low+high)//2
+            if self.code(middle) < scode:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.CODES and self.code(low) == scode:
+            return low
+        return -1
+
+    def row(self, position):
+        '''Return views and downloads for each month of the scode at position.'''
+        offset = self.COUNTS_START + position*self.BLOCK.size
+        return self.BLOCK.unpack_from(self.MAP, offset)
+
+    def counts(self, scode):
+        '''Return views and downloads for each month, or None if unknown.'''
+        position = self.find(scode)
+        if position < 0:
+            return None
+        return self.row(position)
+
+    def months(self, start=None, end=None):
+        '''Return the month numbers of the cache between start and end.'''
+        first = self.FIRST_MONTH
+        last = first + self.MONTHS - 1
+        if start is not None:
+            first = max(first, start)
+        if end is not None:
+            last = min(last, end)
+        return range(first, last+1)
+
+    def monthly(self, scode, start=None, end=None):
+        '''Return (year, month, views, downloads) for each month of scode.
+
+        Start and end are month numbers (see month_number) and inclusive.
+        '''
+        counts = self.counts(scode)
+        if counts is None:
+            return list()
+        answer = list()
+        for month in self.months(start, end):
+            place = (month-self.FIRST_MONTH)*2
+            year, number = month_name(month)
+            answer.append((year, number, counts[place], counts[place+1]))
+        return answer
+
+    def totals(self, scode, start=None, end=None):
+        '''Return the total views and downloads for scode.'''
+        views = 0
+        downloads = 0
+        for unused, unused, v, d in self.monthly(scode, start, end):
+            views += v
+            downloads += d
+        return views, downloads
+
+    def read_counts(self):
+        '''Return all the counts in the form write_cache uses.'''
+        counts = dict()
+        for position in range(self.CODES):
+            row = self.row(position)
+            months = dict()
+            for place in range(self.MONTHS):
+                views, downloads = row[place*2], row[place*2+1]
+                if views or downloads:
+                    months[self.FIRST_MONTH+place] = [views, downloads]
+            counts[self.code(position)] = months
+        return counts
+
+    def __len__(self):
+        return self.CODES
+
+class CacheBuilder(object):
+    '''Build the cache from the custom variables Populate has set.'''
+    def __init__(self):
+        self.CONFIG = None # tables and fields to use
+        self.CONNECTION = None # in this location
+        self.DCODE_VIEW = 'v' # must match those used by Populate
+        self.DCODE_DOWN = 'd'
+        self.setup()
+
+    def setup(self):
+        '''Setup the connection to the system the cache is built from.'''
+        source = dbsources.ReadWriteDB()
+        source.setup_source1()
+        host, username, password, database = source.get_settings()
+        self.CONFIG = dbengine.PiwikConfig()
+        self.CONNECTION = dbengine.Connection()
+        self.CONNECTION.setup(host, username, password, database)
+
+    def sql_monthly_counts(self):
+        '''Return SQL counting views and downloads by scode and month.'''
+        table = self.CONFIG.TABLE_CUSTOM_VARS_STORE
+        scode = self.CONFIG.FIELD_CUSTOM_VARS_SCODE
+        dcode = self.CONFIG.FIELD_CUSTOM_VARS_DCODE
+        when = self.CONFIG.FIELD_STORE_TIME
+        select = 'SELECT %s , YEAR(%s) , MONTH(%s) , %s , COUNT(*) FROM %s'%(
+                        scode, when, when, dcode, table)
+        where = " WHERE %s IN ('%s', '%s')"%(dcode, self.DCODE_VIEW, self.DCODE_DOWN)
+        group = ' GROUP BY %s , YEAR(%s) , MONTH(%s) , %s'%(scode, when, when, dcode)
+        return '%s%s%s'%(select, where, group)
+
+    def add_counts(self, counts, rows):
+        '''Add rows of (scode, year, month, dcode, count) to counts.'''
+        for scode, year, month, dcode, number in rows:
+            months = counts.setdefault(scode, dict())
+            pair = months.setdefault(month_number(year, month), [0, 0])
+            if dcode == self.DCODE_VIEW:
+                pair[0] += int(number)
+            else:
+                pair[1] += int(number)
+        return counts
+
+    def sql_upper_bound(self, low):
+        '''Return SQL to find the first row after low not yet populated.'''
+        table, key = self.CONFIG.get_update_store_config()
+        dcode = self.CONFIG.FIELD_CUSTOM_VARS_DCODE
+        return 'SELECT MIN(%s) FROM %s WHERE %s > %s AND %s IS NULL'%(
+                        key, table, key, low, dcode)
+
+    def sql_last_row(self, low, high=None):
+        '''Return SQL to find the key and time of the last row in a range.'''
+        table, key = self.CONFIG.get_update_store_config()
+        when = self.CONFIG.FIELD_STORE_TIME
+        select = 'SELECT MAX(%s) , UNIX_TIMESTAMP(MAX(%s)) FROM %s'%(key, when, table)
+        where = ' WHERE %s > %s'%(key, low)
+        if high is not None:
+            where += ' AND %s < %s'%(key, high)
+        return '%s%s'%(select, where)
+
+    def sql_new_counts(self, low, high):
+        '''Return SQL counting views and downloads in a range of keys.'''
+        key = self.CONFIG.FIELD_STORE_KEY
+        query = self.sql_monthly_counts()
+        where = ' WHERE %s > %s AND %s <= %s AND'%(key, low, key, high)
+        return query.replace(' WHERE', where, 1)
+
+    def last_row(self, low):
+        '''Return the key and time of the last row after low that can be
+        counted, ie. before the first one not yet populated, or None.'''
+        bound = self.CONNECTION.fetchone(self.sql_upper_bound(low))
+        if bound and bound[0] is not None:
+            last = self.CONNECTION.fetchone(self.sql_last_row(low, bound[0]))
+        else: # everything has been populated
+            last = self.CONNECTION.fetchone(self.sql_last_row(low))
+        if not last or last[0] is None or int(last[0]) <= low:
+            return None
+        return int(last[0]), int(last[1] or 0)
+
+    def build(self, fname=CACHE_FILE):
+        '''Build the cache file from all populated data.
+
+        Rows are counted up to the same watermark update uses, so the
+        next update carries on from where the build stopped.
+        '''
+        start = time.time()
+        counts = dict()
+        last = self.last_row(0)
+        if last:
+            rows = self.CONNECTION.fetchall(self.sql_new_counts(0, last[0]))
+            self.add_counts(counts, rows)
+        write_cache(fname, counts, last or (0, 0))
+        logging.info('Cache built in %.1f seconds'%(time.time()-start))
+        return len(counts)
+
+class CacheUpdater(CacheBuilder):
+    '''Fold rows newer than the cache watermark into the cache.
+
+    Only rows up to the first one Populate has not done yet are used,
+    so the watermark never passes rows that may still become views or
+    downloads. Suitable for running nightly from cron.
+    '''
+    def existing(self, fname):
+        '''Return the counts and watermark key of the cache in fname.'''
+        if not os.path.exists(fname):
+            return dict(), 0
+        cache = TimeCache(fname)
+        counts, key = cache.read_counts(), cache.WATERMARK_KEY
+        cache.close()
+        return counts, key
+
+    def update(self, fname=CACHE_FILE):
+        '''Update the cache with new rows, returning how many were added.'''
+        start = time.time()
+        counts, low = self.existing(fname)
+        last = self.last_row(low)
+        if not last:
+            logging.info('Cache is up to date at: %s'%low)
+            return 0
+        high, when = last
+        rows = self.CONNECTION.fetchall(self.sql_new_counts(low, high))
+        self.add_counts(counts, rows)
+        write_cache(fname, counts, (high, when))
+        added = sum([int(row[4]) for row in rows])
+        taken = max(time.time()-start, 0.001)
+        logging.info('Rows %s to %s added: %s in %.1f seconds, %.0f rows/s'%(
+                        low, high, added, taken, added/taken))
+        return added
+
+if __name__ == '__main__':
+    '''Do nothing unless enabled.'''
+    build = False
+    update = False # eg. nightly from cron
+    testing = False
+    if build:
+        logging.basicConfig(level=logging.INFO)
+        c = CacheBuilder()
+        c.build()
+    if update:
+        logging.basicConfig(level=logging.INFO)
+        c = CacheUpdater()
+        c.update()
+    if testing:
+        tc = TimeCache()
+        print 'Codes in cache: %s'%len(tc)
+        scode = 'uuid:15b86a5d-21f4-44a3-95bb-b8543d326658'
+        start = time.time()
+        monthly = tc.monthly(scode)
+        print 'Lookup took: %.6f seconds'%(time.time()-start)
+        for year, month, views, downloads in monthly:
+            print '%s-%02d\t%s\t%s'%(year, month, views, downloads)
@@ -0,0 +1,61 @@
+'''Monotonic high resolution clock for timing requests.'''
+import ctypes
+import ctypes.util
+import os
+import time
+
+CLOCK_MONOTONIC = 1 # from linux/time.h
+# Parts of a request timed separately: opening the connection, sending
+# the request, waiting for the first byte, reading the body, parsing it.
+PHASES = ('connect', 'write', 'ttfb', 'body', 'parse')
+PHASE_HEADER = 'Connect\tWrite\tTTFB\tBody\tParse'
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _find_clock_gettime():
+    '''Return clock_gettime from the C library, or None if missing.'''
+    for name in (ctypes.util.find_library('rt'), ctypes.util.find_library('c')):
+        if not name:
+            continue
+        try:
+            function = ctypes.CDLL(name, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        function.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        return function
+    return None
+
+_CLOCK_GETTIME = _find_clock_gettime()
+
+def monotonic():
+    '''Return seconds from a clock that never goes back.
+
+    Unlike time.time this is not changed when the system clock is set,
+    eg. by NTP, so is safe for measuring short times. Falls back to
+    time.time where clock_gettime can not be found.
+    '''
+    if _CLOCK_GETTIME is None:
+        return time.time()
+    now = timespec()
+    if _CLOCK_GETTIME(CLOCK_MONOTONIC, ctypes.byref(now)):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return now.tv_sec + now.tv_nsec*1e-9
+
+def no_phases():
+    '''Return phase times with nothing recorded yet.'''
+    return dict.fromkeys(PHASES, 0.0)
+
+def timed(phases):
+    '''Return True if phases show a request was timed, not only parsed.
+
+    Engines start each get with no_phases, so errors before a request
+    was sent, and answers not needing one, keep them all at nothing.
+    '''
+    return any([phases.get(phase) for phase in PHASES if phase != 'parse'])
+
+if __name__ == '__main__':
+    start = monotonic()
+    time.sleep(0.1)
+    print 'Slept for: %.6f seconds'%(monotonic()-start)
@@ -0,0 +1,234 @@
+'''Compare the times of two runs, item by item, to find regressions.'''
+import glob
+import logging
+import math
+import os
+import random
+import sys
+
+import samples # to know which results are errors
+
+COMPARE_HEADER = ('Pairs\tBeforeP50\tAfterP50\tDeltaP50\tCILow\tCIHigh\t'
+                  'DeltaP90\tDeltaP99\tMWU_p\tVerdict\tCompared')
+
+def percentile(values, percent):
+    '''Return the nearest rank percentile of sorted values.'''
+    if not values:
+        return 0.0
+    rank = max(1, int(math.ceil(len(values)*percent/100.0)))
+    return values[rank-1]
+
+def median(values):
+    return percentile(values, 50)
+
+def read_tsv(fname):
+    '''Return {item: time} from a sample report, see SampleSet.save.
+
+    Items whose result was an error are left out.
+    '''
+    times = dict()
+    with file(fname) as infile:
+        lines = infile.read().split('\n')
+    for line in lines[1:]: # skip the header
+        parts = line.split('\t')
+        if len(parts) < 3 or parts[2].startswith('Times, '):
+            break # the summary rows follow the items
+        result, took, item = parts[:3]
+        if str(result).startswith(samples.ERROR_MARKS):
+            continue
+        times[item] = float(took)
+    return times
+
+def is_sample_report(fname):
+    '''Return True if fname is a report of a sample, not a summary.'''
+    with file(fname) as infile:
+        return infile.readline().startswith('Result\tTime\tItem')
+
+def read_history(fname, engine):
+    '''Return {item: time} for an engine id in a history file.
+
+    Items whose result was an error are left out.
+    '''
+    import history
+    h = history.ResultsHistory(fname)
+    query = 'SELECT item, took FROM items WHERE engine_id = ? AND error = 0'
+    times = dict(h.CONNECTION.execute(query, (engine,)).fetchall())
+    h.close()
+    return times
+
+def mann_whitney(before, after):
+    '''Return the two sided p value of a Mann-Whitney U test.
+
+    Uses the normal approximation with a correction for ties, which is
+    fine for the sizes of sample the batches have.
+    '''
+    n1, n2 = len(before), len(after)
+    if not n1 or not n2:
+        return 1.0
+    combined = sorted([(value, 0) for value in before] + [(value, 1) for value in after])
+    ranks = [0.0]*len(combined)
+    ties = 0.0
+    start = 0
+    while start < len(combined):
+        end = start
+        while end+1 < len(combined) and combined[end+1][0] == combined[start][0]:
+            end += 1
+        for place in range(start, end+1):
+            ranks[place] = (start+end)/2.0 + 1
+        size = end-start+1
+        ties += size**3 - size
+        start = end+1
+    rank_sum = sum([rank for rank, (unused, group) in zip(ranks, combined) if not group])
+    u = rank_sum - n1*(n1+1)/2.0
+    mean = n1*n2/2.0
+    total = n1+n2
+    variance = n1*n2/12.0*((total+1) - ties/(total*(total-1) or 1))
+    if variance <= 0:
+        return 1.0
+    z = (abs(u-mean) - 0.5)/math.sqrt(variance)
+    return math.erfc(max(z, 0)/math.sqrt(2))
+
+class Comparison(object):
+    '''Times of the same items before and after a change.
+
+    Items are paired by scode. The change in median time has a bootstrap
+    confidence interval found by resampling the pairs, so it allows for
+    items being slower or faster than each other. A regression is a
+    median that is significantly slower by more than THRESHOLD.
+    '''
+    def __init__(self, before, after, name='', threshold=0.1, level=95,
+                 resamples=2000, seed=1):
+        self.NAME = name
+        self.THRESHOLD = threshold # relative slowdown allowed, eg. 0.1 is 10%
+        self.LEVEL = level # percent confidence of intervals
+        self.RESAMPLES = resamples
+        self.RANDOM = random.Random(seed) # so the same times give the same answer
+        self.ITEMS = sorted(set(before) & set(after))
+        self.BEFORE = [before[item] for item in self.ITEMS]
+        self.AFTER = [after[item] for item in self.ITEMS]
+        self.UNPAIRED = len(set(before) ^ set(after))
+
+    def delta(self, percent, indexes=None):
+        '''Return after less before at percent, over indexes of pairs.'''
+        if indexes is None:
+            indexes = range(len(self.ITEMS))
+        before = sorted([self.BEFORE[i] for i in indexes])
+        after = sorted([self.AFTER[i] for i in indexes])
+        return percentile(after, percent) - percentile(before, percent)
+
+    def interval(self, percent=50):
+        '''Return a bootstrap confidence interval of the delta at percent.'''
+        count = len(self.ITEMS)
+        if not count:
+            return 0.0, 0.0
+        deltas = list()
+        for unused in range(self.RESAMPLES):
+            indexes = [self.RANDOM.randrange(count) for unused in range(count)]
+            deltas.append(self.delta(percent, indexes))
+        deltas.sort()
+        tail = (100-self.LEVEL)/2.0
+        return percentile(deltas, tail), percentile(deltas, 100-tail)
+
+    def verdict(self, low, high, base):
+        '''Return slower, faster or same for a delta interval around base.'''
+        limit = base*self.THRESHOLD
+        if low > 0 and low >= limit:
+            return 'slower'
+        if high < 0 and -high >= limit:
+            return 'faster'
+        return 'same'
+
+    def row(self):
+        '''Return a row of the comparison table and its verdict.'''
+        base = median(sorted(self.BEFORE))
+        low, high = self.interval(50)
+        verdict = self.verdict(low, high, base)
+        values = (len(self.ITEMS), base, median(sorted(self.AFTER)),
+                  self.delta(50), low, high, self.delta(90), self.delta(99),
+                  mann_whitney(self.BEFORE, self.AFTER), verdict, self.NAME)
+        return '%s\t%.3f\t%.3f\t%+.3f\t%+.3f\t%+.3f\t%+.3f\t%+.3f\t%.4f\t%s\t%s'%values, verdict
+
+def pair_files(before, after):
+    '''Return (name, before file, after file) for reports in both.'''
+    if os.path.isfile(before) and os.path.isfile(after):
+        return [(os.path.basename(after), before, after)]
+    pairs = list()
+    for fname in sorted(glob.glob(os.path.join(before, '*.tsv'))):
+        name = os.path.basename(fname)
+        other = os.path.join(after, name)
+        if not os.path.exists(other) or not is_sample_report(fname):
+            continue
+        pairs.append((name, fname, other))
+    return pairs
+
+def compare(pairs, threshold=0.1, level=95, resamples=2000):
+    '''Return the comparison table and how many compared got slower.
+
+    Pairs are (name, before times, after times).
+    '''
+    answer = [COMPARE_HEADER]
+    slower = 0
+    for name, before, after in pairs:
+        comparison = Comparison(before, after, name, threshold, level, resamples)
+        if not comparison.ITEMS:
+            logging.warn('No items in both: %s'%name)
+            continue
+        row, verdict = comparison.row()
+        answer.append(row)
+        if verdict == 'slower':
+            slower += 1
+    return '\n'.join(answer), slower
+
+def command_line():
+    from optparse import OptionParser
+    usage = ('%prog [options] BEFORE AFTER\n\nBEFORE and AFTER are sample '
+             'reports (.tsv) or directories of them, paired by name.\nWith -H '
+             'they are engine ids, or give an engine name with -e.')
+    parser = OptionParser(usage)
+    parser.add_option('-t', help='Relative slowdown of the median to fail on',
+                      dest='threshold', default=0.1, type='float')
+    parser.add_option('-c', help='Percent confidence of intervals',
+                      dest='level', default=95, type='float')
+    parser.add_option('-b', help='Bootstrap resamples', dest='resamples',
+                      default=2000, type='int')
+    parser.add_option('-H', help='Compare engines in this history file',
+                      dest='history', default=None)
+    parser.add_option('-e', help='Compare the last two runs of this engine',
+                      dest='engine', default=None)
+    parser.add_option('-v', help='Enables info logging', dest='info',
+                      default=False, action="store_true")
+    (options, args) = parser.parse_args()
+    if options.info:
+        logging.basicConfig(level=logging.INFO)
+    if not options.engine and len(args) != 2:
+        parser.error('Give BEFORE and AFTER')
+    return options, args
+
+def history_pairs(fname, engine, args):
+    '''Return pairs to compare from the history file.'''
+    import history
+    if args:
+        return [('%s-%s'%tuple(args), read_history(fname, int(args[0])),
+                 read_history(fname, int(args[1])))]
+    h = history.ResultsHistory(fname)
+    query = 'SELECT id FROM engines WHERE name = ? ORDER BY started DESC LIMIT 2'
+    ids = [row[0] for row in h.CONNECTION.execute(query, (engine,))]
+    h.close()
+    if len(ids) < 2:
+        raise ValueError('Fewer than two runs of engine: %s'%engine)
+    return [(engine, read_history(fname, ids[1]), read_history(fname, ids[0]))]
+
+if __name__ == '__main__':
+    options, args = command_line()
+    if options.engine or options.history:
+        fname = options.history or os.path.join('reports', 'history.sqlite')
+        pairs = history_pairs(fname, options.engine, args)
+    else:
+        pairs = [(name, read_tsv(before), read_tsv(after))
+                 for name, before, after in pair_files(*args)]
+    table, slower = compare(pairs, options.threshold, options.level,
+                            options.resamples)
+    print table
+    if slower:
+        print 'Slower: %s of %s'%(slower, len(pairs))
+        sys.exit(1)
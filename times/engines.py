@@ -6,59 +6,682 @@ import httplib  # to fetch data
 #httplib.HTTPConnection.debuglevel = 1
 import urllib # so we can encode urls
 import json
+import copy # so engines can be cloned for workers
+import asyncore # to keep many requests in flight
+import collections
+import threading # connections are shared between threads
+import select # to check idle connections
+import os
+import cPickle # to keep cached responses between runs
 
 import samples # enable the running of samples
+import clock # to time the phases of requests
 import tokens # so calls to Piwik API will work
 
 class EngineError(Exception):
     pass
 
+class ConnectionPool(object):
+    '''Keep-alive HTTP connections shared by every Engine in a process.'''
+    def __init__(self, max_size=8, max_idle=5, timeout=10):
+        self.MAX_SIZE = max_size # idle connections kept for each host
+        self.MAX_IDLE = max_idle # seconds, servers drop idle connections
+        self.TIMEOUT = timeout
+        self.IDLE = dict() # host: list of (connection, time released)
+        self.COUNTS = dict() # host: counts of what happened to connections
+        self.LOCK = threading.Lock()
+        self.PID = os.getpid()
+        
+    def check_process(self):
+        '''Forget connections inherited from a parent process.'''
+        if self.PID != os.getpid():
+            self.IDLE = dict()
+            self.COUNTS = dict()
+            self.PID = os.getpid()
+            
+    def count(self, host, what):
+        counts = self.COUNTS.setdefault(host, dict.fromkeys(POOL_COUNTS, 0))
+        counts[what] += 1
+        
+    def acquire(self, host):
+        '''Return a connection to host and True if it is being reused.'''
+        with self.LOCK:
+            self.check_process()
+            idle = self.IDLE.get(host, [])
+            while idle:
+                connection, released = idle.pop()
+                if self.healthy(connection, released):
+                    self.count(host, 'reused')
+                    return connection, True
+                self.count(host, 'dropped')
+                connection.close()
+            self.count(host, 'new')
+        return httplib.HTTPConnection(host, timeout=self.TIMEOUT), False
+    
+    def healthy(self, connection, released):
+        '''Return True if an idle connection looks usable.'''
+        if not connection.sock:
+            return False
+        if time.time()-released > self.MAX_IDLE:
+            return False
+        try: # an idle connection is only readable if the server closed it
+            readable = select.select([connection.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+    
+    def release(self, host, connection):
+        '''Return a connection to the pool, closing it if not wanted.'''
+        with self.LOCK:
+            self.check_process()
+            idle = self.IDLE.setdefault(host, list())
+            if connection.sock and len(idle) < self.MAX_SIZE:
+                idle.append((connection, time.time()))
+                return
+        connection.close()
+        
+    def discard(self, host, connection):
+        '''Close a connection that failed.'''
+        with self.LOCK:
+            self.check_process()
+            self.count(host, 'failed')
+        connection.close()
+        
+    def stats(self, host):
+        '''Return counts of new, reused, dropped and failed connections.'''
+        with self.LOCK:
+            self.check_process()
+            return dict(self.COUNTS.get(host, dict.fromkeys(POOL_COUNTS, 0)))
+        
+    def report(self, host):
+        '''Return a line summarising connection use for host.'''
+        counts = self.stats(host)
+        parts = ['%s %s'%(what, counts[what]) for what in POOL_COUNTS]
+        return 'Connections to %s: %s'%(host, ', '.join(parts))
+    
+    def clear(self):
+        '''Close all idle connections.'''
+        with self.LOCK:
+            self.check_process()
+            idle, self.IDLE = self.IDLE, dict()
+        for host in idle:
+            for connection, unused in idle[host]:
+                connection.close()
+
+POOL_COUNTS = ('new', 'reused', 'dropped', 'failed')
+POOL = ConnectionPool() # used by all engines unless given another
+
+class Response(object):
+    '''A response that has been read, used like an httplib one.'''
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.HEADERS = headers # names are lower case
+        self.BODY = body
+        self.PHASES = dict() # seconds in each phase, see clock.PHASES
+        
+    def getheader(self, name, default=None):
+        return self.HEADERS.get(name.lower(), default)
+    
+    def read(self):
+        return self.BODY
+
 class Engine(object):
     '''Connection to an engine via an HTTP connection.'''
-    def __init__(self, host='orastats.bodleian.ox.ac.uk', persist=True):
+    def __init__(self, host='orastats.bodleian.ox.ac.uk', persist=True,
+                 pool=None):
         '''Connect to host with a persistent connection by default.'''
         self.HOST = host
         self.PERSIST = persist
+        self.POOL = pool or POOL # where connections are kept between gets
         self.CONNECTION = None # This does the fetching.
+        self.REUSED = False # if the connection was kept alive from before
+        self.PHASES = clock.no_phases() # seconds in each phase of last get
         self.HEADERS = {'User-agent' : 'ora_timestats'}
         if not persist: 
             self.HEADERS['Connection'] = 'close'
         
     def connect(self, host=None):
-        '''Start a HTTP connection to host or use engine default.'''
-        if not host:
-            host = self.HOST
-        if not self.CONNECTION:
-            self.CONNECTION = httplib.HTTPConnection(host, timeout=10)
-            logging.debug('New connection: %s'%host)
+        '''Get a HTTP connection to host or use engine default.
+        
+        Returns False if a new connection could not be opened.
+        '''
+        if host and host != self.HOST:
+            self.release()
+            self.HOST = host
+        if self.CONNECTION:
+            return True
+        self.CONNECTION, self.REUSED = self.POOL.acquire(self.HOST)
+        if self.REUSED:
+            return True
+        start = clock.monotonic()
+        try:
+            self.CONNECTION.connect()
+            logging.debug('New connection: %s'%self.HOST)
+            return True
+        except socket.error:
+            self.discard()
+            return False
+        finally:
+            self.PHASES['connect'] += clock.monotonic()-start
 
     def get(self, suburl):
-        '''Return response to a get request for suburl from the host.'''
-        if not self.CONNECTION:
-            self.connect()
-        try :
-            self.CONNECTION.request('GET', suburl, headers=self.HEADERS)
-            return self.CONNECTION.getresponse()
-        except (socket.error, httplib.CannotSendRequest, httplib.BadStatusLine):
-            raise EngineError
+        '''Return response to a get request for suburl from the host.
+        
+        The body is read so the connection can go back to the pool. A
+        kept alive connection the server has dropped is retried once.
+        The time spent in each phase is kept in PHASES of the response.
+        '''
+        self.PHASES = clock.no_phases()
+        while self.connect():
+            reused = self.REUSED
+            try :
+                start = clock.monotonic()
+                self.CONNECTION.request('GET', suburl, headers=self.HEADERS)
+                sent = clock.monotonic()
+                response = self.CONNECTION.getresponse() # status and headers
+                first = clock.monotonic()
+                body = response.read()
+                done = clock.monotonic()
+            except (socket.error, httplib.HTTPException):
+                self.discard()
+                if reused:
+                    continue
+                raise EngineError
+            self.release()
+            self.PHASES['write'] += sent-start
+            self.PHASES['ttfb'] += first-sent
+            self.PHASES['body'] += done-first
+            answer = Response(response.status, response.reason,
+                              dict(response.getheaders()), body)
+            answer.PHASES = dict(self.PHASES)
+            return answer
+        raise EngineError
+    
+    def release(self):
+        '''Give the connection back to the pool.'''
+        if self.CONNECTION:
+            self.POOL.release(self.HOST, self.CONNECTION)
+            self.CONNECTION = None
+            
+    def discard(self):
+        '''Drop a connection that has failed.'''
+        if self.CONNECTION:
+            logging.debug('Dropping failed connection: %s'%self.HOST)
+            self.POOL.discard(self.HOST, self.CONNECTION)
+            self.CONNECTION = None
         
     def close(self):
         '''Close the HTTP connection if required.'''
         if not self.PERSIST and self.CONNECTION:
             logging.debug('Closing connection')
             self.CONNECTION.close()
+            self.CONNECTION = None
+    
+    def clone(self, host=None):
+        '''Return a new engine with the same settings, eg. for a worker.'''
+        return Engine(host or self.HOST, self.PERSIST, self.POOL)
+
+class AsyncChannel(asyncore.dispatcher):
+    '''A keep-alive connection that pipelines requests for AsyncEngine.'''
+    def __init__(self, engine, sockmap):
+        asyncore.dispatcher.__init__(self, map=sockmap)
+        self.ENGINE = engine
+        self.SENT = list() # indexes of requests awaiting a response
+        self.OUTBUF = ''
+        self.QUEUED = 0 # bytes of requests queued on the connection
+        self.WRITTEN = 0 # of those, bytes written to the socket
+        self.UNWRITTEN = collections.deque() # (bytes to its end, index)
+        self.INBUF = ''
+        self.HEAD = None # status, reason and headers of current response
+        self.CLOSED = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(engine.address())
+        logging.debug('New async connection: %s'%engine.HOST)
+        
+    def request(self, index, suburl):
+        '''Queue a GET request for suburl, its response is for index.'''
+        lines = ['GET %s HTTP/1.1'%suburl, 'Host: %s'%self.ENGINE.HOST]
+        for header in sorted(self.ENGINE.HEADERS):
+            lines.append('%s: %s'%(header, self.ENGINE.HEADERS[header]))
+        data = '%s\r\n\r\n'%'\r\n'.join(lines)
+        self.OUTBUF += data
+        self.QUEUED += len(data)
+        self.UNWRITTEN.append((self.QUEUED, index))
+        self.SENT.append(index)
+        
+    def writable(self):
+        return bool(self.OUTBUF) or not self.connected
+    
+    def handle_connect(self):
+        pass
+    
+    def handle_write(self):
+        sent = self.send(self.OUTBUF)
+        self.OUTBUF = self.OUTBUF[sent:]
+        self.WRITTEN += sent
+        while self.UNWRITTEN and self.UNWRITTEN[0][0] <= self.WRITTEN:
+            self.ENGINE.written(self.UNWRITTEN.popleft()[1])
+        
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self.INBUF += data
+            self.parse()
             
+    def handle_close(self):
+        self.CLOSED = True
+        self.parse() # a body may end when the server closes
+        self.shutdown()
+        
+    def handle_error(self):
+        logging.debug('Async connection failed: %s'%self.ENGINE.HOST,
+                      exc_info=True)
+        self.shutdown()
+        
+    def shutdown(self):
+        '''Close and give any unanswered requests back to the engine.'''
+        self.CLOSED = True
+        self.close()
+        self.ENGINE.lost(self, self.SENT)
+        self.SENT = list()
+        self.UNWRITTEN.clear()
+        
+    def parse(self):
+        '''Pass each complete response in the input to the engine.'''
+        while self.SENT:
+            response = self.parse_response()
+            if not response:
+                return
+            self.ENGINE.finish(self.SENT.pop(0), response)
+            if response.getheader('connection', '').lower() == 'close':
+                self.shutdown()
+                return
+        self.ENGINE.feed(self)
+        
+    def parse_response(self):
+        '''Return the next response if all of it has been received.'''
+        if not self.HEAD:
+            end = self.INBUF.find('\r\n\r\n')
+            if end < 0:
+                return None
+            self.HEAD = self.parse_head(self.INBUF[:end])
+            self.INBUF = self.INBUF[end+4:]
+        status, reason, headers = self.HEAD
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = self.parse_chunked()
+        elif 'content-length' in headers:
+            length = int(headers['content-length'])
+            if len(self.INBUF) < length:
+                return None
+            body, self.INBUF = self.INBUF[:length], self.INBUF[length:]
+        elif status in (204, 304) or status < 200:
+            body = ''
+        elif self.CLOSED: # body was everything until the server closed
+            body, self.INBUF = self.INBUF, ''
+        else:
+            return None
+        if body is None:
+            return None
+        self.HEAD = None
+        return Response(status, reason, headers, body)
+    
+    def parse_head(self, head):
+        '''Return status, reason and headers from a response head.'''
+        lines = head.split('\r\n')
+        parts = lines[0].split(' ', 2)
+        status = int(parts[1])
+        reason = ''
+        if len(parts) > 2:
+            reason = parts[2]
+        headers = dict()
+        for line in lines[1:]:
+            name, unused, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return status, reason, headers
+    
+    def parse_chunked(self):
+        '''Return a chunked body if all of it has been received.'''
+        pieces = list()
+        pos = 0
+        while True:
+            end = self.INBUF.find('\r\n', pos)
+            if end < 0:
+                return None
+            size = int(self.INBUF[pos:end].split(';')[0], 16)
+            if not size: # last chunk, skip any trailers
+                if self.INBUF[end+2:end+4] == '\r\n':
+                    finish = end+4
+                else:
+                    finish = self.INBUF.find('\r\n\r\n', end+2)
+                    if finish < 0:
+                        return None
+                    finish += 4
+                self.INBUF = self.INBUF[finish:]
+                return ''.join(pieces)
+            start = end+2
+            if len(self.INBUF) < start+size+2:
+                return None
+            pieces.append(self.INBUF[start:start+size])
+            pos = start+size+2
+
+class AsyncEngine(object):
+    '''Connection to an engine keeping many requests in flight.
+    
+    Requests are pipelined over a small number of keep-alive connections
+    using asyncore, so one client can put a lot of load on the server.
+    A request is timed from when it is written to its socket, so its time
+    still includes the server answering the requests ahead of it on the
+    same connection.
+    '''
+    def __init__(self, host='orastats.bodleian.ox.ac.uk', persist=True,
+                 connections=4, pipeline=32, timeout=10):
+        self.HOST = host
+        self.PERSIST = persist
+        self.CONNECTIONS = connections # number of connections to use
+        self.PIPELINE = pipeline # requests in flight on each connection
+        self.TIMEOUT = timeout # give up if nothing received for this long
+        self.RETRIES = 1 # times a request is resent if its connection fails
+        self.HEADERS = {'User-agent' : 'ora_timestats'}
+        if not persist: 
+            self.HEADERS['Connection'] = 'close'
+            self.PIPELINE = 1
+        self.MAP = dict() # sockets used by asyncore
+        self.CHANNELS = list()
+        self.SUBURLS = list() # requests for the current get_many
+        self.PENDING = collections.deque() # indexes not yet sent
+        self.TRIES = dict()
+        self.STARTED = dict() # time each request was written to its socket
+        self.RESULTS = dict()
+        self.PROGRESS = 0 # time something last happened
+        
+    def connect(self, host=None):
+        '''Use host for future requests, connections open when needed.'''
+        if host and host != self.HOST:
+            self.close_all()
+            self.HOST = host
+            
+    def clone(self, host=None):
+        '''Return a new engine with the same settings.'''
+        return AsyncEngine(host or self.HOST, self.PERSIST, self.CONNECTIONS,
+                           self.PIPELINE, self.TIMEOUT)
+        
+    def address(self):
+        '''Return the host and port to connect to.'''
+        host, unused, port = self.HOST.partition(':')
+        return host, int(port or 80)
+    
+    def get(self, suburl):
+        '''Return response to a get request for suburl from the host.'''
+        response, unused = self.get_many([suburl])[0]
+        if not response:
+            raise EngineError
+        return response
+    
+    def get_many(self, suburls):
+        '''Return a (response, time taken) for each suburl, in order.
+        
+        The response is None if the request failed.
+        '''
+        self.SUBURLS = list(suburls)
+        self.PENDING = collections.deque(range(len(self.SUBURLS)))
+        self.TRIES = dict()
+        self.STARTED = dict()
+        self.RESULTS = dict()
+        self.PROGRESS = time.time()
+        while len(self.RESULTS) < len(self.SUBURLS):
+            self.open_channels()
+            for channel in self.CHANNELS:
+                self.feed(channel)
+            asyncore.loop(timeout=0.1, map=self.MAP, count=1)
+            if time.time()-self.PROGRESS > self.TIMEOUT:
+                logging.warn('Async requests timed out: %s'%self.HOST)
+                self.close_all()
+                for index in range(len(self.SUBURLS)):
+                    if index not in self.RESULTS:
+                        self.RESULTS[index] = (None, self.TIMEOUT)
+        self.close()
+        return [self.RESULTS[index] for index in range(len(self.SUBURLS))]
+    
+    def open_channels(self):
+        '''Open connections until there are enough for the pending requests.'''
+        self.CHANNELS = [c for c in self.CHANNELS if not c.CLOSED]
+        wanted = min(self.CONNECTIONS, len(self.PENDING))
+        while len(self.CHANNELS) < wanted:
+            self.CHANNELS.append(AsyncChannel(self, self.MAP))
+            
+    def feed(self, channel):
+        '''Send pending requests to channel until its pipeline is full.'''
+        while self.PENDING and len(channel.SENT) < self.PIPELINE:
+            if channel.CLOSED:
+                return
+            index = self.PENDING.popleft()
+            channel.request(index, self.SUBURLS[index])
+            
+    def written(self, index):
+        '''Start timing request index, now all of it is on the socket.
+
+        Time spent queued behind other requests or waiting for the
+        connection to open is not counted.
+        '''
+        self.STARTED[index] = time.time()
+        
+    def finish(self, index, response):
+        '''Store the response and time taken for request index.'''
+        self.PROGRESS = time.time()
+        started = self.STARTED.get(index, self.PROGRESS)
+        self.RESULTS[index] = (response, self.PROGRESS-started)
+        
+    def lost(self, channel, indexes):
+        '''Resend requests from a failed channel, or record them failed.'''
+        self.PROGRESS = time.time()
+        for index in reversed(indexes):
+            self.TRIES[index] = self.TRIES.get(index, 0) + 1
+            if self.TRIES[index] > self.RETRIES:
+                started = self.STARTED.get(index, self.PROGRESS)
+                self.RESULTS[index] = (None, self.PROGRESS-started)
+            else:
+                self.STARTED.pop(index, None)
+                self.PENDING.appendleft(index)
+                
+    def close_all(self):
+        '''Close every connection.'''
+        for channel in self.CHANNELS:
+            channel.CLOSED = True
+            channel.close()
+        self.CHANNELS = list()
+        
+    def close(self):
+        '''Close the connections if required.'''
+        if not self.PERSIST:
+            self.close_all()
+
+class ResponseCache(object):
+    '''Responses kept by full URL for a time, the least recently used go.
+
+    Shared by the CachingEngine of every worker thread, so is locked.
+    Only successful responses are kept. If given a file the responses
+    are loaded from it and can be saved to it for later runs.
+    '''
+    def __init__(self, ttl=300, max_size=10000, fname=None):
+        self.TTL = ttl # seconds a response is kept
+        self.MAX_SIZE = max_size # most responses kept
+        self.FNAME = fname
+        self.RESPONSES = collections.OrderedDict() # url: (time, response)
+        self.LOCK = threading.Lock()
+        self.HITS = 0
+        self.MISSES = 0
+        self.EXPIRED = 0
+        self.EVICTED = 0
+        if fname and os.path.exists(fname):
+            self.load()
+
+    def get(self, url):
+        '''Return the response kept for url, or None.'''
+        with self.LOCK:
+            found = self.RESPONSES.pop(url, None)
+            if found and time.time()-found[0] > self.TTL:
+                self.EXPIRED += 1
+                found = None
+            if not found:
+                self.MISSES += 1
+                return None
+            self.RESPONSES[url] = found # now the most recently used
+            self.HITS += 1
+            return found[1]
+
+    def put(self, url, response):
+        '''Keep response for url if it succeeded.'''
+        if response.status != 200:
+            return
+        with self.LOCK:
+            self.RESPONSES.pop(url, None)
+            self.RESPONSES[url] = (time.time(), response)
+            while len(self.RESPONSES) > self.MAX_SIZE:
+                self.RESPONSES.popitem(last=False)
+                self.EVICTED += 1
+
+    def clear(self):
+        with self.LOCK:
+            self.RESPONSES = collections.OrderedDict()
+
+    def load(self):
+        '''Add the responses saved in FNAME that have not expired.'''
+        with file(self.FNAME, 'rb') as infile:
+            saved = cPickle.load(infile)
+        now = time.time()
+        with self.LOCK:
+            for url, stored, status, reason, headers, body in saved:
+                if now-stored <= self.TTL:
+                    response = Response(status, reason, headers, body)
+                    self.RESPONSES[url] = (stored, response)
+        logging.info('Responses loaded: %s from %s'%(len(self.RESPONSES), self.FNAME))
+
+    def save(self):
+        '''Save the responses to FNAME, if one was given.'''
+        if not self.FNAME:
+            return
+        with self.LOCK:
+            saved = [(url, stored, r.status, r.reason, r.HEADERS, r.BODY)
+                     for url, (stored, r) in self.RESPONSES.iteritems()]
+        tmpname = '%s.tmp'%self.FNAME
+        with file(tmpname, 'wb') as outfile:
+            cPickle.dump(saved, outfile, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, self.FNAME)
+        logging.info('Responses saved: %s to %s'%(len(saved), self.FNAME))
+
+    def report(self):
+        '''Return a line summarising how well the cache did.'''
+        with self.LOCK:
+            tried = self.HITS + self.MISSES
+            rate = 100.0*self.HITS/max(1, tried)
+            return ('Response cache: hits %s, misses %s (%.1f%% hit), '
+                    'expired %s, evicted %s, kept %s'%(self.HITS, self.MISSES,
+                    rate, self.EXPIRED, self.EVICTED, len(self.RESPONSES)))
+
+class CachingEngine(object):
+    '''Engine or AsyncEngine answering repeated requests from a cache.
+
+    Requests are keyed by host and URL, so the same cache can be used
+    for more than one host. Responses from the cache take no time in
+    any phase except the lookup, which is timed as the first byte.
+    '''
+    def __init__(self, engine=None, cache=None):
+        if not engine:
+            engine = Engine()
+        if not cache:
+            cache = ResponseCache()
+        self.ENGINE = engine # for requests not in the cache
+        self.CACHE = cache
+
+    def key(self, suburl):
+        return 'http://%s%s'%(self.ENGINE.HOST, suburl)
+
+    def connect(self, host=None):
+        return self.ENGINE.connect(host)
+
+    def clone(self, host=None):
+        '''Return a new engine sharing the cache.'''
+        return CachingEngine(self.ENGINE.clone(host), self.CACHE)
+
+    def close(self):
+        self.ENGINE.close()
+
+    def cached(self, suburl):
+        '''Return the response kept for suburl with the lookup timed.'''
+        start = clock.monotonic()
+        response = self.CACHE.get(self.key(suburl))
+        if not response:
+            return None
+        answer = Response(response.status, response.reason,
+                          response.HEADERS, response.BODY)
+        answer.PHASES = clock.no_phases()
+        answer.PHASES['ttfb'] = clock.monotonic()-start
+        return answer
+
+    def get(self, suburl):
+        '''Return the response for suburl, from the cache if kept.'''
+        response = self.cached(suburl)
+        if response:
+            return response
+        response = self.ENGINE.get(suburl)
+        self.CACHE.put(self.key(suburl), response)
+        return response
+
+    def get_many(self, suburls):
+        '''Return a (response, time taken) for each suburl, in order.
+
+        Only those not in the cache are requested from the engine.
+        '''
+        results = list()
+        wanted = list()
+        for suburl in suburls:
+            start = clock.monotonic()
+            response = self.cached(suburl)
+            results.append((response, clock.monotonic()-start))
+            if not response:
+                wanted.append(len(results)-1)
+        if not wanted:
+            return results
+        if hasattr(self.ENGINE, 'get_many'):
+            fetched = self.ENGINE.get_many([suburls[i] for i in wanted])
+        else:
+            fetched = list()
+            for index in wanted:
+                start = clock.monotonic()
+                try:
+                    response = self.ENGINE.get(suburls[index])
+                except EngineError:
+                    response = None
+                fetched.append((response, clock.monotonic()-start))
+        for index, (response, took) in zip(wanted, fetched):
+            if response:
+                self.CACHE.put(self.key(suburls[index]), response)
+            results[index] = (response, took)
+        return results
+
 class SingleRequest(object):
     '''Engine to collect results where a single URL can be used.'''
-    def __init__(self):
+    def __init__(self, engine=None):
         '''Start the engine so it is ready for setup.'''
         self.URL_ROOT = None
         self.URL_SOURCE = None # This will point to a method for calling
         self.SOURCES = ['or-static', 'or-vdown', 'or-indexed', 'or-months', 'or-yearmonth']
-        self.ENGINE = Engine()
+        if not engine: # Engine or AsyncEngine
+            engine = Engine()
+        self.ENGINE = engine
         
         # This code will be used for all get requests if enabled.
         self.SINGLE_SCODE = ''
+        self.PHASES = clock.no_phases() # seconds in each phase of last get
+    
+    def clone(self):
+        '''Return a copy that is setup the same but has its own engine.'''
+        other = copy.copy(self)
+        other.ENGINE = self.ENGINE.clone(self.URL_ROOT)
+        if self.URL_SOURCE: # point at the method of the copy
+            other.URL_SOURCE = getattr(other, self.URL_SOURCE.__name__)
+        return other
     
     def setup(self, source, root=None, singlecode=''):
         '''Source controls how the URL is combined with root url.'''
@@ -90,6 +713,8 @@ class SingleRequest(object):
             self.URL_SOURCE = self.url_resultsgroup
         elif source == 'or-yearmonth':
             self.URL_SOURCE = self.url_allmonths
+        elif source == 'fe-batch':
+            self.URL_SOURCE = self.url_batch
         else:
             raise ValueError
         
@@ -134,23 +759,76 @@ class SingleRequest(object):
             item = self.SINGLE_SCODE
         return '/results/yearmonth.php?yeartype=ac&scode=%s'%item
     
+    def url_batch(self, item):
+        '''Return the URL for a front-end batch of one or more items.'''
+        if self.SINGLE_SCODE: # always use the same item
+            item = self.SINGLE_SCODE
+        return '/results/batch.php?type=vdown&scodes=%s'%item
+    
     def get(self, scode):
         '''Get results for scode timing how long it takes.'''
         address = self.URL_SOURCE(scode)
+        self.PHASES = clock.no_phases()
         
-        istart = time.time()
+        istart = clock.monotonic()
         try:
             indata = self.ENGINE.get(address)
             content = indata.read()
+            self.PHASES.update(indata.PHASES)
         except EngineError:
             content = ''
-        iend = time.time()
+        iend = clock.monotonic()
         timetaken = iend-istart
         self.ENGINE.close() # ignored if connection is persistent
         
         content = self.extract(content)
+        self.PHASES['parse'] = clock.monotonic()-iend
         return content, timetaken
     
+    def get_many(self, scodes):
+        '''Get results for many scodes at once, timing each one.
+        
+        Only an AsyncEngine has requests in flight at the same time,
+        with others the scodes are fetched one after another. With the
+        fe-batch source all the scodes are fetched with one request.
+        '''
+        if self.URL_SOURCE == self.url_batch:
+            return self.get_batch(scodes)
+        if not hasattr(self.ENGINE, 'get_many'):
+            return [self.get(scode) for scode in scodes]
+        addresses = [self.URL_SOURCE(scode) for scode in scodes]
+        results = list()
+        for response, timetaken in self.ENGINE.get_many(addresses):
+            content = ''
+            if response:
+                content = response.read()
+            results.append((self.extract(content), timetaken))
+        return results
+    
+    def get_batch(self, scodes):
+        '''Get results for scodes with one front-end request.
+        
+        The time taken is shared equally between the scodes.
+        '''
+        address = self.url_batch(','.join(scodes))
+        istart = clock.monotonic()
+        try:
+            content = self.ENGINE.get(address).read()
+        except EngineError:
+            content = ''
+        timetaken = (clock.monotonic()-istart)/max(1, len(scodes))
+        self.ENGINE.close() # ignored if connection is persistent
+        found = dict()
+        for line in content.splitlines():
+            scode, unused, result = line.partition('\t')
+            found[scode] = result
+        results = list()
+        for scode in scodes:
+            if self.SINGLE_SCODE:
+                scode = self.SINGLE_SCODE
+            results.append((found.get(scode, 'e0;e0'), timetaken))
+        return results
+    
     def extract(self, content):
         '''Check the content for the information expected.'''
         if self.URL_SOURCE == self.url_months:
@@ -166,9 +844,11 @@ class SingleRequest(object):
 
 class MultipleRequest(object):
     '''Engine to collect results where multiple URLs are needed used.'''
-    def __init__(self):
+    def __init__(self, engine=None):
         self.URL_ROOT = ''
-        self.ENGINE = Engine()
+        if not engine: # Engine or AsyncEngine
+            engine = Engine()
+        self.ENGINE = engine
         self.URL_SUBDIR = '' # enables usage if Piwik not in root dir
         self.URL_ITEMS = list() # store base urls items come from
         self.TOKEN = '' # Token need to query API
@@ -181,10 +861,18 @@ class MultipleRequest(object):
         # times it will check the effects of any caches that exist.
         self.SINGLE_VIEWS = None # Get views for this URL
         self.SINGLE_DOWNS = None # Get downloads for this URL
+        self.ERRORS = 0 # requests that failed for the current item
+        self.PHASES = clock.no_phases() # seconds in each phase of last get
+        
+        # Collect the calls for items with Piwik API.getBulkRequest, this
+        # is how many items to put in each request, 0 to not use it.
+        self.BULK = 0
+        self.CATEGORIES = (('views', 'nb_hits'), ('downloads', 'nb_visits'))
     
     def setup(self, token, root=None, subdir='', item='THESIS01',
-              query='last5years', singles=[]):
+              query='last5years', singles=[], bulk=0):
         self.TOKEN = token
+        self.BULK = bulk
         if not root:
             root = 'orastats.bodleian.ox.ac.uk'
         if subdir: # This will enable query of multiple Piwik installs
@@ -216,6 +904,12 @@ class MultipleRequest(object):
         self.URL_ROOT = root
         self.ENGINE.connect(self.URL_ROOT)
 
+    def clone(self):
+        '''Return a copy that is setup the same but has its own engine.'''
+        other = copy.copy(self)
+        other.ENGINE = self.ENGINE.clone(self.URL_ROOT)
+        return other
+    
     def shared_params(self):
         params = dict()
         params['module']='API'
@@ -228,6 +922,21 @@ class MultipleRequest(object):
             
     def url_generic(self, item, baseurl, category='downloads'):
         '''Return a URL to get category stats for item at baseurl.'''
+        params, urlcat, item = self.params_generic(item, baseurl, category)
+        encoded = urllib.urlencode(params)
+        url = self.url_api('%s&%s=%s'%(encoded, urlcat, item))
+        logging.debug(url)
+        
+        return url
+    
+    def url_api(self, query):
+        '''Return the URL for the API with query.'''
+        if self.URL_SUBDIR: # Piwik install not at root of website.
+            return '/%s/index.php?%s'%(self.URL_SUBDIR, query)
+        return '/index.php?%s'%query
+    
+    def params_generic(self, item, baseurl, category='downloads'):
+        '''Return params, name and URL to get category stats for item.'''
         params = self.shared_params()        
         if category == 'downloads':
             params['method']='Actions.getDownload'
@@ -245,24 +954,42 @@ class MultipleRequest(object):
             else:
                 item = '%s%s'%(baseurl, item ) 
             urlcat = 'pageUrl'
-        encoded = urllib.urlencode(params)
-        if self.URL_SUBDIR: # Piwik install not at root of website.
-            url = '/%s/index.php?%s&%s=%s'%(self.URL_SUBDIR, encoded, urlcat, item)
-        else:
-            url = '/index.php?%s&%s=%s'%(encoded, urlcat, item)
-        logging.debug(url)
+        return params, urlcat, item
+    
+    def url_bulk(self, scodes):
+        '''Return a URL for API.getBulkRequest getting all calls for scodes.
         
+        The calls for each scode are in the order of CATEGORIES then
+        URL_ITEMS, as get_generic does them.
+        '''
+        shared = ('module', 'token_auth', 'format')
+        params = dict([(name, self.shared_params()[name]) for name in shared])
+        params['method'] = 'API.getBulkRequest'
+        calls = list()
+        for scode in scodes:
+            for category, unused in self.CATEGORIES:
+                for baseurl in self.URL_ITEMS:
+                    call, urlcat, item = self.params_generic(scode, baseurl, category)
+                    for name in shared: # given once for the whole request
+                        del call[name]
+                    query = '%s&%s=%s'%(urllib.urlencode(call), urlcat, item)
+                    calls.append('urls[%s]=%s'%(len(calls), urllib.quote(query, '')))
+        url = self.url_api('%s&%s'%(urllib.urlencode(params), '&'.join(calls)))
+        logging.debug(url)
         return url
     
     def fetch(self, webpage):
         '''Return time taken and data from webpage on a host engine.'''
-        istart = time.time()
+        istart = clock.monotonic()
         try:
             indata = self.ENGINE.get(webpage)
             data = indata.read()
+            for phase in indata.PHASES:
+                self.PHASES[phase] += indata.PHASES[phase]
         except EngineError:
             data = 'request_error'
-        iend = time.time()
+            self.ERRORS += 1
+        iend = clock.monotonic()
         timetaken = iend-istart
         return timetaken, data
     
@@ -274,7 +1001,9 @@ class MultipleRequest(object):
             url = self.url_generic(scode, baseurl, category)
             timetaken, data = self.fetch(url)
             totaltime += timetaken
+            pstart = clock.monotonic()
             totalresult += self.extract_total(data, countid, scode)
+            self.PHASES['parse'] += clock.monotonic()-pstart
         logging.debug('Total found: %s\t%s'%(totalresult, scode))
         logging.debug('Time taken: %s\t%s'%(totaltime, scode))
         return totalresult, totaltime
@@ -291,7 +1020,11 @@ class MultipleRequest(object):
             elif check == 'request_error':
                 logging.warn('Request issue: %s'%scode)
             return total
+        return self.extract_points(dpoints, field)
     
+    def extract_points(self, dpoints, field):
+        '''Sum the field from all points of decoded data.'''
+        total = 0
         if self.QUERY_PERIOD == 'range':
             try:
                 return dpoints[0][field]
@@ -316,10 +1049,99 @@ class MultipleRequest(object):
         
     def get(self, scode):
         '''Get results for scode, timing all needed requests.'''
+        self.PHASES = clock.no_phases()
+        if self.BULK:
+            return self.get_bulk([scode])[0]
+        self.ERRORS = 0
         views, viewtime = self.get_views(scode)
         downloads, downtime = self.get_downloads(scode)
-        content = '%s;%s'%(views, downloads)
+        content = self.content(views, downloads)
         return content, viewtime+downtime
+    
+    def content(self, views, downloads):
+        '''Return the result, marked e if any request failed.'''
+        if self.ERRORS:
+            return 'e%s;e%s'%(views, downloads)
+        return '%s;%s'%(views, downloads)
+    
+    def get_many(self, scodes):
+        '''Get results for many scodes at once, timing each one.
+        
+        With an AsyncEngine all the requests for all the scodes are in
+        flight together, the time for each scode is the sum of its requests.
+        In bulk mode the scodes are fetched BULK at a time.
+        '''
+        if self.BULK:
+            results = list()
+            for start in range(0, len(scodes), self.BULK):
+                results += self.get_bulk(scodes[start:start+self.BULK])
+            return results
+        if not hasattr(self.ENGINE, 'get_many'):
+            return [self.get(scode) for scode in scodes]
+        categories = self.CATEGORIES
+        urls = list()
+        for scode in scodes:
+            for category, unused in categories:
+                for baseurl in self.URL_ITEMS:
+                    urls.append(self.url_generic(scode, baseurl, category))
+        fetched = iter(self.ENGINE.get_many(urls))
+        results = list()
+        for scode in scodes:
+            self.ERRORS = 0
+            totals = list()
+            totaltime = 0.0
+            for unused, countid in categories:
+                total = 0
+                for baseurl in self.URL_ITEMS:
+                    response, timetaken = fetched.next()
+                    data = 'request_error'
+                    if response:
+                        data = response.read()
+                    else:
+                        self.ERRORS += 1
+                    totaltime += timetaken
+                    total += self.extract_total(data, countid, scode)
+                totals.append(total)
+            results.append((self.content(*totals), totaltime))
+        return results
+    
+    def get_bulk(self, scodes):
+        '''Get results for scodes with one bulk request.
+        
+        The time taken is shared equally between the scodes.
+        '''
+        self.ERRORS = 0
+        timetaken, data = self.fetch(self.url_bulk(scodes))
+        timetaken = timetaken/max(1, len(scodes))
+        calls = len(self.CATEGORIES)*len(self.URL_ITEMS)
+        pstart = clock.monotonic()
+        try:
+            parts = json.loads(data)
+        except ValueError:
+            parts = None
+        self.PHASES['parse'] += clock.monotonic()-pstart
+        if not isinstance(parts, list) or len(parts) != calls*len(scodes):
+            if data != 'request_error':
+                logging.warn('Bulk request failed: %s'%str(data)[:200])
+            return [('e0;e0', timetaken) for scode in scodes]
+        results = list()
+        for number, scode in enumerate(scodes):
+            self.ERRORS = 0
+            totals = list()
+            place = number*calls
+            for unused, countid in self.CATEGORIES:
+                total = 0
+                for baseurl in self.URL_ITEMS:
+                    part = parts[place]
+                    place += 1
+                    if isinstance(part, dict) and part.get('result') == 'error':
+                        logging.warn('Bulk call failed: %s'%part.get('message'))
+                        self.ERRORS += 1
+                        continue
+                    total += self.extract_points(part, countid)
+                totals.append(total)
+            results.append((self.content(*totals), timetaken))
+        return results
         
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
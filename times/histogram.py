@@ -0,0 +1,164 @@
+'''Compact mergeable histogram of times taken.'''
+import logging
+import math
+import sys
+
+SUB_BITS = 7 # each power of 2 is split into 64 buckets, about 1.6% wide
+SUB_COUNT = 1 << SUB_BITS
+SUB_HALF = SUB_COUNT >> 1
+UNITS = 1000000 # times are stored as whole microseconds
+
+class Histogram(object):
+    '''Times in log buckets (like HDR histograms) that can be merged.
+
+    Only buckets that have been used are stored so a histogram for a
+    sample or a whole engine run stays small, and two histograms can be
+    added together without keeping every time.
+    '''
+    def __init__(self):
+        self.BUCKETS = dict() # bucket index: count
+        self.COUNT = 0
+        self.ERRORS = 0
+        self.TOTAL = 0.0 # seconds
+        self.SQUARES = 0.0 # for the standard deviation
+        self.MIN = None
+        self.MAX = None
+
+    def index(self, value):
+        '''Return the bucket for value in microseconds.'''
+        if value < SUB_COUNT:
+            return value
+        shift = value.bit_length() - SUB_BITS
+        return shift*SUB_HALF + (value >> shift)
+
+    def value(self, index):
+        '''Return the middle of the bucket in microseconds.'''
+        if index < SUB_COUNT:
+            return index
+        shift = index//SUB_HALF - 1
+        low = (index - shift*SUB_HALF) << shift
+        return low + ((1 << shift) >> 1)
+
+    def record(self, seconds, error=False):
+        '''Add a time taken, and count it as an error if needed.'''
+        seconds = max(0.0, float(seconds))
+        index = self.index(int(round(seconds*UNITS)))
+        self.BUCKETS[index] = self.BUCKETS.get(index, 0) + 1
+        self.COUNT += 1
+        if error:
+            self.ERRORS += 1
+        self.TOTAL += seconds
+        self.SQUARES += seconds*seconds
+        if self.MIN is None or seconds < self.MIN:
+            self.MIN = seconds
+        if self.MAX is None or seconds > self.MAX:
+            self.MAX = seconds
+
+    def merge(self, other):
+        '''Add the times from other histogram to this one.'''
+        for index in other.BUCKETS:
+            self.BUCKETS[index] = self.BUCKETS.get(index, 0) + other.BUCKETS[index]
+        self.COUNT += other.COUNT
+        self.ERRORS += other.ERRORS
+        self.TOTAL += other.TOTAL
+        self.SQUARES += other.SQUARES
+        for limit in (other.MIN, other.MAX):
+            if limit is None:
+                continue
+            if self.MIN is None or limit < self.MIN:
+                self.MIN = limit
+            if self.MAX is None or limit > self.MAX:
+                self.MAX = limit
+        return self
+
+    def percentile(self, percent):
+        '''Return the time in seconds that percent of times are within.'''
+        if not self.COUNT:
+            return 0.0
+        rank = max(1, int(math.ceil(self.COUNT*percent/100.0)))
+        seen = 0
+        for index in sorted(self.BUCKETS):
+            seen += self.BUCKETS[index]
+            if seen >= rank:
+                break
+        seconds = float(self.value(index))/UNITS
+        return min(max(seconds, self.MIN), self.MAX)
+
+    def average(self):
+        if not self.COUNT:
+            return 0.0
+        return self.TOTAL/self.COUNT
+
+    def stdev(self):
+        '''Return the standard deviation of the times.'''
+        if not self.COUNT:
+            return 0.0
+        average = self.average()
+        return math.sqrt(max(0.0, self.SQUARES/self.COUNT - average*average))
+
+    def summary(self):
+        '''Return the P50, P90, P99, Max, Stdev and Errors as strings.'''
+        return ('%.3f'%self.percentile(50), '%.3f'%self.percentile(90),
+                '%.3f'%self.percentile(99), '%.3f'%(self.MAX or 0.0),
+                '%.3f'%self.stdev(), '%s'%self.ERRORS)
+
+    def dumps(self):
+        '''Return the histogram as a line of text, see loads.'''
+        head = '%s %s %r %r %r %r'%(self.COUNT, self.ERRORS, self.TOTAL,
+                                    self.SQUARES, self.MIN, self.MAX)
+        buckets = ['%s:%s'%(i, self.BUCKETS[i]) for i in sorted(self.BUCKETS)]
+        return '%s|%s'%(head, ','.join(buckets))
+
+    def loads(self, line):
+        '''Replace the contents with a line made by dumps.'''
+        head, unused, buckets = line.strip().partition('|')
+        count, errors, total, squares, low, high = head.split()
+        self.COUNT = int(count)
+        self.ERRORS = int(errors)
+        self.TOTAL = float(total)
+        self.SQUARES = float(squares)
+        self.MIN = None
+        if low != 'None':
+            self.MIN = float(low)
+        self.MAX = None
+        if high != 'None':
+            self.MAX = float(high)
+        self.BUCKETS = dict()
+        for bucket in buckets.split(','):
+            if bucket:
+                index, number = bucket.split(':')
+                self.BUCKETS[int(index)] = int(number)
+        return self
+
+    def save(self, fname):
+        '''Save to fname so runs can be merged later.'''
+        with file(fname, 'w') as savefile:
+            savefile.write('%s\n'%self.dumps())
+        logging.info('Saved to: %s'%fname)
+
+    def load(self, fname):
+        '''Merge the histogram saved in fname into this one.'''
+        with file(fname) as infile:
+            return self.merge(Histogram().loads(infile.read()))
+
+    def result(self):
+        '''Return a summary of the times.'''
+        answer = list()
+        answer.append('Number of times: %s'%self.COUNT)
+        answer.append('Errors: %s'%self.ERRORS)
+        answer.append('Average: %.3f'%self.average())
+        answer.append('Standard deviation: %.3f'%self.stdev())
+        for percent in (50, 90, 99):
+            answer.append('P%s: %.3f'%(percent, self.percentile(percent)))
+        answer.append('Maximum: %.3f'%(self.MAX or 0.0))
+        return '\n'.join(answer)
+
+    def __str__(self):
+        return self.result()
+
+if __name__ == '__main__':
+    # Merge histograms saved by runs, eg. reports/summary-*.hist
+    merged = Histogram()
+    for fname in sys.argv[1:]:
+        merged.load(fname)
+    print merged
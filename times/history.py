@@ -0,0 +1,180 @@
+'''Append-only history of runs to follow times across weeks.'''
+import logging
+import os
+import socket
+import sqlite3
+import subprocess
+import time
+
+import clock # phases of requests
+
+HISTORY_FILE = os.path.join('reports', 'history.sqlite')
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    revision TEXT,
+    client TEXT,
+    workers INTEGER,
+    concurrency TEXT,
+    note TEXT
+);
+CREATE TABLE IF NOT EXISTS engines (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL,
+    host TEXT,
+    source TEXT,
+    query TEXT,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    engine_id INTEGER NOT NULL REFERENCES engines(id),
+    sample TEXT NOT NULL,
+    item TEXT NOT NULL,
+    result TEXT,
+    took REAL,
+    error INTEGER,
+    connect REAL,
+    write REAL,
+    ttfb REAL,
+    body REAL,
+    parse REAL
+);
+CREATE INDEX IF NOT EXISTS engines_name ON engines (name, started);
+CREATE INDEX IF NOT EXISTS engines_run ON engines (run_id);
+CREATE INDEX IF NOT EXISTS items_engine ON items (engine_id, sample);
+CREATE INDEX IF NOT EXISTS items_item ON items (item);
+'''
+TREND_HEADER = 'Started\tRevision\tItems\tTAverage\tMax\tErrors\tEngine'
+
+def git_revision():
+    '''Return the revision of the code being run, or None if unknown.'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                                   cwd=here, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        output = process.communicate()[0]
+    except OSError:
+        return None
+    if process.returncode:
+        return None
+    return output.strip()
+
+def engine_rows(sam):
+    '''Return a row for each item of samples sam, less the engine id.'''
+    rows = list()
+    for sample in sorted(sam.SAMPLES):
+        sampleset = sam.SAMPLES[sample]
+        for item, result, took, phases in sampleset.items():
+            row = [sample, item, str(result), took,
+                   int(sampleset.is_error(result))]
+            row += [phases.get(phase) for phase in clock.PHASES]
+            rows.append(row)
+    return rows
+
+class PendingHistory(object):
+    '''Engines to add to a history later, eg. when run in another process.'''
+    def __init__(self):
+        self.ENGINES = list() # name, host, source, query, started and rows
+
+    def add_engine(self, sam, name, host='', source='', query=''):
+        self.ENGINES.append((name, host, source, query, time.time(),
+                             engine_rows(sam)))
+
+class ResultsHistory(object):
+    '''Runs, engines and item times kept in SQLite, only ever added to.'''
+    def __init__(self, fname=HISTORY_FILE):
+        self.FNAME = fname
+        self.CONNECTION = sqlite3.connect(fname)
+        self.CONNECTION.executescript(SCHEMA)
+        self.RUN = None # id of the run being recorded
+
+    def start_run(self, workers=1, concurrency='threads', note=''):
+        '''Record the start of a run, returning its id.'''
+        with self.CONNECTION:
+            cursor = self.CONNECTION.execute(
+                'INSERT INTO runs (started, revision, client, workers, '
+                'concurrency, note) VALUES (?, ?, ?, ?, ?, ?)',
+                (time.time(), git_revision(), socket.gethostname(), workers,
+                 concurrency, note))
+        self.RUN = cursor.lastrowid
+        logging.info('Recording run %s in: %s'%(self.RUN, self.FNAME))
+        return self.RUN
+
+    def add_engine(self, sam, name, host='', source='', query=''):
+        '''Add the times of each item of samples sam run by engine name.'''
+        return self.add_rows(engine_rows(sam), name, host, source, query)
+
+    def add_rows(self, rows, name, host='', source='', query='', started=None):
+        '''Add rows of item times, see engine_rows, run by engine name.'''
+        if self.RUN is None:
+            self.start_run()
+        with self.CONNECTION:
+            cursor = self.CONNECTION.execute(
+                'INSERT INTO engines (run_id, name, host, source, query, '
+                'started) VALUES (?, ?, ?, ?, ?, ?)',
+                (self.RUN, name, host, source or name, query,
+                 started or time.time()))
+            engine = cursor.lastrowid
+            self.CONNECTION.executemany(
+                'INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [[engine] + row for row in rows])
+        logging.info('Recorded %s items for: %s'%(len(rows), name))
+        return engine
+
+    def add_pending(self, pending):
+        '''Add the engines kept by a PendingHistory, in the order run.'''
+        for name, host, source, query, started, rows in pending.ENGINES:
+            self.add_rows(rows, name, host, source, query, started)
+
+    def trend(self, name, sample=None):
+        '''Return started, revision, items, average, max and errors of
+        each run of engine name, optionally for one sample only.'''
+        query = ('SELECT e.started, r.revision, COUNT(*), AVG(i.took), '
+                 'MAX(i.took), SUM(i.error), e.name FROM engines e '
+                 'JOIN runs r ON r.id = e.run_id '
+                 'JOIN items i ON i.engine_id = e.id WHERE e.name = ?')
+        params = [name]
+        if sample:
+            query += ' AND i.sample = ?'
+            params.append(sample)
+        query += ' GROUP BY e.id ORDER BY e.started'
+        return self.CONNECTION.execute(query, params).fetchall()
+
+    def engine_names(self):
+        query = 'SELECT DISTINCT name FROM engines ORDER BY name'
+        return [row[0] for row in self.CONNECTION.execute(query)]
+
+    def result(self, name, sample=None):
+        '''Return a table of how the times of engine name have changed.'''
+        answer = [TREND_HEADER]
+        for started, revision, count, average, high, errors, engine in self.trend(name, sample):
+            when = time.strftime('%y-%m-%d %H:%M', time.gmtime(started))
+            answer.append('%s\t%s\t%s\t%.3f\t%.3f\t%s\t%s'%(when, revision,
+                          count, average, high, errors, engine))
+        return '\n'.join(answer)
+
+    def close(self):
+        self.CONNECTION.close()
+
+def command_line():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('-f', help='History file to read', dest='fname',
+                      default=HISTORY_FILE)
+    parser.add_option('-e', help='Engine to show the trend of, all if not given',
+                      dest='engine', default=None)
+    parser.add_option('-s', help='Only this sample, eg. batches/5_econ5394.csv',
+                      dest='sample', default=None)
+    (options, unused) = parser.parse_args()
+    return options
+
+if __name__ == '__main__':
+    options = command_line()
+    h = ResultsHistory(options.fname)
+    names = [options.engine] if options.engine else h.engine_names()
+    for name in names:
+        print h.result(name, options.sample)
+        print
@@ -0,0 +1,181 @@
+'''Send a batch at target rates to see how latency grows with load.'''
+import logging
+import os
+import time
+import threading
+
+import engines # how results are obtained
+import samples # what results are needed
+import sources # for multiple engines
+import histogram # to summarise the spread of times
+
+CURVE_HEADER = 'Rate\tThroughput\tP50\tP90\tP99\tMax\tStdev\tErrors\tServiceP50\tServiceP99'
+
+def ramp(start, stop, steps):
+    '''Return steps rates going evenly from start to stop.'''
+    if steps < 2:
+        return [float(start)]
+    step = (stop-start)/float(steps-1)
+    return [start + step*number for number in range(steps)]
+
+class OpenLoopSet(samples.SampleSet):
+    '''Items sent at a constant arrival rate whatever the engine does.
+
+    Unlike SampleSet.run the next item does not wait for the last one to
+    finish. Latency is measured from when each request should have been
+    sent, so time spent waiting when the engine falls behind is counted
+    (correcting for coordinated omission). The service time is what the
+    engine reports, as SampleSet records.
+    '''
+    def __init__(self, duration=30, workers=50):
+        samples.SampleSet.__init__(self)
+        self.DURATION = duration # seconds to send at each rate
+        self.WORKERS = workers # most requests in flight at once
+        self.CURVE = list() # rate, throughput, latency and service times
+        self.LOCK = threading.Lock()
+        self.SCHEDULE = None # what the workers are sending
+
+    def load_batch(self, fname):
+        '''Load items to send from a batch file.'''
+        self.ITEMS = samples.batch(fname)
+        logging.info('Items to send: %s'%len(self.ITEMS))
+
+    def enable(self, engine=None, name=None, workers=None):
+        '''Setup engine to query and give it a name.'''
+        if not workers:
+            workers = self.WORKERS
+        samples.SampleSet.enable(self, engine, name, workers, 'threads')
+
+    def run(self, rates):
+        '''Send items at each rate (requests per second) in turn.'''
+        self.CURVE = list()
+        workers = [self.worker_engine() for unused in range(self.WORKERS)]
+        for rate in rates:
+            logging.info('Sending at %.1f per second: %s'%(rate, self.NAME))
+            self.CURVE.append(self.run_rate(float(rate), workers))
+        logging.info('Open loop finished: %s'%self.NAME)
+
+    def run_rate(self, rate, workers):
+        '''Return throughput and times found sending at rate.'''
+        items = self.ITEMS
+        count = max(1, int(rate*self.DURATION))
+        start = time.time() + 0.1 # give the workers time to start
+        self.SCHEDULE = {'items': items, 'count': count, 'rate': rate,
+                         'start': start, 'next': 0, 'finish': start,
+                         'latency': histogram.Histogram(),
+                         'service': histogram.Histogram()}
+        threads = list()
+        for engine in workers[:count]:
+            thread = threading.Thread(target=self.run_sender, args=(engine,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        schedule, self.SCHEDULE = self.SCHEDULE, None
+        elapsed = max(schedule['finish']-start, 1.0/rate)
+        return rate, count/elapsed, schedule['latency'], schedule['service']
+
+    def run_sender(self, engine):
+        '''Send the next scheduled item until all have been sent.'''
+        schedule = self.SCHEDULE
+        while True:
+            with self.LOCK:
+                number = schedule['next']
+                if number >= schedule['count']:
+                    return
+                schedule['next'] += 1
+            intended = schedule['start'] + number/schedule['rate']
+            wait = intended - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            sent = time.time()
+            item = schedule['items'][number % len(schedule['items'])]
+            result, took = self.run_item(engine, item)
+            error = self.is_error(result)
+            with self.LOCK:
+                schedule['latency'].record(sent-intended+took, error)
+                schedule['service'].record(took, error)
+                schedule['finish'] = max(schedule['finish'], time.time())
+
+    def curve_row(self, point):
+        '''Return a row of the throughput against latency curve.'''
+        rate, throughput, latency, service = point
+        spread = '\t'.join(latency.summary())
+        return '%.1f\t%.1f\t%s\t%.3f\t%.3f'%(rate, throughput, spread,
+                        service.percentile(50), service.percentile(99))
+
+    def result(self):
+        '''Return the throughput against latency curve.'''
+        answer = list()
+        answer.append(CURVE_HEADER)
+        for point in self.CURVE:
+            answer.append(self.curve_row(point))
+        return '\n'.join(answer)
+
+    def save(self, fname):
+        '''Save the curve to fname (name of set gets appended).'''
+        fname = '%s-%s.tsv'%(fname, self.NAME)
+        with file(fname, 'w') as savefile:
+            savefile.write(self.result())
+        logging.info('Saved to: %s'%fname)
+
+def run_engines(batch, rates, duration=30, workers=50, testitem=[]):
+    '''Find the curve for batch for each of the PiwiEngines sources.'''
+    outdir = samples.output_dir()
+    curves = list()
+    for name, token, root, subdir, query in sources.PiwiEngines().get_sources():
+        label = '%s_%s'%(name, query)
+        logging.info('Running engine: %s'%label)
+        multi = engines.MultipleRequest()
+        multi.setup(token, root, subdir, query=query, singles=testitem)
+        openloop = OpenLoopSet(duration, workers)
+        openloop.load_batch(batch)
+        openloop.enable(multi.get, label)
+        openloop.run(rates)
+        openloop.save(os.path.join(outdir, 'openloop'))
+        for point in openloop.CURVE:
+            curves.append('%s\t%s'%(openloop.curve_row(point), label))
+    fname = os.path.join(outdir, 'openloop-summary.tsv')
+    with file(fname, 'w') as outfile:
+        outfile.write('%s\tEngine\n%s'%(CURVE_HEADER, '\n'.join(curves)))
+    logging.info('Saved to: %s'%fname)
+
+def command_line():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('-b', help='Batch file of items to send', dest='batch',
+                      default=os.path.join('batches', '5_econ5394.csv'))
+    parser.add_option('-r', help='Rates to send at, eg. 1,2,5 per second',
+                      dest='rates', default='1,2,5,10')
+    parser.add_option('-m', help='Ramp from, to and steps, eg. 1:20:5',
+                      dest='ramp', default='')
+    parser.add_option('-s', help='Seconds to send at each rate',
+                      dest='duration', default=30, type='int')
+    parser.add_option('-w', help='Most requests in flight at once',
+                      dest='workers', default=50, type='int')
+    parser.add_option('-q', help='Use the internal quick engine',
+                      dest='quick', default=False, action="store_true")
+    parser.add_option('-v', help='Enables info logging', dest='info',
+                      default=False, action="store_true")
+    (options, unused) = parser.parse_args()
+    if options.info:
+        logging.basicConfig(level=logging.INFO)
+    if options.ramp:
+        start, stop, steps = options.ramp.split(':')
+        options.rates = ramp(float(start), float(stop), int(steps))
+    else:
+        options.rates = [float(rate) for rate in options.rates.split(',')]
+    return options
+
+if __name__ == '__main__':
+    options = command_line()
+    if options.quick: # check the open loop without a server
+        openloop = OpenLoopSet(options.duration, options.workers)
+        openloop.load_batch(options.batch)
+        openloop.enable()
+        openloop.run(options.rates)
+        print openloop.result()
+    else:
+        run_engines(options.batch, options.rates, options.duration,
+                    options.workers, 'rowan')
@@ -0,0 +1,145 @@
+'''Run samples cold and warm, so cache effects are reported separately.'''
+import logging
+import subprocess
+import time
+
+import histogram # to merge the times of repeated passes
+
+# Statements that empty each of the caches MySQL and Piwik keep.
+MYSQL_COLD = {
+    'query-cache': ['RESET QUERY CACHE'],
+    'tables': ['FLUSH TABLES'],
+    'archives': [], # see MySQLHook.drop_archives
+}
+ARCHIVE_TABLES = 'piwik_archive_%'
+
+class CommandHook(object):
+    '''Run a shell command to make caches cold, eg. restart a server.'''
+    def __init__(self, command):
+        self.COMMAND = command
+
+    def __call__(self):
+        logging.info('Cold hook: %s'%self.COMMAND)
+        if subprocess.call(self.COMMAND, shell=True):
+            logging.warn('Cold hook failed: %s'%self.COMMAND)
+
+    def __str__(self):
+        return 'command %s'%self.COMMAND
+
+class MySQLHook(object):
+    '''Empty MySQL (and Piwik archive) caches before a cold pass.
+
+    What is one of MYSQL_COLD, settings are host, user, password and
+    database. Dropping archives makes Piwik archive reports again.
+    '''
+    def __init__(self, what, settings):
+        if what not in MYSQL_COLD:
+            raise ValueError('Unknown cold step: %s'%what)
+        self.WHAT = what
+        self.SETTINGS = settings
+
+    def __call__(self):
+        import MySQLdb # only needed when MySQL caches are emptied
+        host, user, password, database = self.SETTINGS
+        connection = MySQLdb.connect(host, user, password, database)
+        try:
+            cursor = connection.cursor()
+            statements = list(MYSQL_COLD[self.WHAT])
+            if self.WHAT == 'archives':
+                statements = self.drop_archives(cursor)
+            for statement in statements:
+                logging.info('Cold hook: %s'%statement)
+                cursor.execute(statement)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def drop_archives(self, cursor):
+        '''Return statements dropping each Piwik archive table.'''
+        cursor.execute("SHOW TABLES LIKE '%s'"%ARCHIVE_TABLES)
+        return ['DROP TABLE %s'%row[0] for row in cursor.fetchall()]
+
+    def __str__(self):
+        return 'mysql %s'%self.WHAT
+
+def cold_hook(spec, settings=None):
+    '''Return a hook from eg. query-cache, tables, archives or cmd:COMMAND.'''
+    if not spec:
+        return None
+    if spec.startswith('cmd:'):
+        return CommandHook(spec[4:])
+    if not settings:
+        raise ValueError('MySQL settings are needed for: %s'%spec)
+    return MySQLHook(spec, settings)
+
+class ColdWarm(object):
+    '''Run each sample cold, warm it up, then run it warm repeatedly.
+
+    With a cold hook the hook is called before each of the repeated cold
+    passes. Without one only the first pass is cold, ie. the first time
+    the engine sees the items. Warm up passes are not measured. Every
+    measured pass runs each item once, so each item is timed repeats
+    times cold and warm. The set then reports the mean warm time of each
+    item, see SampleSet.average_passes.
+    '''
+    def __init__(self, warmups=1, repeats=3, cold=None, pause_between=0):
+        self.WARMUPS = warmups
+        self.REPEATS = max(1, repeats)
+        self.COLD = cold # callable, see cold_hook
+        self.CACHES = list() # local caches to clear too, eg. engines.ResponseCache
+        self.PAUSE_BETWEEN = pause_between # seconds between passes
+
+    def cold_passes(self):
+        if self.COLD:
+            return self.REPEATS
+        return 1
+
+    def run_pass(self, sampleset, merged=None):
+        '''Run every item once, adding the times to merged if measured.'''
+        sampleset.run()
+        if merged is not None:
+            merged.merge(sampleset.HISTOGRAM)
+        if self.PAUSE_BETWEEN:
+            time.sleep(self.PAUSE_BETWEEN)
+
+    def run(self, sampleset):
+        '''Return histograms of the cold and warm times of sampleset.'''
+        cold = histogram.Histogram()
+        warm = histogram.Histogram()
+        for unused in range(self.cold_passes()):
+            for cache in self.CACHES:
+                cache.clear()
+            if self.COLD:
+                self.COLD()
+            self.run_pass(sampleset, cold)
+        for unused in range(self.WARMUPS):
+            self.run_pass(sampleset)
+        passes = list()
+        for unused in range(self.REPEATS):
+            self.run_pass(sampleset, warm)
+            passes.append(sampleset.RESULTS)
+        sampleset.average_passes(passes, warm) # so reports are of warm times
+        return cold, warm
+
+    def runall(self, sam):
+        '''Run all samples, saving them as Samples.runall does.
+
+        Returns histograms of the cold and warm times of all samples.
+        '''
+        cold = histogram.Histogram()
+        warm = histogram.Histogram()
+        for sample in sorted(sam.SAMPLES):
+            logging.info('Doing cold and warm: %s'%sample)
+            sampleset = sam.SAMPLES[sample]
+            sample_cold, sample_warm = self.run(sampleset)
+            fname = sam.report_name(sample)
+            sampleset.save(fname)
+            sample_cold.save('%s-%s-cold.hist'%(fname, sampleset.NAME))
+            cold.merge(sample_cold)
+            warm.merge(sample_warm)
+        return cold, warm
+
+    def __str__(self):
+        return 'Cold passes: %s (%s), warm ups: %s, warm passes: %s'%(
+                self.cold_passes(), self.COLD or 'first time', self.WARMUPS,
+                self.REPEATS)
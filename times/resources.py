@@ -0,0 +1,189 @@
+'''Sample processor, memory and IO use while tests are running.'''
+import logging
+import os
+import threading
+import time
+
+SAMPLE_HEADER = 'Time\tCPUBusy\tCPUTotal\tMemUsedKB\tReadBytes\tWriteBytes\tProcCPU\tProcRSSKB'
+PROCESSES = ('mysqld', 'php', 'php5', 'php-fpm', 'php5-fpm', 'apache2', 'httpd')
+SUMMARY_HEADER = 'CPUSecs\tProcCPUSecs\tReadBytes\tWriteBytes\tPeakMemKB\tPeakRSSKB'
+SECTOR = 512 # bytes in a sector as /proc/diskstats counts them
+
+def summary_row(found, name):
+    '''Return a summary table row for resources found by a sampler.'''
+    row = '%(cpu).1f\t%(proc_cpu).1f\t%(read)s\t%(written)s\t%(peak_mem)s\t%(peak_rss)s'
+    return '%s\t%s'%(row%found, name)
+
+class ResourceSampler(threading.Thread):
+    '''Read /proc at a fixed interval, keeping or streaming the series.
+
+    Each sample has the busy and total processor jiffies, memory used,
+    bytes read and written by disks, and the processor jiffies and
+    resident memory of processes with names like those given.
+    '''
+    def __init__(self, fname=None, interval=1.0, processes=PROCESSES,
+                 disks=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.FNAME = fname # stream samples here as they are taken
+        self.INTERVAL = interval # seconds between samples
+        self.PROCESSES = processes
+        self.SAMPLES = list()
+        self.STOP = threading.Event()
+        self.TICKS = float(os.sysconf('SC_CLK_TCK'))
+        self.DISKS = set(disks) if disks else self.disks()
+
+    def disks(self):
+        '''Return the names of physical whole disks.
+
+        Partitions are left out, and so are virtual devices such as
+        loop, dm-* and md*, which have no device link in /sys/block and
+        would count again the IO of the disks under them.
+        '''
+        try:
+            names = os.listdir('/sys/block')
+        except OSError:
+            return None # count every device
+        return set([name for name in names
+                    if os.path.exists(os.path.join('/sys/block', name, 'device'))])
+
+    def read_cpu(self):
+        '''Return busy and total processor jiffies.'''
+        with file('/proc/stat') as infile:
+            fields = [int(value) for value in infile.readline().split()[1:]]
+        idle = fields[3] + fields[4] # idle and iowait
+        return sum(fields)-idle, sum(fields)
+
+    def read_memory(self):
+        '''Return the memory used in kB, less buffers and cache.'''
+        found = dict()
+        with file('/proc/meminfo') as infile:
+            for line in infile:
+                name, value = line.split(':', 1)
+                found[name] = int(value.split()[0])
+        free = found['MemFree'] + found.get('Buffers', 0) + found.get('Cached', 0)
+        return found['MemTotal'] - free
+
+    def read_disks(self):
+        '''Return the bytes read and written by the disks.'''
+        read = 0
+        written = 0
+        with file('/proc/diskstats') as infile:
+            for line in infile:
+                fields = line.split()
+                if self.DISKS is not None and fields[2] not in self.DISKS:
+                    continue
+                read += int(fields[5])*SECTOR
+                written += int(fields[9])*SECTOR
+        return read, written
+
+    def read_processes(self):
+        '''Return jiffies used and resident kB of the processes watched.'''
+        jiffies = 0
+        resident = 0
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with file('/proc/%s/stat'%pid) as infile:
+                    stat = infile.read()
+                name = stat[stat.index('(')+1:stat.rindex(')')]
+                if not name.startswith(self.PROCESSES):
+                    continue
+                fields = stat[stat.rindex(')')+2:].split()
+                jiffies += int(fields[11]) + int(fields[12]) # utime, stime
+                resident += int(fields[21])*os.sysconf('SC_PAGE_SIZE')//1024
+            except (IOError, ValueError, IndexError): # it has gone
+                continue
+        return jiffies, resident
+
+    def sample(self):
+        '''Return a sample of resources in use now.'''
+        busy, total = self.read_cpu()
+        read, written = self.read_disks()
+        jiffies, resident = self.read_processes()
+        return (time.time(), busy, total, self.read_memory(), read, written,
+                jiffies, resident)
+
+    def run(self):
+        outfile = None
+        if self.FNAME:
+            outfile = file(self.FNAME, 'w')
+            outfile.write('%s\n'%SAMPLE_HEADER)
+        stopping = False
+        try:
+            while True:
+                sample = self.sample()
+                self.SAMPLES.append(sample)
+                if outfile:
+                    outfile.write('%s\n'%self.sample_row(sample))
+                    outfile.flush()
+                if stopping:
+                    break
+                stopping = self.STOP.wait(self.INTERVAL)
+        finally:
+            if outfile:
+                outfile.close()
+
+    def stop(self):
+        '''Stop sampling, taking a last sample first.'''
+        self.STOP.set()
+        self.join()
+
+    def sample_row(self, sample):
+        return '%.3f\t%s\t%s\t%s\t%s\t%s\t%s\t%s'%sample
+
+    def summary(self):
+        '''Return CPU seconds, read and written bytes, and peak kB used.'''
+        if len(self.SAMPLES) < 2:
+            return {'cpu': 0.0, 'proc_cpu': 0.0, 'read': 0, 'written': 0,
+                    'peak_mem': 0, 'peak_rss': 0, 'seconds': 0.0}
+        first, last = self.SAMPLES[0], self.SAMPLES[-1]
+        return {'cpu': (last[1]-first[1])/self.TICKS,
+                'proc_cpu': (last[6]-first[6])/self.TICKS,
+                'read': last[4]-first[4],
+                'written': last[5]-first[5],
+                'peak_mem': max([sample[3] for sample in self.SAMPLES]),
+                'peak_rss': max([sample[7] for sample in self.SAMPLES]),
+                'seconds': last[0]-first[0]}
+
+    def result(self):
+        '''Return a line summarising resources used.'''
+        found = self.summary()
+        return ('Resources: CPU %(cpu).1fs, watched processes CPU %(proc_cpu).1fs, '
+                'read %(read)s bytes, written %(written)s bytes, '
+                'peak memory %(peak_mem)s kB, peak RSS %(peak_rss)s kB, '
+                'over %(seconds).1fs'%found)
+
+    def __str__(self):
+        return self.result()
+
+def command_line():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('-o', help='File to stream samples to', dest='fname',
+                      default='resources.tsv')
+    parser.add_option('-i', help='Seconds between samples', dest='interval',
+                      default=1.0, type='float')
+    parser.add_option('-p', help='Names of processes to watch, eg. mysqld,php',
+                      dest='processes', default=','.join(PROCESSES))
+    parser.add_option('-d', help='Disks to count IO of, eg. sda,sdb, '
+                      'by default every physical disk', dest='disks', default='')
+    (options, unused) = parser.parse_args()
+    return options
+
+if __name__ == '__main__':
+    # Run as an agent on the server, eg. while run.py is testing it.
+    logging.basicConfig(level=logging.INFO)
+    options = command_line()
+    processes = tuple(options.processes.split(','))
+    disks = [name for name in options.disks.split(',') if name]
+    sampler = ResourceSampler(options.fname, options.interval, processes, disks)
+    sampler.start()
+    logging.info('Sampling to %s, press Ctrl-C to stop.'%options.fname)
+    try:
+        while sampler.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sampler.stop()
+    print sampler
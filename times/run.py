@@ -1,27 +1,74 @@
 '''Run all engines testing the samples.'''
+import collections
 import logging
+import multiprocessing
 import os
+import Queue
 import time
+import traceback
 
 import engines # how results are obtained
 import samples # what results are needed
 import sources # for multiple engines
+import resources # what the run used on this host
+import clock # phases of requests
+import standin # to run offline
+import history # to compare runs over time
+import protocol # to run samples cold and warm
+
+def _run_group(runner, testitem, runs, queue):
+    '''Run a group of sources in a child process, see Runner.run_groups.'''
+    name = multiprocessing.current_process().name
+    try:
+        queue.put((name, 'parts', runner.run_group(testitem, runs)))
+    except Exception:
+        queue.put((name, 'error', traceback.format_exc()))
 
 class Runner(object):
     '''Runs all the available engines.'''
-    def __init__(self, saveto, sample_limit=1, pause_between=1):
+    def __init__(self, saveto, sample_limit=1, pause_between=1, workers=1,
+                 concurrency='threads'):
         '''Prepare to run engines and save report to file specified.'''
         self.SAMPLE_LIMIT = sample_limit
         self.PAUSE_BETWEEN = pause_between
+        self.WORKERS = workers # items of a sample run at the same time
+        self.CONCURRENCY = concurrency # using threads, processes or async
         self.RESULT = list()
         self.DIV1 = '='*50
         self.DIV2 = '-'*50
         self.REPORT_SAVE = saveto
         self.REPORT_BY_SAMPLE = dict()
+        self.REPORT_BY_ENGINE = list() # name and histogram of each engine
+        self.REPORT_BY_PHASE = list() # name and phase totals of each engine
+        self.FRONTEND_HOST = None # eg. localhost:8080, see collate/frontend.py
+        self.FRONTEND_SOURCES = ('or-vdown', 'or-months', 'results-group', 'fe-batch')
+        self.FRONTEND_BATCH = 100 # items in each fe-batch request
+        self.MULTIPLE_BULK = (0,) # items per Piwik bulk request, 0 for none
+        self.SAMPLE_RESOURCES = True # record CPU, memory and IO during runs
+        self.RESOURCE_INTERVAL = 1.0 # seconds between resource samples
+        self.REPORT_RESOURCES = list() # name and resource summary of each engine
+        self.RESPONSE_CACHE = None # engines.ResponseCache in front of engines
+        self.STANDIN_HOST = None # eg. localhost:8090, used for every engine
+        self.HISTORY = None # history.ResultsHistory every run is added to
+        self.PROTOCOL = None # protocol.ColdWarm to run samples cold and warm
+        self.REPORT_COLD_WARM = list() # name, cold and warm times of each engine
+        self.PARALLEL_HOSTS = 1 # hosts whose multiple sources run at once
+        self.GROUP_POLL = 5 # seconds between checks that groups still run
+        
+    def new_engine(self):
+        '''Return the engine requests should use, None for the default.'''
+        engine = None
+        if self.CONCURRENCY == 'async':
+            engine = engines.AsyncEngine()
+        if self.RESPONSE_CACHE:
+            engine = engines.CachingEngine(engine, self.RESPONSE_CACHE)
+        return engine
         
     def run_engines(self, testitem=[]):
         '''Run all the available engines.'''
         self.save(header=True)
+        if self.HISTORY:
+            self.HISTORY.start_run(self.WORKERS, self.CONCURRENCY)
 
         # prepare storage for the report by sample
         sam = samples.Samples(self.SAMPLE_LIMIT, 1)
@@ -31,6 +78,8 @@ class Runner(object):
         
         self.run_engines_single(testitem)
         self.run_local_singles(testitem)
+        if self.FRONTEND_HOST:
+            self.run_frontend(testitem)
         self.run_engines_multiple(testitem)
         self.final_result()
     
@@ -39,37 +88,50 @@ class Runner(object):
         self.RESULT += '%s\nEnd summary.\n%s\n'%(self.DIV1, self.DIV1)
         self.RESULT += '\n%s\nResults by samples.\n%s\n\n'%(self.DIV1, self.DIV1)
         self.RESULT += self.report_samples()
+        self.RESULT += '\n%s\nResults by engines.\n%s\n\n'%(self.DIV1, self.DIV1)
+        self.RESULT += self.report_engines()
+        if self.PROTOCOL:
+            self.RESULT += '\n%s\nCold and warm by engines.\n%s\n\n'%(self.DIV1, self.DIV1)
+            self.RESULT += self.report_cold_warm()
+        self.RESULT += '\n%s\nPhases by engines.\n%s\n\n'%(self.DIV1, self.DIV1)
+        self.RESULT += self.report_phases()
+        if self.REPORT_RESOURCES:
+            self.RESULT += '\n%s\nResources by engines.\n%s\n\n'%(self.DIV1, self.DIV1)
+            self.RESULT += self.report_engine_resources()
+        if self.RESPONSE_CACHE:
+            self.RESULT += '\n%s\n'%self.report_cache()
+            self.RESPONSE_CACHE.save()
         self.RESULT += '\n%s\nEnd results.\n%s\n'%(self.DIV1, self.DIV1)
         self.save()
         
     def run_engines_single(self, testitem):
         '''Run engines that can get data with a single request.'''
-        singles  = engines.SingleRequest()
+        singles  = engines.SingleRequest(self.new_engine())
         for source in singles.SOURCES:
             logging.info('Running engine: %s'%source) 
             self.log('\n%s\n%s\n'%(source, self.DIV2))
             self.log(self.report_time('Start: '))
             
-            singles.setup(source, singlecode=testitem)
+            singles.setup(source, self.STANDIN_HOST, testitem)
             sam = samples.Samples(self.SAMPLE_LIMIT, 1)
-            sam.enable(singles.get, source)
-            sam.runall()
-            sam.save()
+            sam.enable(singles.get, source, self.WORKERS, self.CONCURRENCY)
+            sampler = self.runall(sam, source, singles.URL_ROOT)
             
-            for sample in sam.SAMPLES: # put samples together
-                content = sam.summary_sample(sample, source)
-                self.REPORT_BY_SAMPLE[sample].append(content)
+            self.collate(sam, source)
             
             self.log(self.report_time('Finish: '))
             self.log('%s\n'%self.DIV2)
             self.log(sam.summary_table())
-            self.log('\n%s\n'%self.DIV2)
+            self.log('\n%s\n'%self.report_connections(singles.URL_ROOT))
+            self.log(self.report_cache())
+            self.log(self.report_resources(sampler))
+            self.log('%s\n'%self.DIV2)
             self.save()
             self.RESULT = list()
             time.sleep(self.PAUSE_BETWEEN)
     
     def run_local_singles(self, testitem):
-        host = "HOST"
+        host = self.STANDIN_HOST or "HOST"
         source = 'results-get'
         self.single_resultrun(testitem, source, host)
         source = 'results-group'
@@ -77,57 +139,253 @@ class Runner(object):
         
     def single_resultrun(self, testitem, source, host):
         '''Do a single customised test using results-get'''
-        singles = engines.SingleRequest()
+        singles = engines.SingleRequest(self.new_engine())
         singles.setup(source, host, testitem)
         sam = samples.Samples(self.SAMPLE_LIMIT, 1)
-        sam.enable(singles.get, source)
-        sam.runall()
+        sam.enable(singles.get, source, self.WORKERS, self.CONCURRENCY)
+        self.runall(sam, source, singles.URL_ROOT)
+        self.collate(sam, source)
+    
+    def run_frontend(self, testitem):
+        '''Run the URLs the cache front-end answers as other sources.'''
+        for source in self.FRONTEND_SOURCES:
+            label = 'fe_%s'%source
+            logging.info('Running engine: %s'%label)
+            singles = engines.SingleRequest(self.new_engine())
+            singles.setup(source, self.FRONTEND_HOST, testitem)
+            sam = samples.Samples(self.SAMPLE_LIMIT, 1)
+            if source == 'fe-batch': # many items with each request
+                sam.enable(singles.get, label, self.FRONTEND_BATCH, 'async')
+            else:
+                sam.enable(singles.get, label, self.WORKERS, self.CONCURRENCY)
+            self.runall(sam, label, singles.URL_ROOT, source)
+            self.collate(sam, label)
+        
+    def runall(self, sam, name, host='', source='', query=''):
+        '''Run and save the samples, sampling resources used meanwhile.
+        
+        The host, source and query the engine used are kept with the
+        times in the history, if there is one.
+        '''
+        sampler = None
+        if self.SAMPLE_RESOURCES:
+            fname = os.path.join(samples.output_dir(), 'resources-%s.tsv'%name)
+            sampler = resources.ResourceSampler(fname, self.RESOURCE_INTERVAL)
+            sampler.start()
+        try:
+            if self.PROTOCOL:
+                cold, warm = self.PROTOCOL.runall(sam)
+                self.REPORT_COLD_WARM.append((name, cold, warm))
+            else:
+                sam.runall()
+        finally:
+            if sampler:
+                sampler.stop()
         sam.save()
-        for sample in sam.SAMPLES: # put samples together
-            content = sam.summary_sample(sample, source)
+        if sampler:
+            self.REPORT_RESOURCES.append((name, sampler.summary()))
+        if self.HISTORY:
+            self.HISTORY.add_engine(sam, name, host, source, query)
+        return sampler
+        
+    def collate(self, sam, name):
+        '''Put the results of samples run by the engine name together.'''
+        for sample in sam.SAMPLES:
+            content = sam.summary_sample(sample, name)
             self.REPORT_BY_SAMPLE[sample].append(content)
-    
+        self.REPORT_BY_ENGINE.append((name, sam.histogram()))
+        self.REPORT_BY_PHASE.append((name, sam.phases()))
+        
     def multiple_sources(self):
         '''Return a tuple of of which multiple sources to test.'''
         ms = sources.PiwiEngines()
+        if self.STANDIN_HOST:
+            ms.enable_standin(self.STANDIN_HOST)
+            return ms.SOURCES
         return ms.get_sources()
         
+    def multiple_runs(self):
+        '''Return the autosort number, source and bulk size of each run.'''
+        runs = [(source, bulk) for source in self.multiple_sources()
+                for bulk in self.MULTIPLE_BULK]
+        return [(11+number, source, bulk)
+                for number, (source, bulk) in enumerate(runs)]
+        
+    def host_groups(self, runs):
+        '''Return lists of the runs of sources sharing a host.'''
+        groups = collections.OrderedDict()
+        for run in runs:
+            groups.setdefault(run[1][2], list()).append(run)
+        return groups.values()
+        
     def run_engines_multiple(self, testitem):
         '''Run engines that need to get data with a multiple requests.'''
-        sources = self.multiple_sources()
-        autosort = 10
-        for source in sources:
-            autosort += 1
-            name = source[0]
-            token = source[1]
-            root = source[2]
-            subdir = source[3]
-            query = source[4]
-            label = '%s_%s'%(name, query)
-            
-            logging.info('Running engine: %s'%label) 
-            self.log('\n%s\n%s\n'%(name, self.DIV2))
-            self.log(self.report_time('Start: '))
-            
-            multi = engines.MultipleRequest()
-            multi.setup(token, root, subdir, query=query, singles=testitem)
-            sam = samples.Samples(self.SAMPLE_LIMIT, 1)
-            
-            sam.enable(multi.get, 's%s_%s'%(autosort, label))
-            sam.runall()
-            sam.save()
-            
-            for sample in sam.SAMPLES: # put samples together
-                content = sam.summary_sample(sample, label)
-                self.REPORT_BY_SAMPLE[sample].append(content)
-            
-            self.log(self.report_time('Finish: '))
-            self.log('%s\n'%self.DIV2)
-            self.log(sam.summary_table())
-            self.log('\n%s\n'%self.DIV2)
+        runs = self.multiple_runs()
+        groups = self.host_groups(runs)
+        if self.PARALLEL_HOSTS > 1 and len(groups) > 1:
+            return self.run_groups(testitem, groups)
+        for autosort, source, bulk in runs:
+            self.run_multiple(testitem, autosort, source, bulk)
             self.save()
             self.RESULT = list()
             time.sleep(self.PAUSE_BETWEEN)
+            
+    def run_multiple(self, testitem, autosort, source, bulk):
+        '''Run an engine using a multiple source with bulk items a request.'''
+        name = source[0]
+        token = source[1]
+        root = source[2]
+        subdir = source[3]
+        query = source[4]
+        label = '%s_%s'%(name, query)
+        if bulk:
+            label = '%s_bulk%s'%(label, bulk)
+        
+        logging.info('Running engine: %s'%label) 
+        self.log('\n%s\n%s\n'%(name, self.DIV2))
+        self.log(self.report_time('Start: '))
+        
+        multi = engines.MultipleRequest(self.new_engine())
+        multi.setup(token, root, subdir, query=query, singles=testitem,
+                    bulk=bulk)
+        sam = samples.Samples(self.SAMPLE_LIMIT, 1)
+        
+        if bulk > 1: # so get_many is given enough items for each request
+            sam.enable(multi.get, 's%s_%s'%(autosort, label), bulk, 'async')
+        else:
+            sam.enable(multi.get, 's%s_%s'%(autosort, label), self.WORKERS,
+                       self.CONCURRENCY)
+        sampler = self.runall(sam, label, root, name, query)
+        
+        self.collate(sam, label)
+        
+        self.log(self.report_time('Finish: '))
+        self.log('%s\n'%self.DIV2)
+        self.log(sam.summary_table())
+        self.log('\n%s\n'%self.report_connections(root))
+        self.log(self.report_cache())
+        self.log(self.report_resources(sampler))
+        self.log('%s\n'%self.DIV2)
+        
+    def run_groups(self, testitem, groups):
+        '''Run groups of sources at the same time, a process for each host.
+        
+        Sources sharing a host run one after another, so they do not slow
+        each other down. What each run found is merged in the order of the
+        runs, so reports do not depend on which host finished first.
+        '''
+        kept = self.HISTORY # children keep theirs to be added here
+        if kept:
+            self.HISTORY = history.PendingHistory()
+        queue = multiprocessing.Queue()
+        parts = list()
+        try:
+            for start in range(0, len(groups), self.PARALLEL_HOSTS):
+                processes = [multiprocessing.Process(target=_run_group,
+                             args=(self, testitem, runs, queue))
+                             for runs in groups[start:start+self.PARALLEL_HOSTS]]
+                logging.info('Running %s hosts at once'%len(processes))
+                for process in processes:
+                    process.start()
+                try:
+                    parts += self.wait_parts(queue, processes)
+                except:
+                    for process in processes:
+                        process.terminate()
+                    raise
+                finally:
+                    for process in processes:
+                        process.join()
+        finally:
+            self.HISTORY = kept
+        for autosort, part in sorted(parts, key=lambda part: part[0]):
+            self.merge_part(part)
+            
+    def wait_parts(self, queue, processes):
+        '''Return the parts the processes post, before they are joined so
+        pipes drain. Raises RuntimeError if one fails or dies silently.'''
+        parts = list()
+        posted = set()
+        dead = set() # exited without posting when last checked
+        while len(posted) < len(processes):
+            try:
+                name, found, answer = queue.get(timeout=self.GROUP_POLL)
+            except Queue.Empty:
+                gone = set([process.name for process in processes
+                            if not process.is_alive()]) - posted
+                for process in processes: # dead twice, so nothing is coming
+                    if process.name in gone & dead:
+                        raise RuntimeError('Sources stopped with exit code %s: %s'%(
+                                           process.exitcode, process.name))
+                dead = gone
+                continue
+            if found == 'error':
+                raise RuntimeError('Sources failed:\n%s'%answer)
+            posted.add(name)
+            parts += answer
+        return parts
+        
+    def run_group(self, testitem, runs):
+        '''Run sources sharing a host, returning what each run found.'''
+        parts = list()
+        for autosort, source, bulk in runs:
+            self.start_part()
+            self.run_multiple(testitem, autosort, source, bulk)
+            parts.append((autosort, self.part()))
+            time.sleep(self.PAUSE_BETWEEN)
+        return parts
+        
+    def start_part(self):
+        '''Forget what was found so far, so a part has a single run.'''
+        self.RESULT = list()
+        self.REPORT_BY_SAMPLE = dict((sample, list())
+                                     for sample in self.REPORT_BY_SAMPLE)
+        self.REPORT_BY_ENGINE = list()
+        self.REPORT_BY_PHASE = list()
+        self.REPORT_RESOURCES = list()
+        self.REPORT_COLD_WARM = list()
+        if self.HISTORY:
+            self.HISTORY = history.PendingHistory()
+        
+    def part(self):
+        '''Return what was found since start_part, to merge_part elsewhere.'''
+        return {
+            'result': ''.join(self.RESULT),
+            'by_sample': self.REPORT_BY_SAMPLE,
+            'by_engine': self.REPORT_BY_ENGINE,
+            'by_phase': self.REPORT_BY_PHASE,
+            'resources': self.REPORT_RESOURCES,
+            'cold_warm': self.REPORT_COLD_WARM,
+            'history': self.HISTORY,
+        }
+        
+    def merge_part(self, part):
+        '''Add what a run in another process found to this run.'''
+        self.save(content=part['result'])
+        for sample, contents in part['by_sample'].items():
+            self.REPORT_BY_SAMPLE[sample] += contents
+        self.REPORT_BY_ENGINE += part['by_engine']
+        self.REPORT_BY_PHASE += part['by_phase']
+        self.REPORT_RESOURCES += part['resources']
+        self.REPORT_COLD_WARM += part['cold_warm']
+        if self.HISTORY and part['history']:
+            self.HISTORY.add_pending(part['history'])
+        
+    def report_connections(self, host):
+        '''Return how many connections to host were new or reused so far.'''
+        return engines.POOL.report(host)
+        
+    def report_cache(self):
+        '''Return how well the response cache has done so far, if used.'''
+        if not self.RESPONSE_CACHE:
+            return ''
+        return '%s\n'%self.RESPONSE_CACHE.report()
+        
+    def report_resources(self, sampler):
+        '''Return the resources used while an engine ran, if sampled.'''
+        if not sampler:
+            return ''
+        return '%s\n'%sampler.result()
         
     def report_time(self, prefix=''):
         when = time.strftime('%y-%m-%d at %H:%M:%S', time.gmtime())
@@ -138,11 +396,48 @@ class Runner(object):
         result = list()
         for sample in self.REPORT_BY_SAMPLE:
             result.append(sample)
-            result.append('TMins\tTSecs\tTAverage\tTest run')
+            result.append('%s\tTest run'%samples.SUMMARY_HEADER)
             for part in self.REPORT_BY_SAMPLE[sample]:
                 result.append(part)
             result.append('')
         return '\n'.join(result)
+    
+    def report_engines(self):
+        '''Return a string with the times of all samples for each engine.'''
+        result = list()
+        result.append('%s\tTest run'%samples.SUMMARY_HEADER)
+        for name, times in self.REPORT_BY_ENGINE:
+            result.append(samples.summary_histogram(times, name))
+        return '\n'.join(result)
+        
+    def report_cold_warm(self):
+        '''Return a string with the cold and warm times of each engine.'''
+        result = list()
+        result.append('%s'%self.PROTOCOL)
+        result.append('%s\tTest run'%samples.SUMMARY_HEADER)
+        for name, cold, warm in self.REPORT_COLD_WARM:
+            result.append(samples.summary_histogram(cold, '%s cold'%name))
+            result.append(samples.summary_histogram(warm, '%s warm'%name))
+        return '\n'.join(result)
+        
+    def report_phases(self):
+        '''Return a string with the average phases of requests by engine.'''
+        result = list()
+        result.append('%s\tItems\tTest run'%clock.PHASE_HEADER)
+        for name, (totals, count) in self.REPORT_BY_PHASE:
+            if not count: # engine did not time phases, eg. async
+                continue
+            averages = '\t'.join(samples.phase_averages(totals, count))
+            result.append('%s\t%s\t%s'%(averages, count, name))
+        return '\n'.join(result)
+        
+    def report_engine_resources(self):
+        '''Return a string with the resources used by each engine.'''
+        result = list()
+        result.append('%s\tTest run'%resources.SUMMARY_HEADER)
+        for name, found in self.REPORT_RESOURCES:
+            result.append(resources.summary_row(found, name))
+        return '\n'.join(result)
         
     def log(self, message):
         self.RESULT.append(message)
@@ -156,6 +451,13 @@ class Runner(object):
             content += '-Each sample, the time taken in minutes is first.\n'
             content += '-For a small sample time in seconds is a better measure.\n'
             content += '-Average time to get results for each item in sample.\n'
+            content += '-Then percentiles, maximum and standard deviation of times.\n'
+            content += '-Errors is the number of items the engine failed to get.\n'
+            if self.PROTOCOL:
+                content += '-Times are of warm passes, cold ones are at the end.\n'
+            content += '-Phases split the average time into connecting, writing the\n'
+            content += ' request, waiting for the first byte, reading and parsing.\n'
+            content += '-Resources are CPU, IO and peak memory of this host meanwhile.\n'
             content += '-The name of the sample contains the sample size.\n'
             content += '%s\n%s'%(self.DIV1,self.report_time('Generated: '))
         else:
@@ -174,6 +476,40 @@ def command_line():
                       default=False, action="store_true")
     parser.add_option('-v', help='Enables info logging', dest='info', 
                       default=False, action="store_true")
+    parser.add_option('-w', help='Number of items to run at the same time',
+                      dest='workers', default=1, type='int')
+    parser.add_option('-p', help='Run workers as processes not threads',
+                      dest='processes', default=False, action="store_true")
+    parser.add_option('-a', help='Keep workers requests in flight with asyncore',
+                      dest='asynchronous', default=False, action="store_true")
+    parser.add_option('-f', help='Also test the cache front-end at host:port',
+                      dest='frontend', default=None)
+    parser.add_option('-b', help='Piwik bulk request sizes to compare, eg. 0,1,20',
+                      dest='bulk', default='0')
+    parser.add_option('-t', help='Cache responses for this many seconds',
+                      dest='cache_ttl', default=0, type='int')
+    parser.add_option('-s', help='Most responses to cache',
+                      dest='cache_size', default=10000, type='int')
+    parser.add_option('-k', help='File to keep cached responses in between runs',
+                      dest='cache_file', default=None)
+    parser.add_option('-l', help='Run every engine against a local stand-in '
+                      'with latency, eg. lognormal:0.1:0.5', dest='standin',
+                      default=None)
+    parser.add_option('-H', help='SQLite file to add the run to, none to not keep it',
+                      dest='history', default=history.HISTORY_FILE)
+    parser.add_option('-R', help='Times to run each item cold and warm',
+                      dest='repeats', default=0, type='int')
+    parser.add_option('-W', help='Warm up passes before warm times are taken',
+                      dest='warmups', default=1, type='int')
+    parser.add_option('-C', help='Make caches cold with query-cache, tables, '
+                      'archives or cmd:COMMAND', dest='cold', default=None)
+    parser.add_option('-M', help='MySQL host,user,password,database for -C',
+                      dest='mysql', default=None)
+    parser.add_option('-g', help='Hosts whose Piwik sources run at the same '
+                      'time, sources sharing a host always run in turn',
+                      dest='hosts', default=1, type='int')
+    parser.add_option('-n', help='Do not sample CPU, memory and IO use',
+                      dest='noresources', default=False, action="store_true")
     (options, unused) = parser.parse_args()
     if options.debug:
         logging.basicConfig(level=logging.DEBUG)
@@ -181,15 +517,50 @@ def command_line():
         logging.basicConfig(level=logging.INFO)
     else:
         logging.warn('Running engines, showing warnings only.')
+    return options
     
 if __name__ == '__main__':
-    command_line()    
+    options = command_line()
+    concurrency = 'threads'
+    if options.processes:
+        concurrency = 'processes'
+    elif options.asynchronous:
+        concurrency = 'async'
+    server = None
+    if options.standin: # serve results and the API from this process
+        latency = standin.latency_model(options.standin)
+        server = standin.StandIn(('127.0.0.1', 0), latency, latency)
+        server.start()
     e = engines.Engine()
+    if server:
+        e.connect(server.address())
     preload1 = e.get('/results/dv/8b/0b/6cac-e205-41d9-a9f8-f0ca39f6b7eb').read()
     preload2 = e.get('/results/dv/53/2d/3978-9c85-4dc3-a6f7-73b3bd1814f3').read()
     print preload1.strip(), preload2.strip()
     
     report = os.path.join(os.getcwd(),'reports','summary_engines.txt') 
-    r = Runner(report, 2)
+    r = Runner(report, 2, workers=options.workers, concurrency=concurrency)
+    r.FRONTEND_HOST = options.frontend
+    r.MULTIPLE_BULK = [int(size) for size in options.bulk.split(',')]
+    r.SAMPLE_RESOURCES = not options.noresources
+    r.PARALLEL_HOSTS = options.hosts
+    if server:
+        r.STANDIN_HOST = server.address()
+    if options.cache_ttl:
+        r.RESPONSE_CACHE = engines.ResponseCache(options.cache_ttl,
+                                    options.cache_size, options.cache_file)
+    if options.repeats or options.cold:
+        settings = None
+        if options.mysql:
+            settings = options.mysql.split(',')
+        hook = protocol.cold_hook(options.cold, settings)
+        r.PROTOCOL = protocol.ColdWarm(options.warmups, options.repeats or 1, hook)
+        if r.RESPONSE_CACHE:
+            r.PROTOCOL.CACHES.append(r.RESPONSE_CACHE)
+    if options.history != 'none':
+        r.HISTORY = history.ResultsHistory(options.history)
     r.run_engines('rowan')
+    if server:
+        engines.POOL.clear() # so the stand-in can finish its connections
+        server.shutdown()
     
@@ -4,20 +4,182 @@ import glob
 import time
 import random
 import os
+import threading # to run items concurrently
+import Queue
+import multiprocessing
+import array # compact storage for many items
+
+import histogram # to summarise the spread of times
+import clock # phases of requests
 
 QUICK_MAX = 0.5 # maximum time quick engine can pretend to take
+CONCURRENCY_MODES = ('threads', 'processes', 'async')
+ERROR_MARKS = ('e', 'n') # results starting with these failed, eg. e0;e0
+SUMMARY_HEADER = 'TMins\tTSecs\tTAverage\tP50\tP90\tP99\tMax\tStdev\tErrors'
+
+# Each worker process gets its own copy of the engine, see run_processes.
+_PROCESS_SET = None
+_PROCESS_ENGINE = None
+
+# Batches are read once and shared by every SampleSet, see batch.
+_BATCHES = dict()
+_BATCHES_LOCK = threading.Lock()
+
+def output_dir():
+    '''Return the location reports should be output to.'''
+    outdir = os.path.join(os.getcwd(),'reports')
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    return outdir
+
+def summary_histogram(times, name):
+    '''Return a summary table row for a histogram of times.'''
+    t = '%.1f'%times.TOTAL
+    a = '%.3f'%times.average()
+    m = '%.1f'%(times.TOTAL/60)
+    spread = '\t'.join(times.summary())
+    return '%s\t%s\t%s\t%s\t%s'%(m, t, a, spread, name)
+
+def phase_averages(totals, count):
+    '''Return the average time of each phase as strings.'''
+    count = max(1, count)
+    return ['%.4f'%(totals[phase]/count) for phase in clock.PHASES]
+
+def _process_setup(sampleset):
+    '''Prepare a worker process to run items from sampleset.'''
+    global _PROCESS_SET, _PROCESS_ENGINE
+    _PROCESS_SET = sampleset
+    _PROCESS_ENGINE = sampleset.worker_engine()
+
+def _process_item(index):
+    '''Run an item in a worker process, returning what is needed to store it.'''
+    item = _PROCESS_SET.ITEMS[index]
+    result, took = _PROCESS_SET.run_item(_PROCESS_ENGINE, item)
+    return index, result, took, _PROCESS_SET.item_phases(_PROCESS_ENGINE)
+
+def batch(fname):
+    '''Return the shared Batch for the file fname.'''
+    key = os.path.abspath(fname)
+    with _BATCHES_LOCK:
+        if key not in _BATCHES:
+            _BATCHES[key] = Batch(fname)
+        return _BATCHES[key]
+
+class Batch(object):
+    '''Read only sequence of the items in a batch file.
+
+    The file is only read when the items are first needed, then kept as
+    one string with the offsets of each item, so a batch of millions of
+    codes takes little more memory than the file. Blank lines are skipped
+    and an item repeated in the file is only kept once, as before.
+    '''
+    def __init__(self, fname=None, lines=None):
+        self.FNAME = fname
+        self.CONTENT = None # text of the file
+        self.STARTS = None # offsets in CONTENT where each item starts
+        self.ENDS = None # and ends
+        self.LOCK = threading.Lock()
+        if lines is not None:
+            self.parse('\n'.join([str(line).strip() for line in lines]))
+
+    def loaded(self):
+        '''Read the file if that has not been done yet.'''
+        if self.CONTENT is None:
+            with self.LOCK:
+                if self.CONTENT is None:
+                    with file(self.FNAME) as infile:
+                        self.parse(infile.read())
+                    logging.debug('Items read: %s from %s'%(len(self.STARTS),
+                                  self.FNAME))
+        return self
+
+    def parse(self, content):
+        '''Find where each item in content starts and ends.'''
+        starts = array.array('L')
+        ends = array.array('L')
+        seen = set() # only while parsing
+        place = 0
+        size = len(content)
+        while place < size:
+            end = content.find('\n', place)
+            if end < 0:
+                end = size
+            start, finish = place, end
+            while start < finish and content[start].isspace():
+                start += 1
+            while finish > start and content[finish-1].isspace():
+                finish -= 1
+            if finish > start and content[start:finish] not in seen:
+                seen.add(content[start:finish])
+                starts.append(start)
+                ends.append(finish)
+            place = end+1
+        self.STARTS, self.ENDS = starts, ends
+        self.CONTENT = content
+
+    def __len__(self):
+        return len(self.loaded().STARTS)
+
+    def __getitem__(self, index):
+        self.loaded()
+        return self.CONTENT[self.STARTS[index]:self.ENDS[index]]
+
+    def __iter__(self):
+        self.loaded()
+        for index in xrange(len(self.STARTS)):
+            yield self.CONTENT[self.STARTS[index]:self.ENDS[index]]
+
+class SampleResults(object):
+    '''Result, time taken and phases of each item of one run of a batch.
+
+    Kept apart from the Batch, which is shared, and stored by the
+    position of the item to avoid a dict for each.
+    '''
+    def __init__(self, size):
+        self.RESULTS = [''] * size
+        self.TOOK = array.array('d', [0.0]) * size
+        self.PHASES = None # phase: array of times, once an engine gives them
+        self.TIMED = array.array('B', [0]) * size # 1 where phases were timed
+        self.LOCK = threading.Lock()
+
+    def store(self, index, result, took, phases=None):
+        self.RESULTS[index] = result
+        self.TOOK[index] = took
+        if phases and clock.timed(phases):
+            if self.PHASES is None:
+                with self.LOCK:
+                    if self.PHASES is None:
+                        size = len(self.TOOK)
+                        self.PHASES = dict([(phase, array.array('d', [0.0])*size)
+                                            for phase in clock.PHASES])
+            for phase in clock.PHASES:
+                self.PHASES[phase][index] = phases.get(phase, 0.0)
+            self.TIMED[index] = 1
+
+    def phases(self, index):
+        '''Return the phases of the item at index, empty if not timed.'''
+        if self.PHASES is None or not self.TIMED[index]:
+            return dict()
+        return dict([(phase, self.PHASES[phase][index]) for phase in clock.PHASES])
 
 class SampleSet(object):
     '''Set of items to get results from engine and gather timings.'''
-    def __init__(self):
-        self.ITEMS = dict() # store the items
+    def __init__(self, items=None):
+        if items is None:
+            items = Batch(lines=[])
+        self.ITEMS = items # the items, a Batch shared with other sets
+        self.RESULTS = SampleResults(0) # of the last run, see store
         self.ENGINE = None # engine to query, a method or function
         self.NAME = None # name of sample
-        self.KRESULT = 'result' # keys to store data
-        self.KTOOK = 'took'
         self.TIME_TOTAL = 0
         self.TIME_AVERAGE = 0
         self.TIME_MINUTES = 0
+        self.TIME_WALL = 0 # differs from total when items run concurrently
+        self.HISTOGRAM = histogram.Histogram() # spread of times taken
+        self.PHASE_TOTALS = clock.no_phases() # of items the engine timed
+        self.PHASE_COUNT = 0
+        self.WORKERS = 1 # number of items to run at the same time
+        self.CONCURRENCY = CONCURRENCY_MODES[0] # how workers are run
         
     def test_engine_quick(self, scode):
         '''Get results for scode using random values.'''
@@ -28,44 +190,193 @@ class SampleSet(object):
 
     def load(self, lines):
         '''Extract items to query from lines.'''
-        for scode in lines:
-            cleaned = str(scode).strip()
-            self.ITEMS[cleaned] = {self.KRESULT:str(), self.KTOOK:0}
+        self.ITEMS = Batch(lines=lines)
+        self.RESULTS = SampleResults(0)
     
-    def enable(self, engine=None, name=None):
-        '''Setup engine to query and give it a name.'''
+    def enable(self, engine=None, name=None, workers=1, concurrency='threads'):
+        '''Setup engine to query and give it a name.
+        
+        When workers is more than 1 the items are shared out between
+        that many threads or processes, each using its own copy of the
+        engine (see worker_engine). With async, workers is the number of
+        items in flight at once using the get_many of the engine.
+        '''
         if not engine:
             engine = self.test_engine_quick
         if not name:
             name = 'quick'
+        if concurrency not in CONCURRENCY_MODES:
+            raise ValueError
         self.ENGINE = engine
         self.NAME = name
+        self.WORKERS = max(1, int(workers))
+        self.CONCURRENCY = concurrency
+        
+    def worker_engine(self):
+        '''Return a copy of the engine for use by a single worker.
+        
+        Engines that keep a connection (SingleRequest, MultipleRequest)
+        provide a clone method, others are assumed safe to share.
+        '''
+        owner = getattr(self.ENGINE, 'im_self', None)
+        if owner is not None and hasattr(owner, 'clone'):
+            return getattr(owner.clone(), self.ENGINE.__name__)
+        return self.ENGINE
         
     def run(self):
         '''Run items against the engine getting results and time taken.'''
         logging.debug('Using engine: %s'%self.ENGINE)
-        for item in self.ITEMS:
-            istart = time.time()
-            self.ITEMS[item][self.KRESULT], etime = self.ENGINE(item)
-            iend = time.time()
-            if etime: # enable engine to return time taken
-                time_taken = etime
-            else:
-                time_taken = iend-istart
-            self.ITEMS[item][self.KTOOK] = time_taken 
+        self.RESULTS = SampleResults(len(self.ITEMS))
+        wstart = time.time()
+        if self.WORKERS == 1 or len(self.ITEMS) < 2:
+            self.run_serial()
+        elif self.CONCURRENCY == 'processes':
+            self.run_processes()
+        elif self.CONCURRENCY == 'async':
+            self.run_async()
+        else:
+            self.run_threads()
+        self.TIME_WALL = '%.1f'%(time.time()-wstart)
         self.calc_times()
         logging.info('Total time: %s'%self.TIME_TOTAL)
         logging.info('Average time: %s'%self.TIME_AVERAGE)
+        logging.info('Wall clock time: %s'%self.TIME_WALL)
+        
+    def run_item(self, engine, item):
+        '''Return the result and time taken to run item against engine.'''
+        istart = time.time()
+        result, etime = engine(item)
+        iend = time.time()
+        if etime: # enable engine to return time taken
+            return result, etime
+        return result, iend-istart
+    
+    def item_phases(self, engine):
+        '''Return the phases of the item engine last ran, if it kept them.
+        
+        Engines timing the phases of requests (SingleRequest,
+        MultipleRequest) keep them in PHASES, see clock.PHASES.
+        '''
+        owner = getattr(engine, 'im_self', None)
+        return dict(getattr(owner, 'PHASES', None) or {})
+    
+    def store(self, index, result, took, phases=None):
+        '''Keep the result, time taken and phases timed for item at index.'''
+        self.RESULTS.store(index, result, took, phases)
+        
+    def items(self):
+        '''Yield the item, result, time taken and phases of each item.'''
+        results = self.RESULTS
+        for index, item in enumerate(self.ITEMS):
+            if index >= len(results.TOOK): # not run yet
+                yield item, '', 0.0, dict()
+            else:
+                yield (item, results.RESULTS[index], results.TOOK[index],
+                       results.phases(index))
+        
+    def run_serial(self):
+        '''Run items one at a time.'''
+        for index, item in enumerate(self.ITEMS):
+            result, took = self.run_item(self.ENGINE, item)
+            self.store(index, result, took, self.item_phases(self.ENGINE))
+            
+    def run_threads(self):
+        '''Run items using a pool of threads, one engine per thread.'''
+        todo = Queue.Queue()
+        for index in xrange(len(self.ITEMS)):
+            todo.put(index)
+        workers = list()
+        for unused in range(min(self.WORKERS, len(self.ITEMS))):
+            worker = threading.Thread(target=self.run_worker,
+                                      args=(self.worker_engine(), todo))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+            
+    def run_worker(self, engine, todo):
+        '''Run items from the todo queue until it is empty.'''
+        while True:
+            try:
+                index = todo.get_nowait()
+            except Queue.Empty:
+                return
+            result, took = self.run_item(engine, self.ITEMS[index])
+            self.store(index, result, took, self.item_phases(engine))
+            
+    def run_async(self):
+        '''Run items in batches using the get_many of the engine.'''
+        owner = getattr(self.ENGINE, 'im_self', None)
+        if not hasattr(owner, 'get_many'):
+            logging.warn('Engine has no get_many, running items serially.')
+            return self.run_serial()
+        count = len(self.ITEMS)
+        for start in xrange(0, count, self.WORKERS):
+            indexes = xrange(start, min(count, start+self.WORKERS))
+            items = [self.ITEMS[index] for index in indexes]
+            for index, (result, took) in zip(indexes, owner.get_many(items)):
+                self.store(index, result, took)
+            
+    def run_processes(self):
+        '''Run items using a pool of processes, one engine per process.'''
+        workers = min(self.WORKERS, len(self.ITEMS))
+        pool = multiprocessing.Pool(workers, _process_setup, (self,))
+        try:
+            for index, result, took, phases in pool.imap_unordered(
+                                _process_item, xrange(len(self.ITEMS)), 100):
+                self.store(index, result, took, phases)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
 
     def calc_times(self):
         '''Return the total and average times for this set.'''
-        totaltime = 0.0
-        for item in self.ITEMS:
-            totaltime += self.ITEMS[item][self.KTOOK]
-        avetime = totaltime/len(self.ITEMS)
+        results = self.RESULTS
+        self.HISTOGRAM = histogram.Histogram()
+        for result, took in zip(results.RESULTS, results.TOOK):
+            self.HISTOGRAM.record(took, self.is_error(result))
+        totaltime = sum(results.TOOK)
+        self.PHASE_TOTALS = clock.no_phases()
+        self.PHASE_COUNT = 0
+        for index, result in enumerate(results.RESULTS):
+            if not results.TIMED[index] or self.is_error(result):
+                continue # so averages are not diluted by untimed items
+            self.PHASE_COUNT += 1
+            for phase in clock.PHASES:
+                self.PHASE_TOTALS[phase] += results.PHASES[phase][index]
+        avetime = totaltime/max(1, len(results.TOOK))
         self.TIME_TOTAL = '%.1f'%(totaltime)
         self.TIME_AVERAGE = '%.3f'%avetime
         self.TIME_MINUTES = '%.1f'%(totaltime/60)
+        
+    def average_passes(self, passes, merged):
+        '''Keep the mean time and phases of each item over passes, the
+        SampleResults of runs, eg. the warm passes of protocol.ColdWarm.
+
+        Totals and averages are then those of an average pass, while the
+        histogram is merged, the times of every pass.
+        '''
+        results = SampleResults(len(self.ITEMS))
+        count = len(passes)
+        for index in xrange(len(self.ITEMS)):
+            took = sum([found.TOOK[index] for found in passes])/count
+            timed = [found.phases(index) for found in passes if found.TIMED[index]]
+            phases = None
+            if timed:
+                phases = dict([(phase, sum([each[phase] for each in timed])/len(timed))
+                               for phase in clock.PHASES])
+            results.store(index, passes[-1].RESULTS[index], took, phases)
+        self.RESULTS = results
+        self.calc_times()
+        self.HISTOGRAM = merged
+        
+    def is_error(self, result):
+        '''Return True if the result shows the engine failed.'''
+        return str(result).startswith(ERROR_MARKS)
 
     def result(self):
         '''Return a summary of results.'''
@@ -75,24 +386,49 @@ class SampleSet(object):
         answer.append('Total time taken: %s'%self.TIME_TOTAL)
         answer.append('Average time taken: %s'%self.TIME_AVERAGE)
         answer.append('Minutes taken: %s'%self.TIME_MINUTES)
+        p50, p90, p99, high, stdev, errors = self.HISTOGRAM.summary()
+        answer.append('Percentiles 50, 90 and 99: %s %s %s'%(p50, p90, p99))
+        answer.append('Maximum time taken: %s'%high)
+        answer.append('Standard deviation: %s'%stdev)
+        answer.append('Errors: %s'%errors)
+        if self.WORKERS > 1:
+            answer.append('Workers: %s %s'%(self.WORKERS, self.CONCURRENCY))
+            answer.append('Wall clock time: %s'%self.TIME_WALL)
+        if self.PHASE_COUNT:
+            averages = phase_averages(self.PHASE_TOTALS, self.PHASE_COUNT)
+            parts = ['%s %s'%pair for pair in zip(clock.PHASES, averages)]
+            answer.append('Average phases: %s'%', '.join(parts))
         return '\n'.join(answer)
                 
     def save(self, fname):
         '''Save results to fname (name of set gets appended).'''
         content = list()
-        content.append('Result\tTime\tItem')
-        for item in self.ITEMS:
-            result = self.ITEMS[item][self.KRESULT]
-            time = '%.3f'%self.ITEMS[item][self.KTOOK]
-            content.append('%s\t%s\t%s'%(result, time, item))
+        if self.PHASE_COUNT: # phases follow the item, see clock.PHASES
+            content.append('Result\tTime\tItem\t%s'%clock.PHASE_HEADER)
+        else:
+            content.append('Result\tTime\tItem')
+        for item, result, took, phases in self.items():
+            row = '%s\t%.3f\t%s'%(result, took, item)
+            if self.PHASE_COUNT:
+                times = ['%.4f'%phases.get(phase, 0.0) for phase in clock.PHASES]
+                row = '%s\t%s'%(row, '\t'.join(times))
+            content.append(row)
         total, avg = self.TIME_TOTAL, self.TIME_AVERAGE
         content.append('%s\t%s\tTimes, total and average'%(total, avg))
+        p50, p90, p99, high, stdev, errors = self.HISTOGRAM.summary()
+        content.append('%s\t%s\tTimes, percentiles 50 and 90'%(p50, p90))
+        content.append('%s\t%s\tTimes, percentile 99 and maximum'%(p99, high))
+        content.append('%s\t%s\tStandard deviation and errors'%(stdev, errors))
+        if self.PHASE_COUNT:
+            averages = phase_averages(self.PHASE_TOTALS, self.PHASE_COUNT)
+            content.append('%s\tPhases, average'%'\t'.join(averages))
         
         lines = '\n'.join(content)
-        fname = '%s-%s.tsv'%(fname, self.NAME)
-        with file(fname, 'w') as savefile:
+        fname = '%s-%s'%(fname, self.NAME)
+        with file('%s.tsv'%fname, 'w') as savefile:
             savefile.writelines(lines)
-        logging.info('Saved to: %s'%fname)
+        logging.info('Saved to: %s.tsv'%fname)
+        self.HISTOGRAM.save('%s.hist'%fname)
         
     def __str__(self):
         return self.result()
@@ -111,10 +447,7 @@ class Samples(object):
         
     def output_dir(self):
         '''Return the location the report should be output to.'''
-        outdir = os.path.join(os.getcwd(),'reports')
-        if not os.path.exists(outdir):
-            os.makedirs(outdir)
-        return outdir
+        return output_dir()
     
     def load(self, nameroot=None):
         '''Prepare all samples for processing.'''
@@ -122,36 +455,38 @@ class Samples(object):
             nameroot = '*%s'%self.SAMEXT
         pattern = os.path.join(self.SAMDIR, nameroot)
         samples = glob.glob(pattern) 
-        for sample in sorted(samples): 
-            self.SAMPLES[sample] = SampleSet()
-            with file(sample) as infile:
-                lines = infile.readlines()
-            self.SAMPLES[sample].load(lines)
+        for sample in sorted(samples): # items are read when first run
+            self.SAMPLES[sample] = SampleSet(batch(sample))
             self.SAMPLE_LIMIT -= 1
             if not self.SAMPLE_LIMIT:
                 break
         logging.info('Samples to process: %s '%len(self.SAMPLES))
                 
-    def enable(self, engine=None, name=None):
+    def enable(self, engine=None, name=None, workers=1, concurrency='threads'):
         '''Enable the engines and names for all samples.'''
         logging.info('Engine enabled: %s'%engine)
+        if workers > 1:
+            logging.info('Workers: %s %s'%(workers, concurrency))
         self.NAME = name
         for sample in self.SAMPLES:
-            self.SAMPLES[sample].enable(engine, name)
+            self.SAMPLES[sample].enable(engine, name, workers, concurrency)
     
     def runall(self):
         '''Run all the samples against the engines and save results.'''
         for sample in sorted(self.SAMPLES):
             logging.info('Doing: %s'%sample)             
             self.SAMPLES[sample].run()
-            # need to stop results being in the folder with samples
-            name = sample.replace('%s/'%self.SAMDIR, '')
-            name = name.replace(self.SAMEXT, '')
-            fname = os.path.join(self.OUTDIR, name)
-            self.SAMPLES[sample].save(fname)
+            self.SAMPLES[sample].save(self.report_name(sample))
             if self.PAUSE_BETWEEN:
                 time.sleep(self.PAUSE_BETWEEN)
     
+    def report_name(self, sample):
+        '''Return where to save the report of sample, less the engine.'''
+        # need to stop results being in the folder with samples
+        name = sample.replace('%s/'%self.SAMDIR, '')
+        name = name.replace(self.SAMEXT, '')
+        return os.path.join(self.OUTDIR, name)
+    
     def result(self):
         '''Return a summary of all samples.'''
         answer = list()
@@ -171,26 +506,47 @@ class Samples(object):
     
     def summary_table(self):
         answer = list()
-        answer.append('TMins\tTSecs\tTAverage\tSample')
+        answer.append('%s\tSample'%SUMMARY_HEADER)
         for sample in sorted(self.SAMPLES):
             answer.append(self.summary_sample(sample))
+        answer.append(summary_histogram(self.histogram(), 'All samples'))
         return '\n'.join(answer)
     
     def summary_sample(self, sample, altname=''):
         t = self.SAMPLES[sample].TIME_TOTAL
         a = self.SAMPLES[sample].TIME_AVERAGE
         m = self.SAMPLES[sample].TIME_MINUTES
+        spread = '\t'.join(self.SAMPLES[sample].HISTOGRAM.summary())
         if altname: # make it so last column content can vary
             sample = altname
-        return '%s\t%s\t%s\t%s'%(m, t, a, sample)
+        return '%s\t%s\t%s\t%s\t%s'%(m, t, a, spread, sample)
+    
+    def phases(self):
+        '''Return the phase totals of all samples and items they cover.'''
+        totals = clock.no_phases()
+        count = 0
+        for sample in self.SAMPLES:
+            sampleset = self.SAMPLES[sample]
+            count += sampleset.PHASE_COUNT
+            for phase in clock.PHASES:
+                totals[phase] += sampleset.PHASE_TOTALS[phase]
+        return totals, count
+        
+    def histogram(self):
+        '''Return the times of all samples merged together.'''
+        merged = histogram.Histogram()
+        for sample in self.SAMPLES:
+            merged.merge(self.SAMPLES[sample].HISTOGRAM)
+        return merged
         
     def save(self):
         '''Save a summary of results for all samples.'''
         if not self.NAME:
             self.NAME = 'quick'
-        fname = os.path.join(self.OUTDIR,'summary-%s.tsv'%self.NAME)
-        with file(fname, 'w') as outfile:
+        fname = os.path.join(self.OUTDIR,'summary-%s'%self.NAME)
+        with file('%s.tsv'%fname, 'w') as outfile:
             outfile.write(self.summary_table())
+        self.histogram().save('%s.hist'%fname)
             
     def __str__(self):
         return self.result()
@@ -35,6 +35,13 @@ class PiwiEngines():
         self.add('pi_indexed', token, ipaddress, query='ac1year')
         self.add('pi_indexed', token, ipaddress, query='24months')
 
+    def enable_standin(self, address):
+        '''Use the stand-in server at address, see standin.py.'''
+        token = 'standin'
+        self.add('standin', token, address, 'root')
+        self.add('standin', token, address, 'root', query='last12months')
+        self.add('standin', token, address, 'root', query='ac1year')
+
     def get_sources(self):
         self.enable_all()
         return self.SOURCES
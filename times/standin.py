@@ -0,0 +1,304 @@
+'''Stand-in for the results pages and Piwik API to run engines offline.'''
+import json
+import logging
+import random
+import threading
+import time
+import urlparse
+import zlib
+import BaseHTTPServer
+import SocketServer
+
+TODAY = (2013, 9) # year and month lastN periods count back from
+FIRST = (2008, 1) # first month with any data
+ACADEMIC_START = 8 # academic years start in August
+ITEM_BASE = 'http://ora.ox.ac.uk/objects/' # other bases have no data
+BATCH_LIMIT = 1000
+
+def month_number(year, month):
+    return int(year)*12 + int(month) - 1
+
+def month_name(number):
+    return number//12, number%12 + 1
+
+def counts(scode, month):
+    '''Return the views and downloads of scode in a month number.
+
+    The same scode and month always give the same counts, and about one
+    scode in ten has none at all, so runs can be compared.
+    '''
+    if zlib.crc32('empty %s'%scode) % 10 == 0:
+        return 0, 0
+    if month < month_number(*FIRST) or month > month_number(*TODAY):
+        return 0, 0
+    check = zlib.crc32('%s %s'%(scode, month)) & 0xffffffff
+    return check % 50, (check >> 8) % 10
+
+class FixedLatency(object):
+    '''Every request takes the same time.'''
+    def __init__(self, seconds=0.05):
+        self.SECONDS = seconds
+
+    def wait(self):
+        time.sleep(self.SECONDS)
+
+    def __str__(self):
+        return 'fixed %.3fs'%self.SECONDS
+
+class LognormalLatency(object):
+    '''Times with a long tail, as most web servers give.'''
+    def __init__(self, median=0.05, sigma=0.5, seed=1):
+        self.MEDIAN = median # seconds
+        self.SIGMA = sigma # spread of the underlying normal
+        self.RANDOM = random.Random(seed)
+        self.LOCK = threading.Lock()
+
+    def wait(self):
+        with self.LOCK:
+            seconds = self.MEDIAN*self.RANDOM.lognormvariate(0, self.SIGMA)
+        time.sleep(seconds)
+
+    def __str__(self):
+        return 'lognormal median %.3fs sigma %s'%(self.MEDIAN, self.SIGMA)
+
+class QueueingLatency(object):
+    '''Requests queue for a fixed number of servers, so time grows with load.
+
+    Each request waits for one of the servers then holds it for a time
+    drawn from an exponential distribution, like an M/M/c queue.
+    '''
+    def __init__(self, service=0.05, servers=4, seed=1):
+        self.SERVICE = service # average seconds holding a server
+        self.SERVERS = threading.Semaphore(servers)
+        self.COUNT = servers
+        self.RANDOM = random.Random(seed)
+        self.LOCK = threading.Lock()
+
+    def wait(self):
+        with self.LOCK:
+            seconds = self.RANDOM.expovariate(1.0/self.SERVICE)
+        with self.SERVERS:
+            time.sleep(seconds)
+
+    def __str__(self):
+        return 'queueing service %.3fs servers %s'%(self.SERVICE, self.COUNT)
+
+def latency_model(spec):
+    '''Return a latency model from eg. fixed:0.05, lognormal:0.05:0.5,
+    queue:0.05:4 or none.'''
+    parts = spec.split(':')
+    values = [float(value) for value in parts[1:]]
+    if parts[0] == 'none':
+        return FixedLatency(0)
+    if parts[0] == 'fixed':
+        return FixedLatency(*values)
+    if parts[0] == 'lognormal':
+        return LognormalLatency(*values)
+    if parts[0] == 'queue':
+        if len(values) > 1:
+            values[1] = int(values[1])
+        return QueueingLatency(*values)
+    raise ValueError('Unknown latency model: %s'%spec)
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answer the URLs SingleRequest and MultipleRequest use.'''
+    protocol_version = 'HTTP/1.1' # so clients can keep connections alive
+    server_version = 'StatsStandIn/1'
+    wbufsize = -1 # send the head and body together, avoiding delayed ACKs
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        scode = params.get('scode', [''])[0]
+        if url.path.endswith('/index.php') and params.get('module') == ['API']:
+            content = self.api(params)
+        elif url.path.startswith('/results/'):
+            self.server.RESULTS_LATENCY.wait()
+            content = self.results(url.path, scode, params)
+        else:
+            content = None
+        if content is None:
+            return self.send_error(404)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def results(self, path, scode, params):
+        '''Return the content of a results page, or None if unknown.'''
+        if path.startswith('/results/dv/'):
+            return '%s;%s'%self.totals('uuid:%s'%''.join(path.split('/')[3:]))
+        if path in ('/results/vdown.php', '/results/vdown_act.php',
+                    '/results/get.php'):
+            return '%s;%s'%self.totals(scode)
+        if path == '/results/yearmonth.php':
+            academic = params.get('yeartype', [''])[0] == 'ac'
+            lines = list()
+            for month in self.months():
+                year, number = month_name(month)
+                if academic and number < ACADEMIC_START:
+                    label = '%s-%02d'%(year-1, year%100)
+                elif academic:
+                    label = '%s-%02d'%(year, (year+1)%100)
+                else:
+                    label = year
+                views, downloads = counts(scode, month)
+                lines.append('%s\t%s\t%s\t%s'%(label, number, views, downloads))
+            return '\n'.join(lines)
+        if path == '/results/getgrby.php':
+            lines = list()
+            for year in range(FIRST[0], TODAY[0]+1):
+                months = self.months(month_number(year, 1), month_number(year, 12))
+                views, downloads = self.totals(scode, months)
+                lines.append('%s\t%s\t%s'%(year, views, downloads))
+            return '\n'.join(lines)
+        if path == '/results/batch.php':
+            scodes = list()
+            for value in params.get('scodes', []):
+                scodes += [code for code in value.split(',') if code]
+            lines = ['%s\t%s;%s'%((code,) + self.totals(code))
+                     for code in scodes[:BATCH_LIMIT]]
+            return '\n'.join(lines)
+        return None
+
+    def months(self, start=None, end=None):
+        '''Return the month numbers with data between start and end.'''
+        first = month_number(*FIRST)
+        last = month_number(*TODAY)
+        if start is not None:
+            first = max(first, start)
+        if end is not None:
+            last = min(last, end)
+        return range(first, last+1)
+
+    def totals(self, scode, months=None):
+        '''Return the total views and downloads of scode over months.'''
+        if months is None:
+            months = self.months()
+        views = 0
+        downloads = 0
+        for month in months:
+            v, d = counts(scode, month)
+            views += v
+            downloads += d
+        return views, downloads
+
+    def api(self, params):
+        '''Return the JSON answer to a Piwik API call.'''
+        method = params.get('method', [''])[0]
+        if method == 'API.getBulkRequest':
+            answers = list()
+            number = 0
+            while 'urls[%s]'%number in params:
+                call = urlparse.parse_qs(params['urls[%s]'%number][0])
+                answers.append(self.api_call(call))
+                number += 1
+            return json.dumps(answers)
+        return json.dumps(self.api_call(params))
+
+    def api_call(self, params):
+        '''Return the decoded answer to a single Piwik API call.'''
+        self.server.API_LATENCY.wait()
+        method = params.get('method', [''])[0]
+        if method == 'Actions.getPageUrl':
+            url = params.get('pageUrl', [''])[0]
+            field = 0
+        elif method == 'Actions.getDownload':
+            url = params.get('downloadUrl', [''])[0]
+            field = 1
+        else:
+            return {'result': 'error', 'message': 'Unknown method: %s'%method}
+        scode = None
+        if url.startswith(ITEM_BASE):
+            scode = url[len(ITEM_BASE):].split('/')[0].replace('%3A', ':')
+        period = params.get('period', ['year'])[0]
+        date = params.get('date', ['last5'])[0]
+        answer = dict()
+        for label, months in self.periods(period, date):
+            rows = list()
+            if scode:
+                total = self.totals(scode, months)[field]
+                if total:
+                    rows.append({'label': url, 'nb_hits': total,
+                                 'nb_visits': total})
+            answer[label] = rows
+        if period == 'range':
+            return answer.values()[0]
+        return answer
+
+    def periods(self, period, date):
+        '''Return a label and months for each period a Piwik query covers.'''
+        today = month_number(*TODAY)
+        if ',' in date:
+            start, end = [d.split('-') for d in date.split(',')]
+            first = month_number(start[0], start[1])
+            last = month_number(end[0], end[1])
+        else:
+            count = int(date.replace('last', '') or 1)
+            last = today
+            if period == 'year':
+                first = month_number(TODAY[0]-count+1, 1)
+            else:
+                first = today-count+1
+        if period == 'range':
+            return [(date, range(first, last+1))]
+        if period == 'month':
+            return [('%s-%02d'%month_name(m), [m]) for m in range(first, last+1)]
+        years = range(month_name(first)[0], month_name(last)[0]+1)
+        return [(str(year), range(max(first, month_number(year, 1)),
+                                  min(last, month_number(year, 12))+1))
+                for year in years]
+
+    def log_message(self, format, *args):
+        logging.debug('%s %s'%(self.address_string(), format%args))
+
+class StandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Threaded server taking the time latency models give.'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, results_latency=None, api_latency=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandInHandler)
+        self.RESULTS_LATENCY = results_latency or FixedLatency(0)
+        self.API_LATENCY = api_latency or FixedLatency(0)
+
+    def handle_error(self, request, client_address):
+        logging.debug('Stand-in request failed: %s'%(client_address,),
+                      exc_info=True)
+
+    def start(self):
+        '''Serve from a background thread, eg. within a test run.'''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def address(self):
+        '''Return the host:port engines should use.'''
+        return '%s:%s'%self.server_address
+
+def command_line():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('-p', help='Port to listen on', dest='port',
+                      default=8090, type='int')
+    parser.add_option('-r', help='Latency of results pages, eg. fixed:0.05, '
+                      'lognormal:0.05:0.5 or queue:0.05:4', dest='results',
+                      default='fixed:0.02')
+    parser.add_option('-a', help='Latency of each Piwik API call',
+                      dest='api', default='lognormal:0.1:0.5')
+    parser.add_option('-v', help='Enables info logging', dest='info',
+                      default=False, action="store_true")
+    (options, unused) = parser.parse_args()
+    if options.info:
+        logging.basicConfig(level=logging.INFO)
+    return options
+
+if __name__ == '__main__':
+    options = command_line()
+    server = StandIn(('', options.port), latency_model(options.results),
+                     latency_model(options.api))
+    logging.warn('Stand-in on port %s, results %s, API %s'%(options.port,
+                 server.RESULTS_LATENCY, server.API_LATENCY))
+    server.serve_forever()